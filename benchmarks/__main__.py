@@ -0,0 +1,119 @@
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+"""
+    Runs PAL's benchmark suite.
+
+    Every run happens in a temporary working directory holding a copy of pal/config, so the benchmarks
+    neither read nor disturb the results and caches in pal/results. Queries go to a local stand-in for
+    AstorbDB (see benchmarks/server.py) and astropy is kept offline, so the suite runs without a network
+    connection. Each run is stored in benchmarks/results, and can be compared to an earlier run.
+
+    Usage:
+        python -m benchmarks
+        python -m benchmarks --pages 20 --latency 0.05 --compare
+        python -m benchmarks --only pipeline propogate --compare benchmarks/results/<run>.json
+        python -m benchmarks --validate
+"""
+
+RESULTS_DIR = "benchmarks/results"
+
+def offline_astropy():
+    """ Keep astropy from downloading IERS and leap second tables, using the tables installed with it. """
+    from astropy.utils import iers
+    from astropy.utils.data import conf
+
+    conf.allow_internet = False
+    iers.conf.auto_download = False
+    iers.conf.iers_degraded_accuracy = 'ignore'
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Run PAL's benchmark suite.")
+    parser.add_argument('--repeat', type=int, default=5, help="the number of timed calls of each benchmark")
+    parser.add_argument('--pages', type=int, default=5, help="the number of pages the stand-in server returns per night")
+    parser.add_argument('--latency', type=float, default=0.0, help="the latency of the stand-in server in seconds")
+    parser.add_argument('--rows', type=int, default=100000, help="the number of asteroids in the storage and propogation benchmarks")
+    parser.add_argument('--page-file', default=None, help="a file of pages recorded with benchmarks.server.record_pages to replay")
+    parser.add_argument('--only', nargs='+', default=None, help="run only the benchmarks whose names contain these strings")
+    parser.add_argument('--compare', nargs='?', const='latest', default=None, help="compare to a stored run. Default is the latest run.")
+    parser.add_argument('--threshold', type=float, default=0.1, help="the relative slowdown that counts as a regression")
+    parser.add_argument('--validate', action='store_true', help="check the two-body propogator against astropy instead of running the suite")
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help="the directory runs are stored in")
+    args = parser.parse_args(argv)
+
+    root = os.getcwd()
+    results_dir = os.path.abspath(args.results_dir)
+    page_file = os.path.abspath(args.page_file) if args.page_file else None
+    sys.path.insert(0, root)
+
+    offline_astropy()
+    if args.validate:
+        from benchmarks.validation import validate
+        return 0 if validate() else 1
+
+    from benchmarks.suite import build_suite, compare, latest_result, run_suite
+    from pal.astorb.throttle import Throttle, set_throttle
+
+    workdir = tempfile.mkdtemp(prefix="pal-bench-")
+    try:
+        shutil.copytree(os.path.join(root, "pal/config"), os.path.join(workdir, "pal/config"))
+        os.chdir(workdir)
+
+        suite, server = build_suite(args.pages, args.latency, args.rows, page_file)
+        with server:
+            # The stand-in server has no rate limit, so the benchmarks measure PAL rather than the throttle
+            set_throttle(server.url, Throttle(requests_per_second=0))
+            results = run_suite(suite, args.repeat, args.only)
+    finally:
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    run = {
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "config": {"repeat": args.repeat, "pages": args.pages, "latency": args.latency, "rows": args.rows, "page_file": args.page_file},
+        "results": results,
+    }
+    os.makedirs(results_dir, exist_ok=True)
+    file_name = os.path.join(results_dir, f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{run['revision']}.json")
+    with open(file_name, 'w') as f:
+        json.dump(run, f, indent=4)
+    print(f"Results written to {os.path.relpath(file_name, root)}")
+
+    if args.compare is None:
+        return 0
+
+    baseline_file = latest_result(results_dir, exclude=file_name) if args.compare == 'latest' else args.compare
+    if baseline_file is None:
+        print("No earlier run to compare to.")
+        return 0
+
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    if baseline['config'] != run['config']:
+        print(f"Warning: {baseline_file} was run with a different configuration: {baseline['config']}")
+
+    print(f"Compared to {os.path.relpath(baseline_file, root)} ({baseline['revision']}):")
+    regressions = compare(results, baseline['results'], args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
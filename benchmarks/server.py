@@ -0,0 +1,148 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+
+import numpy as np
+
+"""
+    Contains the StubServer class, a local stand-in for the AstorbDB GraphQL API.
+    It answers ephemeris queries with keyset pagination on ast_number, as the real API does, from either
+    synthetic rows or pages recorded from the real API. Each response can be delayed by a fixed latency,
+    so the benchmarks measure PAL's side of a run without a network connection. Has the function:
+        record_pages(): Records the pages of a real query, to be replayed by the server.
+"""
+
+PAGE_SIZE = 1000
+
+class StubServer():
+    url = None
+    requests = None
+
+    def __init__(self, pages: int = 5, latency: float = 0.0, page_file: str = None, seed: int = 0):
+        """ Build the rows the server answers with.
+        :param pages: the number of pages a night's query returns. The last page is half full.
+        :param latency: the time to wait before answering each request, in seconds
+        :param page_file: a file of pages recorded with record_pages, replayed instead of synthetic rows
+        :param seed: the seed of the synthetic rows
+        """
+        self.latency = latency
+        self.requests = 0
+
+        if page_file is not None:
+            with open(page_file, 'r') as f:
+                rows = [row for page in json.load(f) for row in page]
+        else:
+            rows = synthetic_rows(max(pages - 1, 0) * PAGE_SIZE + PAGE_SIZE // 2, seed)
+
+        # Encode every page once, so the server's own work does not weigh on the benchmarks
+        self.numbers = np.array([row['minorplanet']['ast_number'] for row in rows], dtype=np.int64)
+        self.rows = [json.dumps(row) for row in rows]
+        self.server = None
+
+    def __enter__(self) -> 'StubServer':
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """ Start serving on a free local port, in a background thread. """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+                body = stub.answer(query)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """ Stop serving. """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def answer(self, query: str) -> bytes:
+        """ Answer a query with the page of rows after its last asteroid number, for each of its selections.
+        :param query: the GraphQL query built by pal.astorb.query.Query, with one selection or several aliased ones
+        :return: the encoded response
+        """
+        self.requests += 1
+        selections = re.findall(r'(?:(\w+):\s*)?ephemeris\((?:(?!ephemeris\().)*?ast_number: \{_gt: "(\d+)"', query, re.S)
+        answers = []
+        for alias, last_id in selections or [('', '0')]:
+            start = int(np.searchsorted(self.numbers, int(last_id), side='right'))
+            page = self.rows[start:start + PAGE_SIZE]
+            answers.append(f'"{alias or "ephemeris"}": [' + ', '.join(page) + ']')
+        return ('{"data": {' + ', '.join(answers) + '}}').encode()
+
+def synthetic_rows(count: int, seed: int = 0) -> list[dict]:
+    """ Generate ephemeris rows shaped like those returned by AstorbDB.
+    :param count: the number of rows
+    :param seed: the random seed
+    :return: the rows, ordered by asteroid number
+    """
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 2 * np.pi, count)
+    dec = rng.uniform(np.radians(-25), np.radians(77), count)
+    ra_rate = rng.normal(0, 40, count)
+    dec_rate = rng.normal(0, 20, count)
+    v_mag = rng.uniform(10, 16.5, count)
+
+    return [
+        {
+            "minorplanet": {"ast_number": i + 1, "designameByIdDesignationPrimary": {"str_designame": f"{2000 + i % 25} {chr(65 + i % 26)}{chr(65 + i // 26 % 26)}{i % 1000}"}},
+            "ra": float(ra[i]),
+            "ra_rate": float(ra_rate[i]),
+            "dec": float(dec[i]),
+            "dec_rate": float(dec_rate[i]),
+            "v_mag": float(v_mag[i]),
+        }
+        for i in range(count)
+    ]
+
+def record_pages(date: str, sky_range: tuple[float, float, float, float], v_mag: float, file_name: str, url: str = None) -> int:
+    """ Record the pages of a real query, to be replayed by the server without a network connection.
+    :param date: the date to query, YYYY-MM-DD
+    :param sky_range: the sky range to query (ra_min, ra_max, dec_min, dec_max) in radians
+    :param v_mag: the limiting magnitude
+    :param file_name: the JSON file to write the pages to
+    :param url: the GraphQL endpoint to query. Defaults to the AstorbDB API.
+    :return: the number of pages recorded
+    """
+    from pal.astorb.query import Query
+
+    query = Query(url=url)
+    pages = []
+    last_id = 0
+    while True:
+        query.build_query(*sky_range, date=date, mag_lim=v_mag, last_id=last_id)
+        query.get_results()
+        page = query.data['data']['ephemeris']
+        pages.append(page)
+        if len(page) < PAGE_SIZE:
+            break
+        last_id = page[-1]['minorplanet']['ast_number']
+
+    with open(file_name, 'w') as f:
+        json.dump(pages, f)
+    return len(pages)
@@ -0,0 +1,209 @@
+from contextlib import redirect_stderr, redirect_stdout
+import glob
+import json
+import os
+import shutil
+import statistics
+import time
+
+import numpy as np
+
+from benchmarks.server import StubServer, synthetic_rows
+
+"""
+    Contains the benchmarks and the functions to run and compare them.
+    Each benchmark times one call of a part of PAL, after an untimed setup that puts it back in the same
+    starting state (for example, with the night geometry or query caches emptied). Has the functions:
+        build_suite(): Builds the list of benchmarks for a configuration.
+        run_suite(): Runs the benchmarks and collects their timings.
+        compare(): Compares a run to a baseline run, flagging regressions.
+"""
+
+class Benchmark():
+    name = None
+    run = None
+    setup = None
+    items = None
+    unit = None
+
+    def __init__(self, name: str, run, setup=None, items: int = None, unit: str = None):
+        """ Describe a benchmark.
+        :param name: the name of the benchmark
+        :param run: the function to time
+        :param setup: the function run before each timed call, untimed
+        :param items: the number of items each call processes, to report a throughput
+        :param unit: the name of the items
+        """
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.items = items
+        self.unit = unit
+
+def build_suite(pages: int = 5, latency: float = 0.0, rows: int = 100000, page_file: str = None) -> tuple[list[Benchmark], StubServer]:
+    """ Build the benchmarks. Must be run from a working directory holding a copy of pal/config.
+    :param pages: the number of pages the stand-in server returns per night
+    :param latency: the latency of the stand-in server in seconds
+    :param rows: the number of asteroids in the storage and propogation benchmarks
+    :param page_file: a file of recorded pages for the stand-in server to replay
+    :return: the benchmarks, and the stand-in server they query (not yet started)
+    """
+    from astropy.time import Time
+    import astropy.units as u
+
+    from benchmarks.validation import synthetic_elements
+    from pal.astorb.kepler import Orbits
+    from pal.astorb.pipeline import get_sky_range, get_sky_ranges, pipeline
+    from pal.astorb.product import EphemerisProduct
+    from pal.astorb.propogate import get_time_steps, log_ephemera, propogate, propogate_positions
+    from pal.astorb.storage import flatten, write_observable
+    from pal.utils.asteroid import AsteroidTable
+    from pal.utils.telescope import Telescope
+
+    for directory in ("pal/results/ephemera", "pal/results/observable", "pal/results/logs"):
+        os.makedirs(directory, exist_ok=True)
+
+    telescope = Telescope('Pathfinder')
+    date = Time('2025-01-08', scale='utc')
+    month = date + np.arange(30) * u.day
+    week = date + np.arange(4) * u.day
+    full_week = date + np.arange(7) * u.day
+
+    server = StubServer(pages=pages, latency=latency, page_file=page_file)
+    page_rows = len(server.rows)
+
+    def clear_geometry():
+        telescope.geometry.nights = {}
+
+    def clear_queries():
+        for directory in ("pal/results/cache/queries", "pal/results/cache/journal"):
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def run_pipeline(dates, workers, batch=1):
+        # The pipeline reports its progress with tqdm, which is not part of what is measured.
+        # The stand-in server ignores the sky range, so each night is queried as one box to keep the rows comparable.
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+            pipeline(dates, telescope, True, workers=workers, url=server.url, plan=False, batch=batch)
+
+    # Synthetic asteroids for the storage and propogation benchmarks, on a night the pipeline benchmarks do not write
+    night = Time('2025-02-01', scale='utc')
+    records = flatten(synthetic_rows(rows))
+    asteroids = AsteroidTable.from_records(records)
+    start, end = telescope.get_night_length(night)
+    offsets = get_time_steps(night.datetime, start, end, 15)
+    observable = write_observable(records, night.datetime, telescope.slug)
+    ra, dec = propogate_positions(asteroids, offsets)
+    json_rows = [json.loads(row) for row in server.rows]
+
+    def read_step(compression, days):
+        # Write a product once, on a night of its own, then read the slice in the middle of the night back from it
+        product_file = log_ephemera(asteroids, offsets, ra, dec, (night + days * u.day).datetime, telescope.slug, compression)
+        def read():
+            with EphemerisProduct(product_file) as product:
+                product.step(len(offsets) // 2)
+        return read
+
+    # Synthetic orbits for the two-body propogator, observed at the same time steps
+    elements = synthetic_elements(rows)
+    orbits = Orbits(elements)
+    steps = night + offsets * u.min
+
+    suite = [
+        Benchmark("telescope.get_night_length", lambda: telescope.get_night_length(date), setup=clear_geometry, items=1, unit="nights"),
+        Benchmark("telescope.get_night_length (cached)", lambda: telescope.get_night_length(date), items=1, unit="nights"),
+        Benchmark("pipeline.get_sky_range", lambda: get_sky_range(date, telescope), setup=clear_geometry, items=1, unit="nights"),
+        Benchmark("pipeline.get_sky_ranges (30 nights)", lambda: get_sky_ranges(month, telescope), setup=clear_geometry, items=len(month), unit="nights"),
+        Benchmark("pipeline (1 night)", lambda: run_pipeline(date.reshape((1,)), 1), setup=clear_queries, items=page_rows, unit="rows"),
+        Benchmark("pipeline (4 nights, 4 workers)", lambda: run_pipeline(week, 4), setup=clear_queries, items=4 * page_rows, unit="rows"),
+        Benchmark("pipeline (7 nights)", lambda: run_pipeline(full_week, 1), setup=clear_queries, items=7 * page_rows, unit="rows"),
+        Benchmark("pipeline (7 nights, batch 7)", lambda: run_pipeline(full_week, 1, batch=7), setup=clear_queries, items=7 * page_rows, unit="rows"),
+        Benchmark("storage.flatten", lambda: flatten(json_rows), items=page_rows, unit="rows"),
+        Benchmark("storage.write_observable", lambda: write_observable(records, night.datetime, telescope.slug), items=rows, unit="rows"),
+        Benchmark("json.dump (observable rows)", lambda: dump_json(records), items=rows, unit="rows"),
+        Benchmark("propogate.propogate_positions", lambda: propogate_positions(asteroids, offsets), items=rows * len(offsets), unit="object-epochs"),
+        Benchmark("propogate.log_ephemera", lambda: log_ephemera(asteroids, offsets, ra, dec, night.datetime, telescope.slug), items=rows * len(offsets), unit="object-epochs"),
+        Benchmark("propogate.log_ephemera (gzip)", lambda: log_ephemera(asteroids, offsets, ra, dec, night.datetime, telescope.slug, 'gzip'), items=rows * len(offsets), unit="object-epochs"),
+        Benchmark("product.EphemerisProduct.step", read_step('none', 1), items=rows, unit="rows"),
+        Benchmark("product.EphemerisProduct.step (gzip)", read_step('gzip', 2), items=rows, unit="rows"),
+        Benchmark("propogate.propogate (1 night)", lambda: propogate([observable], telescope, 15), items=rows, unit="rows"),
+        Benchmark("propogate.propogate (1 night, 4 processes)", lambda: propogate([observable], telescope, 15, processes=4, tile_size=max(rows // 16, 1)), items=rows, unit="rows"),
+        Benchmark("kepler.Orbits", lambda: Orbits(elements), items=rows, unit="orbits"),
+        Benchmark("kepler.Orbits.observe (geocentric)", lambda: orbits.observe(steps), items=rows * len(offsets), unit="object-epochs"),
+        Benchmark("kepler.Orbits.observe (topocentric)", lambda: orbits.observe(steps, telescope.location), items=rows * len(offsets), unit="object-epochs"),
+    ]
+    return suite, server
+
+def dump_json(records: np.ndarray):
+    """ Write observable rows as JSON, as the pipeline did before the columnar format. """
+    with open("pal/results/observable/benchmark.json", 'w') as f:
+        json.dump([{name: record[name].item() for name in records.dtype.names} for record in records], f)
+
+def run_suite(suite: list[Benchmark], repeat: int = 5, only: list[str] = None) -> dict[str, dict]:
+    """ Run the benchmarks.
+    :param suite: the benchmarks returned by build_suite
+    :param repeat: the number of timed calls of each benchmark
+    :param only: run only the benchmarks whose names contain one of these strings
+    :return: the timings of each benchmark, in seconds
+    """
+    results = {}
+    for benchmark in suite:
+        if only and not any(name in benchmark.name for name in only):
+            continue
+
+        times = []
+        for _ in range(repeat):
+            if benchmark.setup is not None:
+                benchmark.setup()
+            start = time.perf_counter()
+            benchmark.run()
+            times.append(time.perf_counter() - start)
+
+        median = statistics.median(times)
+        results[benchmark.name] = {
+            "median": median,
+            "min": min(times),
+            "max": max(times),
+            "repeat": repeat,
+            "items": benchmark.items,
+            "unit": benchmark.unit,
+            "throughput": benchmark.items / median if benchmark.items and median > 0 else None,
+        }
+        print(format_result(benchmark.name, results[benchmark.name]), flush=True)
+
+    return results
+
+def format_result(name: str, result: dict) -> str:
+    line = f"{name:<40} {result['median'] * 1000:10.2f} ms  (min {result['min'] * 1000:.2f} ms)"
+    if result['throughput']:
+        line += f"  {result['throughput']:,.0f} {result['unit']}/s"
+    return line
+
+def latest_result(results_dir: str, exclude: str = None) -> str | None:
+    """ Find the most recent stored run.
+    :param results_dir: the directory runs are stored in
+    :param exclude: a run to skip, such as the one just written
+    :return: the file of the most recent run, or None if there is none
+    """
+    files = sorted(file_name for file_name in glob.glob(os.path.join(results_dir, "*.json")) if file_name != exclude)
+    return files[-1] if files else None
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float = 0.1) -> list[str]:
+    """ Compare a run to a baseline run.
+    :param results: the timings of the run
+    :param baseline: the timings of the baseline run
+    :param threshold: the relative slowdown of the median time that counts as a regression
+    :return: the names of the benchmarks that regressed
+    """
+    regressions = []
+    print(f"{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<40} {'-':>12} {result['median'] * 1000:10.2f}ms {'new':>8}")
+            continue
+        change = result['median'] / baseline[name]['median'] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<40} {baseline[name]['median'] * 1000:10.2f}ms {result['median'] * 1000:10.2f}ms {change:+7.1%}{flag}")
+    return regressions
@@ -0,0 +1,118 @@
+import numpy as np
+
+"""
+    Contains the checks of the two-body propogator in pal.astorb.kepler against astropy.
+        - round trip: synthetic asteroid orbits are propogated a month ahead, turned back into elements at
+          that time with elements_from_state, and propogated again to a third time. Both paths must agree.
+        - planets: the osculating elements of the inner planets and Jupiter are taken from astropy's
+          built-in ephemeris at the start of a night, then propogated through the night and a week beyond
+          it and compared to astropy's astrometric positions, seen from the telescope with light-time
+          corrected independently. The differences are the planetary perturbations the two-body orbit leaves out.
+    Has the function:
+        validate(): Runs the checks and reports the largest differences.
+"""
+
+# The largest differences allowed, in AU for the round trip and arcseconds for the planets
+ROUND_TRIP_TOLERANCE = 1e-9
+NIGHT_TOLERANCE = 1.0
+WEEK_TOLERANCE = 5.0
+PLANETS = ('mercury', 'venus', 'mars', 'jupiter')
+
+def synthetic_elements(count: int, seed: int = 0, epoch: float = 2460800.5) -> dict[str, np.ndarray]:
+    """ Generate main belt asteroid orbits.
+    :param count: the number of orbits
+    :param seed: the random seed
+    :param epoch: the epoch of osculation, as a TT Julian date
+    :return: the columns of pal.astorb.mirror.ELEMENTS_DTYPE, without designations
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        'ast_number': np.arange(1, count + 1),
+        'epoch': np.full(count, epoch),
+        'a': rng.uniform(1.8, 3.5, count),
+        'e': rng.uniform(0, 0.35, count),
+        'i': np.radians(rng.uniform(0, 35, count)),
+        'node': rng.uniform(0, 2 * np.pi, count),
+        'peri': rng.uniform(0, 2 * np.pi, count),
+        'M': rng.uniform(0, 2 * np.pi, count),
+        'H': rng.uniform(10, 19, count),
+        'G': np.full(count, 0.15),
+    }
+
+def validate(count: int = 100000, telescope: str = 'Pathfinder', date: str = '2025-01-08') -> bool:
+    """ Check the two-body propogator against astropy.
+    :param count: the number of synthetic orbits of the round trip
+    :param telescope: the telescope the planets are observed from
+    :param date: the night the planets are observed on
+    :return: whether every check passed
+    """
+    from astropy.coordinates import get_body_barycentric_posvel
+    from astropy.time import Time
+    import astropy.units as u
+
+    from pal.astorb.kepler import Orbits, elements_from_state, observer_positions
+    from pal.utils.telescope import Telescope
+
+    passed = True
+
+    # Round trip through elements_from_state
+    orbits = Orbits(synthetic_elements(count))
+    middle, end = np.array([2460830.5]), np.array([2460860.5])
+    position, velocity = orbits.state(middle)
+    elements = elements_from_state(position[:, :, 0], velocity[:, :, 0], middle[0])
+    direct, _ = orbits.state(end)
+    round_trip, _ = Orbits(elements).state(end)
+    difference = np.nanmax(np.linalg.norm(direct - round_trip, axis=0))
+    passed &= bool(difference < ROUND_TRIP_TOLERANCE)
+    print(f"{'round trip (' + str(count) + ' orbits)':<28} {difference:.2e} AU  {'ok' if difference < ROUND_TRIP_TOLERANCE else 'FAILED'}")
+
+    # Planets seen from the telescope, against astropy's ephemeris
+    location = Telescope(telescope).location
+    start = Time(date, scale='utc')
+    times = {
+        'night': start + np.arange(0, 12.25, 0.25) * u.hour,
+        'week': start + np.arange(0, 8) * u.day,
+    }
+    tolerances = {'night': NIGHT_TOLERANCE, 'week': WEEK_TOLERANCE}
+
+    for planet in PLANETS:
+        planet_position, planet_velocity = get_body_barycentric_posvel(planet, start)
+        sun_position, sun_velocity = get_body_barycentric_posvel('sun', start)
+        position = (planet_position - sun_position).xyz.to_value(u.AU)[:, None]
+        velocity = (planet_velocity - sun_velocity).xyz.to_value(u.AU / u.day)[:, None]
+        orbits = Orbits(elements_from_state(position, velocity, start.tt.jd))
+
+        for span, span_times in times.items():
+            ra, dec, _ = orbits.observe(span_times, location, magnitudes=False)
+            expected_ra, expected_dec = astrometric(planet, span_times, observer_positions(span_times, location))
+            separation = np.degrees(np.arccos(np.clip(
+                np.sin(dec[0]) * np.sin(expected_dec) + np.cos(dec[0]) * np.cos(expected_dec) * np.cos(ra[0] - expected_ra), -1, 1
+            ))) * 3600
+            ok = separation.max() < tolerances[span]
+            passed &= bool(ok)
+            print(f"{planet + ' (' + span + ')':<28} {separation.max():8.3f} arcsec  {'ok' if ok else 'FAILED'}")
+
+    return passed
+
+def astrometric(planet: str, times, observer: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Get the astrometric position of a planet from astropy's ephemeris, iterating the light-time to convergence.
+    :param planet: the name of the planet
+    :param times: the times of observation
+    :param observer: the heliocentric positions of the observer in AU, shaped (3, number of times)
+    :return: the right ascensions and declinations in radians
+    """
+    from astropy.coordinates import get_body_barycentric
+    import astropy.units as u
+
+    from pal.astorb.kepler import LIGHT_SPEED
+
+    # Measured from the solar system barycenter, where the light-time is exact
+    observer = observer + get_body_barycentric('sun', times).xyz.to_value(u.AU)
+    delay = np.zeros(len(times))
+    for _ in range(3):
+        relative = get_body_barycentric(planet, times - delay * u.day).xyz.to_value(u.AU) - observer
+        delay = np.linalg.norm(relative, axis=0) / LIGHT_SPEED
+
+    ra = np.remainder(np.arctan2(relative[1], relative[0]), 2 * np.pi)
+    dec = np.arcsin(relative[2] / np.linalg.norm(relative, axis=0))
+    return ra, dec
@@ -1,5 +1,6 @@
-import sys
+import argparse
 from importlib import import_module
+import sys
 
 """
     Argus Pathfinder Asteroid Locator (Argus-PAL)
@@ -18,25 +19,47 @@ from importlib import import_module
     The tool is designed to be run from the command line, and requires
     a configuration file to be passed in as an argument. The configuration
     file should contain the necessary information for the telescope.
+
+    Usage:
+        python -m pal ephemeris --start-date 2025-01-08 --end-date 2025-01-15 --mag-lim --workers 4
+        python -m pal nights
+        python -m pal nights --prefill 2025 --telescope Pathfinder
+        python -m pal mirror build astorb.dat.gz
+        python -m pal ephemeris --start-date 2025-01-08 --end-date 2025-01-15 --mag-lim --source local
+        python -m pal lookup 433 --date 2025-01-08 --time 04:30
+        python -m pal --import-time crossmatch --exposures batch.json
+    Each action's heavy imports (astropy, requests, tqdm) are only loaded when that action is run.
 """
 
 # DONE: Implement the asteroid class for type hinting
 # DONE: Implement query code in pipeline.py
 # DONE: Implement logging code in ephemeris.py and logging.py
 # DONE: Fix query retrying when max asteroids is reached
-
-# TODO: Implement propogate code in propogate.py
+# DONE: Implement propogate code in propogate.py
 
 def exectute(**kwargs) -> int:
     """ Execute the Argus-PAL tool with the given parameters.
 
     :param kwargs: Accepted parameters for the tool:
-            - action: The action to perform. Currently only 'ephemeris' is supported.
+            - action: The action to perform. Either 'ephemeris', 'crossmatch' to find the asteroids in a batch of exposures, 'convert' to convert JSON observable files to the columnar format, 'serve' to start the PAL daemon (see pal.client), 'nights' to list the nights with results on disk (or, with prefill, cache the night geometry of a year), 'lookup' to look up a single asteroid on a night, or 'mirror' to build or update the local mirror of the orbital elements.
             - telescope: The name of the telescope to use. Check the configuration file for available telescopes.
+            - telescopes: The names of several telescopes to run the ephemeris action for as one batch, sharing the queries of the sky they have in common. Default is the single telescope.
             - start_date: The start date for the observation period.
             - end_date: The end date for the observation period.
             - mag_lim: Whether to apply a magnitude limit to the query. Default is False. If set to True, the tool will only return asteroids with a magnitude less than or equal to the limit, which is set by the telescope.
             - propogation_interval: The interval at which to propogate the asteroid locations throughout the night. Default is 15 minutes.
+            - workers: The number of nights to query the database for concurrently. Default is 1.
+            - reuse: The largest number of consecutive nights one database query is reused for, predicting the nights in between locally. Default is 1 (no reuse).
+            - tolerance: The largest predicted position error in arcseconds before a reused query is refreshed. Default is no limit.
+            - processes: The number of processes to propogate the nights in. Default is 1.
+            - compression: The compression of the ephemeris products, 'none', 'gzip' or 'zstd'. Default is 'none'.
+            - source: Where to find the observable asteroids. Either 'remote' to query AstorbDB, or 'local' to select them from the local mirror of the orbital elements. Default is 'remote'.
+            - batch: The number of nights packed into each database request. Default is 1.
+            - plan: Whether to query only the tiles of sky the telescope can observe each night, instead of one box around the night. Default is True.
+            - prometheus: Whether to also write the run's metrics in the Prometheus text format. Default is False.
+            - profile: Whether to profile each stage of the ephemeris action. Default is False.
+            - profile_memory: Whether to also report the peak memory of each stage. Default is False.
+            - prefill: A year to cache the night geometry of with the nights action, instead of listing the nights. Default is None.
     :return: 0 if successful, 1 if an error occurred.
     """
     return import_module(f'pal.actions.{kwargs.pop("action")}').execute(**kwargs)
@@ -44,23 +67,80 @@ def exectute(**kwargs) -> int:
 def main(p: dict) -> int:
     return exectute(**p)
 
+def parse_args(argv: list[str] = None) -> tuple[dict, bool]:
+    """ Parse the command line into the parameters for exectute.
+    Only argparse is imported here, so --help and the quick actions do not wait on astropy.
+
+    :param argv: the command line arguments. Default is sys.argv.
+    :return: the parameters, and whether to report the import time of the action
+    """
+    parser = argparse.ArgumentParser(prog="python -m pal", description="Argus Pathfinder Asteroid Locator.")
+    parser.add_argument('--import-time', action='store_true', help="report the time spent importing the action before running it")
+    actions = parser.add_subparsers(dest='action', required=True, metavar='action')
+
+    ephemeris = actions.add_parser('ephemeris', help="query and propogate the asteroids observable each night")
+    ephemeris.add_argument('--telescope', default='Pathfinder', help="the telescope to use")
+    ephemeris.add_argument('--telescopes', nargs='+', default=None, help="several telescopes to run as one batch, sharing the queries of the sky they have in common")
+    ephemeris.add_argument('--start-date', required=True, dest='start_date', help="the start date, YYYY-MM-DD")
+    ephemeris.add_argument('--end-date', required=True, dest='end_date', help="the end date, YYYY-MM-DD")
+    ephemeris.add_argument('--mag-lim', action='store_true', dest='mag_lim', help="apply the telescope's limiting magnitude")
+    ephemeris.add_argument('--interval', type=int, default=15, dest='propogation_interval', help="the propogation interval in minutes")
+    ephemeris.add_argument('--workers', type=int, default=1, help="the number of nights to query concurrently")
+    ephemeris.add_argument('--batch', type=int, default=1, help="the number of nights packed into each database request")
+    ephemeris.add_argument('--reuse', type=int, default=1, help="the number of consecutive nights one query is reused for")
+    ephemeris.add_argument('--tolerance', type=float, default=None, help="the largest predicted position error in arcseconds")
+    ephemeris.add_argument('--processes', type=int, default=1, help="the number of processes to propogate the nights in")
+    ephemeris.add_argument('--compression', choices=['none', 'gzip', 'zstd'], default='none', help="the compression of the ephemeris products")
+    ephemeris.add_argument('--source', choices=['remote', 'local'], default='remote', help="query AstorbDB, or select from the local mirror of the orbital elements")
+    ephemeris.add_argument('--no-plan', action='store_false', dest='plan', help="query one box around each night instead of the planned tiles")
+    ephemeris.add_argument('--prometheus', action='store_true', help="also write the run's metrics in the Prometheus text format")
+    ephemeris.add_argument('--profile', action='store_true', help="profile each stage, writing cProfile dumps and collapsed stacks")
+    ephemeris.add_argument('--profile-memory', action='store_true', dest='profile_memory', help="also report the peak memory of each stage")
+
+    crossmatch = actions.add_parser('crossmatch', help="find the asteroids inside a batch of exposures")
+    crossmatch.add_argument('--telescope', default='Pathfinder', help="the telescope to use")
+    crossmatch.add_argument('--exposures', required=True, help="the JSON file of exposures")
+
+    convert = actions.add_parser('convert', help="convert JSON observable files to the columnar format")
+    convert.add_argument('files', nargs='*', help="the JSON files to convert. Default is every JSON observable file.")
+    convert.add_argument('--remove', action='store_true', help="remove each JSON file once converted")
+
+    serve = actions.add_parser('serve', help="start the PAL daemon")
+    serve.add_argument('--telescopes', nargs='+', default=['Pathfinder'], help="the telescopes to warm up")
+    serve.add_argument('--socket', default='pal/results/pal.sock', help="the Unix socket to listen on")
+    serve.add_argument('--port', type=int, default=None, help="the local HTTP port to listen on instead of the socket")
+    serve.add_argument('--workers', type=int, default=4, help="the number of connections kept open to the database")
+    serve.add_argument('--cached-nights', type=int, default=8, dest='cached_nights', help="the number of nights kept loaded")
+
+    nights = actions.add_parser('nights', help="list the nights with results on disk")
+    nights.add_argument('--telescope', default=None, help="the telescope to list the nights of")
+    nights.add_argument('--prefill', type=int, default=None, metavar='YEAR', help="compute and cache the night geometry of every date in a year instead")
+
+    lookup = actions.add_parser('lookup', help="look up a single asteroid on a night")
+    lookup.add_argument('asteroid', help="the asteroid number or primary designation")
+    lookup.add_argument('--telescope', default='Pathfinder', help="the telescope to use")
+    lookup.add_argument('--date', required=True, help="the date of the night, YYYY-MM-DD")
+    lookup.add_argument('--time', default=None, help="the UTC time, HH:MM[:SS]. Default is UTC midnight.")
+
+    mirror = actions.add_parser('mirror', help="build or update the local mirror of the orbital elements")
+    mirror.add_argument('command', choices=['build', 'update', 'info'], help="build the mirror from a bulk export, merge a later export into it, or describe it")
+    mirror.add_argument('file', nargs='?', default=None, help="the export file: astorb.dat(.gz) or CSV")
+
+    params = vars(parser.parse_args(argv))
+    import_time = params.pop('import_time')
+    return params, import_time
+
 if __name__ == "__main__":
-    
-    params = {
 
-        # required
-        "action": "ephemeris",
-        "telescope": "Pathfinder",
-        "start_date": "2025-01-08",
-        "end_date": "2025-01-15",
-        "mag_lim": True,
-        "propogation_interval": 15,
+    params, import_time = parse_args()
 
-    }
+    if import_time:
+        from pal.utils.importtime import import_report
+        print(import_report(f"pal.actions.{params['action']}"))
 
     try:
         sys.exit(main(params))
     except KeyboardInterrupt:
         print("\n")
         print("Keyboard interrupt activated. Quitting...")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
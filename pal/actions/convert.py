@@ -0,0 +1,29 @@
+import glob
+import os
+
+from pal.astorb.storage import OBSERVABLE_DIR, convert
+
+"""
+    This script converts observable asteroid files written as pretty-printed JSON by earlier versions
+    of the pipeline into the columnar .npy format, so they can be memory-mapped by the later stages.
+"""
+
+def execute(**kwargs):
+    """ Execute the convert action with the given parameters.
+    :param kwargs: Accepted parameters for the action:
+            - files: The JSON files to convert. Default is every JSON file in pal/results/observable.
+            - remove: Whether to remove each JSON file once it has been converted. Default is False.
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    files = kwargs.get('files') or sorted(glob.glob(os.path.join(OBSERVABLE_DIR, "*.json")))
+    if not files:
+        print("No JSON files to convert.")
+        return 0
+
+    for file_name in files:
+        new_file_name = convert(file_name)
+        if kwargs.get('remove', False):
+            os.remove(file_name)
+        print(f"Converted {file_name} to {new_file_name}")
+
+    return 0
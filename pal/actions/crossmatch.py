@@ -0,0 +1,124 @@
+from astropy.time import Time
+from datetime import datetime
+import json
+import numpy as np
+import os
+from tqdm import tqdm
+from typing import Iterator
+
+from pal.astorb.index import IndexCache
+from pal.astorb.product import find_ephemera
+from pal.utils.telescope import Telescope, get_telescope
+
+"""
+    This script cross-matches a batch of exposures against the stored ephemerides, predicting which
+    asteroids fall inside each camera's footprint. Exposures are processed in time order so each
+    night's ephemera are loaded and indexed only once, and the results are streamed out one exposure at a time.
+
+    Each exposure is a dictionary with the keys:
+        - id: An identifier for the exposure.
+        - time: The UTC time of the exposure, in ISO format.
+        - camera: The ID of the camera that took the exposure.
+        - vertices: The corners of the footprint as a list of [ra, dec] pairs in degrees, in order around the footprint.
+          Alternatively, wcs: the FITS WCS header keywords of the image, including NAXIS1 and NAXIS2.
+"""
+
+def execute(**kwargs):
+    """ Execute the crossmatch action with the given parameters.
+    :param kwargs: Accepted parameters for the action:
+            - telescope: The name of the telescope to use. Check the configuration file for available telescopes.
+            - exposures: The list of exposures to cross-match, or the path to a JSON file containing it.
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    if os.path.exists("pal/results/crossmatch") == False:
+        os.makedirs("pal/results/crossmatch")
+
+    exposures = kwargs['exposures']
+    if isinstance(exposures, str):
+        with open(exposures, 'r') as f:
+            exposures = json.load(f)
+
+    telescope = get_telescope(kwargs['telescope'])
+
+    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    file_name = f"pal/results/crossmatch/xm_{kwargs['telescope']}_{now}.jsonl"
+
+    try:
+        with open(file_name, 'w') as f:
+            for match in tqdm(crossmatch(exposures, telescope), total=len(exposures), desc="Cross-matching exposures", leave=False):
+                f.write(json.dumps(match))
+                f.write('\n')
+    except FileNotFoundError as e:
+        print(f"Missing ephemera: {e.filename}. Run the ephemeris action for this night first.")
+        return 1
+
+    print('Cross-match successfully logged.')
+    print(f'Results available at {file_name}')
+    return 0
+
+def crossmatch(exposures: list[dict], telescope: Telescope, indexes: IndexCache = None) -> Iterator[dict]:
+    """ Predict the asteroids inside each exposure's footprint.
+    :param exposures: the exposures to cross-match
+    :param telescope: the telescope the ephemera were generated for
+    :param indexes: the cache of loaded nights to use, kept between batches by the daemon. Default is a cache of one night.
+    :return: an iterator over the matches of each exposure, in time order
+    """
+    times = Time([exposure['time'] for exposure in exposures], scale='utc')
+    order = np.argsort(times.jd, kind='stable')
+
+    # The night of each exposure is its UTC date, and the ephemeris epoch is UTC midnight of that date
+    nights = times.strftime("%Y-%m-%d")
+    offsets = (times.jd - np.floor(times.jd - 0.5) - 0.5) * 24 * 60
+
+    if indexes is None:
+        indexes = IndexCache()
+
+    night = None
+    index = ephemera = None
+
+    for i in order:
+        exposure = exposures[i]
+
+        # Load and index each night's ephemera only once, since the exposures are in time order
+        if nights[i] != night:
+            night = nights[i]
+            index, ephemera = indexes.get(find_ephemera(night, telescope.slug))
+
+        vertices_ra, vertices_dec = get_footprint(exposure)
+        rows, ra, dec = index.polygon_at(np.radians(vertices_ra), np.radians(vertices_dec), offsets[i])
+
+        columns = zip(
+            ephemera['ast_number'][rows].tolist(),
+            ephemera['designation'][rows].tolist(),
+            np.degrees(ra).tolist(),
+            np.degrees(dec).tolist(),
+            ephemera['v_mag'][rows].tolist(),
+        )
+        yield {
+            "id": exposure.get('id'),
+            "camera": exposure.get('camera'),
+            "time": exposure['time'],
+            "asteroids": [
+                {"ast_number": number, "designation": designation, "ra": row_ra, "dec": row_dec, "v_mag": v_mag}
+                for number, designation, row_ra, row_dec, v_mag in columns
+            ],
+        }
+
+def get_footprint(exposure: dict) -> tuple[np.ndarray, np.ndarray]:
+    """ Get the corners of an exposure's footprint.
+    :param exposure: the exposure, with either vertices or a wcs header
+    :return: the right ascension and declination of each corner in degrees
+    """
+    if 'vertices' in exposure:
+        vertices = np.asarray(exposure['vertices'], dtype=np.float64)
+    elif 'wcs' in exposure:
+        # Imported here since most exposures give their vertices, and the WCS modules are slow to import
+        from astropy.io import fits
+        from astropy.wcs import WCS
+
+        header = fits.Header(exposure['wcs'])
+        vertices = WCS(header).calc_footprint(header=header)
+    else:
+        raise ValueError(f"Exposure {exposure.get('id')} has no footprint. Provide vertices or a wcs header.")
+
+    return vertices[:, 0], vertices[:, 1]
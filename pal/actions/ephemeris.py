@@ -1,11 +1,17 @@
 from astropy.time import Time
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 import json
 import os
 
+from pal.astorb.mirror import Mirror
 from pal.astorb.pipeline import pipeline
+from pal.astorb.product import EphemerisProduct
 from pal.astorb.propogate import propogate
-from pal.utils.telescope import Telescope
+from pal.astorb.sites import query_sites
+from pal.utils.metrics import Metrics
+from pal.utils.profiling import Profiler
+from pal.utils.telescope import get_telescope
 
 """
     This script is used to query the Lowell Observatory Astorb database to determine
@@ -18,10 +24,24 @@ def execute(**kwargs):
     """ Execute the ephemeris action with the given parameters.
     :param kwargs: Accepted parameters for the action:
             - telescope: The name of the telescope to use. Check the configuration file for available telescopes.
+            - telescopes: The names of several telescopes to run as one batch, querying the sky they share only once (see pal.astorb.sites). Each telescope gets its own ephemera and log file. Cannot be combined with reuse, tolerance or turning plan off. Default is the single telescope.
             - start_date: The start date for the observation period.
             - end_date: The end date for the observation period.
             - mag_lim: Whether to apply a magnitude limit to the query. Default is False. If set to True, the tool will only return asteroids with a magnitude less than or equal to the limit, which is set by the telescope.
             - propogation_interval: The interval at which to propogate the asteroid locations throughout the night. Default is 15 minutes.
+            - workers: The number of nights to query the database for concurrently. Default is 1.
+            - batch: The number of nights packed into each database request as GraphQL aliases, each paging on its own. Saves round trips when nights are small. Not used with reuse. Default is 1.
+            - reuse: The largest number of consecutive nights one database query is reused for, predicting the nights in between locally. Default is 1 (no reuse).
+            - tolerance: The largest predicted position error in arcseconds before a reused query is refreshed. Default is no limit.
+            - source: Where to find the observable asteroids. Either 'remote' to query AstorbDB, or 'local' to select them from the local mirror of the orbital elements (see pal.astorb.mirror), which works offline and propogates each asteroid along its orbit as seen from the telescope. Default is 'remote'.
+            - plan: Whether to query only the tiles of sky the telescope can observe each night, found from its declination and pointing limits (see pal.astorb.planner), instead of one box around the night. Default is True.
+            - processes: The number of processes to propogate the nights in, each night split into blocks of time steps and tiles of asteroids. Default is 1.
+            - compression: The compression of the ephemeris products written for each night (see pal.astorb.product). Either 'none', 'gzip' or 'zstd', which needs the zstandard package. Default is 'none'.
+            - session: An HTTP session to post the queries with, kept open between runs by the daemon. Default is a new session.
+            - prometheus: Whether to also write the run's metrics in the Prometheus text format. Default is False.
+              The metrics are always written as JSON lines next to the log file (see pal.utils.metrics).
+            - profile: Whether to profile each stage of the run, writing cProfile dumps and collapsed stacks to pal/results/logs. Default is False.
+            - profile_memory: Whether to also track allocations, reporting the peak memory of each stage. Default is False.
     :return: 0 if successful, 1 if an error occurred.
     """
     if os.path.exists("pal/results") == False:
@@ -33,10 +53,97 @@ def execute(**kwargs):
     if os.path.exists("pal/results/observable") == False:
         os.makedirs("pal/results/observable")
 
-    results = query_asteroids(**kwargs)
-    ephemera = propogate_asteroids(results, **kwargs)
-    
-    return log_results(ephemera, **kwargs)
+    sites = kwargs.pop('telescopes', None)
+    if sites:
+        check_sites(**kwargs)
+    run_name = '+'.join(sites) if sites else kwargs['telescope']
+
+    metrics = Metrics(run_name)
+
+    profiler = None
+    if kwargs.get('profile', False) or kwargs.get('profile_memory', False):
+        profiler = Profiler(run_name, allocations=kwargs.get('profile_memory', False))
+
+    def stage(name):
+        if profiler is None:
+            return metrics.stage(name)
+        stack = ExitStack()
+        stack.enter_context(metrics.stage(name))
+        stack.enter_context(profiler.stage(name))
+        return stack
+
+    if profiler is not None:
+        # Compute the night geometry up front, so its astropy time is profiled apart from the stages that use it
+        with stage("telescope_geometry"):
+            for name in sites or [kwargs['telescope']]:
+                telescope_geometry(**{**kwargs, 'telescope': name})
+
+    if sites:
+        status = execute_sites(sites, stage, metrics, **kwargs)
+    else:
+        with stage("query_asteroids"):
+            results = query_asteroids(metrics=metrics, **kwargs)
+        with stage("propogate_asteroids"):
+            ephemera = propogate_asteroids(results, metrics=metrics, **kwargs)
+
+        metrics_files = metrics.write(prometheus=kwargs.get('prometheus', False))
+
+        with stage("log_results"):
+            status = log_results(ephemera, metrics_files=metrics_files, **kwargs)
+
+    if profiler is not None:
+        summary = profiler.write_summary()
+        with open(summary, 'r') as f:
+            print(f.read(), end='')
+        print(f'Profiles available at {os.path.join(os.path.dirname(summary), profiler.prefix)}_*')
+
+    return status
+
+def check_sites(**kwargs):
+    """ Check that the options of a run for several telescopes can be honoured.
+    The telescopes share planned queries (see pal.astorb.sites), which cannot be reused across nights or replaced by a box.
+    :param kwargs: the parameters used for the action
+    :raises ValueError: if an option is not supported for several telescopes
+    """
+    if kwargs.get('reuse', 1) > 1 or kwargs.get('tolerance') is not None:
+        raise ValueError("Reusing queries across nights (reuse, tolerance) is not supported for several telescopes. Run each telescope on its own instead.")
+    if not kwargs.get('plan', True):
+        raise ValueError("Several telescopes always share planned queries, so plan cannot be turned off. Run each telescope on its own instead.")
+
+def execute_sites(sites: list[str], stage, metrics: Metrics, **kwargs) -> int:
+    """ Execute the ephemeris action for several telescopes, sharing the queries of the sky they have in common.
+    :param sites: the names of the telescopes
+    :param stage: the function that measures (and profiles) a stage of the run
+    :param metrics: the measurements of the run
+    :param kwargs: the parameters used for the action
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    telescopes = [get_telescope(name) for name in sites]
+
+    with stage("query_asteroids"):
+        dates = create_dates(kwargs['start_date'], kwargs['end_date'])
+        results = query_sites(dates, telescopes, kwargs['mag_lim'], workers=kwargs.get('workers', 1), session=kwargs.get('session'), metrics=metrics, source=kwargs.get('source', 'remote'), batch=kwargs.get('batch', 1))
+
+    ephemera = {}
+    for telescope in telescopes:
+        with stage(f"propogate_asteroids_{telescope.slug}"):
+            ephemera[telescope.name] = propogate_asteroids(results[telescope.name], metrics=metrics, **{**kwargs, 'telescope': telescope.name})
+
+    metrics_files = metrics.write(prometheus=kwargs.get('prometheus', False))
+
+    status = 0
+    with stage("log_results"):
+        for telescope in telescopes:
+            status |= log_results(ephemera[telescope.name], metrics_files=metrics_files, **{**kwargs, 'telescope': telescope.name})
+    return status
+
+def telescope_geometry(**kwargs):
+    """ Compute the night geometry of every date with the telescope, filling its geometry cache.
+    :param kwargs: the parameters used for the action
+    """
+    dates = create_dates(kwargs['start_date'], kwargs['end_date'])
+    telescope = get_telescope(kwargs['telescope'])
+    telescope.get_nights(dates)
 
 def query_asteroids(**kwargs) -> list[str]:
     """ Query the Lowell Observatory Astorb database for asteroids visible in the sky at the time of observation.
@@ -44,19 +151,26 @@ def query_asteroids(**kwargs) -> list[str]:
     :return: a list of file paths to the results
     """
     dates = create_dates(kwargs['start_date'], kwargs['end_date'])
-    telescope = Telescope(kwargs['telescope'])
+    telescope = get_telescope(kwargs['telescope'])
 
-    results = pipeline(dates, telescope, kwargs['mag_lim'])
+    results = pipeline(dates, telescope, kwargs['mag_lim'], workers=kwargs.get('workers', 1), reuse=kwargs.get('reuse', 1), tolerance=kwargs.get('tolerance'), session=kwargs.get('session'), metrics=kwargs.get('metrics'), source=kwargs.get('source', 'remote'), plan=kwargs.get('plan', True), batch=kwargs.get('batch', 1))
     return results
 
 
-def propogate_asteroids(results, **kwargs):
-    """ Propogate the asteroid locations for every 15 minutes throughout the night.
-    :param asteroids: the list of asteroids to propogate
+def propogate_asteroids(results, **kwargs) -> list[str]:
+    """ Propogate the asteroid locations throughout each night at the propogation interval.
+    :param results: the list of observable asteroid files to propogate
     :param kwargs: the parameters used for the action
+    :return: a list of file paths to the ephemera
     """
-    results = propogate(results)
-    return results
+    telescope = get_telescope(kwargs['telescope'])
+    interval = kwargs.get('propogation_interval', 15)
+
+    # Nights selected from the local mirror are propogated along their orbits
+    mirror = Mirror() if kwargs.get('source', 'remote') == 'local' else None
+
+    ephemera = propogate(results, telescope, interval, metrics=kwargs.get('metrics'), mirror=mirror, processes=kwargs.get('processes', 1), compression=kwargs.get('compression', 'none'))
+    return ephemera
 
 
 def create_dates(start_date: datetime, end_date: datetime) -> list[datetime]:
@@ -112,8 +226,15 @@ def log_results(ephemera, **kwargs):
         f.write(f"Ephemera successfully generated for {telescope} between the dates of {start_str} and {end_str}. \n")
         f.write("Ephemera data available at the following file paths: \n \n")
         for file in ephemera:
-            f.write(file)
+            # Only the index of each product is read
+            with EphemerisProduct(file) as product:
+                f.write(f"{file} ({len(product)} asteroids, {len(product.offsets)} time steps, {product.index['compression']} compression)")
             f.write('\n')
+        if kwargs.get('metrics_files'):
+            f.write("\nMetrics of the run available at the following file paths: \n \n")
+            for file in kwargs['metrics_files']:
+                f.write(file)
+                f.write('\n')
     print('Ephemra data successfully logged.')
     print(f'Log file available at {file_name}')
     return 0
\ No newline at end of file
@@ -0,0 +1,79 @@
+from datetime import datetime
+import math
+import os
+
+from pal.astorb.storage import observable_file
+from pal.utils import config
+from pal.utils.asteroid import AsteroidTable
+
+"""
+    This script looks up a single asteroid in a night's observable asteroids and reports its position.
+    The night is memory-mapped rather than loaded, and the position is propogated with the same rates
+    as the ephemera, so a lookup returns without importing astropy or querying the database.
+"""
+
+def execute(**kwargs):
+    """ Execute the lookup action with the given parameters.
+    :param kwargs: Accepted parameters for the action:
+            - telescope: The name of the telescope to use. Check the configuration file for available telescopes.
+            - date: The date of the night in the format YYYY-MM-DD.
+            - asteroid: The asteroid number, or its primary designation.
+            - time: The UTC time to report the position at, in the format HH:MM or HH:MM:SS. Default is UTC midnight.
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    slug = config.get(config.read('pal/config/telescope.ini'), kwargs['telescope'], 'slug')
+    if slug is None:
+        raise ValueError(f"Unknown telescope: {kwargs['telescope']}")
+
+    date = datetime.strptime(kwargs['date'], '%Y-%m-%d')
+    file_name = observable_file(date, slug)
+    if not os.path.exists(file_name):
+        print(f"No observable asteroids for {kwargs['telescope']} on {kwargs['date']}. Run the ephemeris action for this night first.")
+        return 1
+
+    asteroids = AsteroidTable.load(file_name)
+    row = find_asteroid(asteroids, kwargs['asteroid'])
+    if row is None:
+        print(f"Asteroid {kwargs['asteroid']} is not observable by {kwargs['telescope']} on {kwargs['date']}.")
+        return 1
+
+    offset = get_offset(kwargs.get('time'))
+    asteroid = asteroids[row]
+    ra, dec = asteroid.propogate(offset)
+
+    print(f"{asteroid.mpc} ({asteroid.name}) at {kwargs['date']} {kwargs.get('time') or '00:00'} UTC:")
+    print(f"    RA:  {math.degrees(ra):.6f} deg")
+    print(f"    Dec: {math.degrees(dec):.6f} deg")
+    print(f"    V:   {asteroid.app_mag:.2f}")
+    print(f"    Rates: {asteroid.ra_rate:.3f}, {asteroid.dec_rate:.3f} arcsec/hr")
+    return 0
+
+def find_asteroid(asteroids: AsteroidTable, asteroid: str | int) -> int | None:
+    """ Find an asteroid in a night's table by number or designation.
+    :param asteroids: the night's observable asteroids, ordered by asteroid number
+    :param asteroid: the asteroid number, or its primary designation
+    :return: the row of the asteroid, or None if it is not in the table
+    """
+    asteroid = str(asteroid).strip()
+    if asteroid.isdigit():
+        # The pipeline pages through the database in asteroid number order, so the numbers are sorted
+        number = int(asteroid)
+        row = int(asteroids.ast_number.searchsorted(number))
+        if row < len(asteroids) and asteroids.ast_number[row] == number:
+            return row
+        rows = (asteroids.ast_number == number).nonzero()[0]
+        if len(rows):
+            return int(rows[0])
+
+    rows = (asteroids.designation == asteroid).nonzero()[0]
+    return int(rows[0]) if len(rows) else None
+
+def get_offset(time: str = None) -> float:
+    """ Convert a UTC time of day to minutes after UTC midnight.
+    :param time: the time in the format HH:MM or HH:MM:SS
+    :return: the minutes after UTC midnight
+    """
+    if not time:
+        return 0.0
+    parsed = datetime.strptime(time, '%H:%M:%S' if time.count(':') == 2 else '%H:%M')
+    return parsed.hour * 60 + parsed.minute + parsed.second / 60
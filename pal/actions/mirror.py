@@ -0,0 +1,41 @@
+import time
+
+from pal.astorb.mirror import Mirror, build_mirror, update_mirror
+
+"""
+    This script builds and updates the local mirror of the Astorb orbital elements (see pal.astorb.mirror),
+    which the ephemeris action selects the observable asteroids from when run with source='local'.
+    The mirror is built once from a bulk export, and kept current with later exports while a connection is available.
+"""
+
+def execute(**kwargs):
+    """ Execute the mirror action with the given parameters.
+    :param kwargs: Accepted parameters for the action:
+            - command: Either 'build' to build the mirror from a bulk export, 'update' to merge a later export into it, or 'info' to describe it.
+            - file: The export file to build or update the mirror from: astorb.dat, astorb.dat.gz or a CSV file.
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    command = kwargs['command']
+    file_name = kwargs.get('file')
+    if command in ('build', 'update') and file_name is None:
+        print(f"An export file is needed to {command} the mirror.")
+        return 1
+
+    start_time = time.time()
+    if command == 'build':
+        rows = build_mirror(file_name)
+        print(f"Mirror built from {file_name}: {rows} orbits. Time elapsed: {time.time() - start_time:.2f} seconds.")
+    elif command == 'update':
+        updated, added = update_mirror(file_name)
+        print(f"Mirror updated from {file_name}: {updated} orbits updated, {added} added. Time elapsed: {time.time() - start_time:.2f} seconds.")
+
+    try:
+        mirror = Mirror()
+    except FileNotFoundError as e:
+        print(e)
+        return 1
+
+    manifest = mirror.manifest
+    print(f"Local mirror: {len(mirror)} orbits, built {manifest.get('built')}, last updated {manifest.get('updated', 'never')}.")
+    print(f"Sources: {', '.join(manifest.get('sources', []))}")
+    return 0
@@ -0,0 +1,89 @@
+import glob
+import json
+import os
+
+from pal.utils import config
+
+"""
+    This script lists the nights that already have results on disk: the observable asteroids written by
+    the pipeline, the ephemera written by the propogation, and the queries held in the query cache.
+    It only reads file names and the cache manifest, so it returns without importing astropy or numpy.
+    With prefill, it instead computes the night geometry of every date in a year ahead of the runs that need it.
+"""
+
+def execute(**kwargs):
+    """ Execute the nights action with the given parameters.
+    :param kwargs: Accepted parameters for the action:
+            - telescope: The name of the telescope to list the nights of. Default is every telescope.
+            - prefill: A year to compute and cache the night geometry of, for the telescope or every configured telescope (see pal.utils.geometry), instead of listing the nights. Default is None.
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    if kwargs.get('prefill') is not None:
+        return prefill_nights(kwargs['prefill'], kwargs.get('telescope'))
+
+    nights = list_nights(kwargs.get('telescope'))
+    if not nights:
+        print("No nights on disk.")
+        return 0
+
+    print(f"{'telescope':<10} {'date':<10}  {'observable':>10}  {'ephemera':>8}  {'cached queries':>14}")
+    for (slug, date), night in sorted(nights.items()):
+        print(f"{slug:<10} {date:<10}  {'yes' if night['observable'] else '-':>10}  {'yes' if night['ephemera'] else '-':>8}  {night['cached_queries']:>14}")
+
+    return 0
+
+def prefill_nights(year: int, telescope: str = None) -> int:
+    """ Compute and cache the night geometry of every date in a year, so later runs skip astropy for it.
+    :param year: the year to fill
+    :param telescope: the name of the telescope to fill. Default is every telescope with a slug in the configuration file.
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    # astropy is only imported when the geometry is actually computed
+    from pal.utils.geometry import prefill
+    from pal.utils.telescope import get_telescope
+
+    settings = config.read('pal/config/telescope.ini')
+    if telescope is not None:
+        if config.get(settings, telescope, 'slug') is None:
+            raise ValueError(f"Unknown telescope: {telescope}")
+        names = [telescope]
+    else:
+        names = [name for name in settings.sections() if config.get(settings, name, 'slug') is not None]
+
+    for name in names:
+        count = prefill(get_telescope(name), year)
+        print(f"Night geometry of {count} nights cached for {name} in {year}.")
+    return 0
+
+def list_nights(telescope: str = None) -> dict[tuple[str, str], dict]:
+    """ List the nights with results on disk.
+    :param telescope: the name of the telescope to list the nights of. Default is every telescope.
+    :return: the results of each (telescope slug, date) pair
+    """
+    slug = None
+    if telescope is not None:
+        slug = config.get(config.read('pal/config/telescope.ini'), telescope, 'slug')
+        if slug is None:
+            raise ValueError(f"Unknown telescope: {telescope}")
+
+    nights = {}
+    for kind, pattern in (('observable', "pal/results/observable/*_*.*"), ('ephemera', "pal/results/ephemera/*_*.eph"), ('ephemera', "pal/results/ephemera/*_*.npz")):
+        for file_name in glob.glob(pattern):
+            file_slug, _, date = os.path.splitext(os.path.basename(file_name))[0].rpartition('_')
+            if slug is not None and file_slug != slug:
+                continue
+            night = nights.setdefault((file_slug, date), {"observable": False, "ephemera": False, "cached_queries": 0})
+            night[kind] = True
+
+    # The query cache is keyed by the query parameters, which do not include the telescope
+    manifest_file = "pal/results/cache/queries/manifest.json"
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            entries = json.load(f).get('entries', {})
+        queries = {}
+        for entry in entries.values():
+            queries[entry['params']['date']] = queries.get(entry['params']['date'], 0) + 1
+        for (_, date), night in nights.items():
+            night['cached_queries'] = queries.get(date, 0)
+
+    return nights
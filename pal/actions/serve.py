@@ -0,0 +1,27 @@
+import os
+
+from pal.utils.daemon import SOCKET_PATH, Daemon
+
+"""
+    This script starts the PAL daemon, which keeps telescopes, night geometry, the database session
+    and loaded ephemera in memory and serves requests from the thin client in pal.client.
+"""
+
+def execute(**kwargs):
+    """ Execute the serve action with the given parameters.
+    :param kwargs: Accepted parameters for the action:
+            - telescopes: The names of the telescopes to warm up before serving. Default is ['Pathfinder'].
+            - socket: The Unix socket to listen on. Default is pal/results/pal.sock.
+            - port: The local HTTP port to listen on instead of the Unix socket. Default is None.
+            - workers: The number of connections kept open to the database. Default is 4.
+            - cached_nights: The number of nights of ephemera kept loaded and indexed. Default is 8.
+    :return: 0 if successful, 1 if an error occurred.
+    """
+    if os.path.exists("pal/results") == False:
+        os.makedirs("pal/results")
+
+    daemon = Daemon(kwargs.get('telescopes'), kwargs.get('workers', 4), kwargs.get('cached_nights', 8))
+    daemon.serve(kwargs.get('socket', SOCKET_PATH), kwargs.get('port'))
+
+    print('PAL daemon stopped.')
+    return 0
@@ -0,0 +1,145 @@
+from datetime import datetime
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+from pal.astorb.storage import flatten
+
+"""
+    Contains the QueryCache class, a content-addressed cache of AstorbDB query results.
+    Each entry is keyed by a hash of the full set of query parameters (date, sky range, limiting
+    magnitude and query fields), so a night queried with different parameters is never reused by mistake.
+    A manifest records the parameters of every entry along with hit and miss statistics. The statistics are
+    counted in memory and written with the manifest when an entry is stored, or when the run saves the cache.
+    Has the function:
+        query_params(): Builds the canonical parameter set a query is cached under.
+"""
+
+CACHE_DIR = "pal/results/cache/queries"
+
+def query_params(date: datetime, sky_range: tuple[float, float, float, float], mag_lim: float, fields: str, mag_min: float = None, tiles: list[tuple[float, float, float, float]] = None) -> dict:
+    """ Build the canonical set of parameters a query is cached under.
+    :param date: the date of the query
+    :param sky_range: the sky range of the query (ra_min, ra_max, dec_min, dec_max) in radians
+    :param mag_lim: the limiting magnitude of the query
+    :param fields: the fields selected by the query
+    :param mag_min: the bright magnitude limit of the query, if it selects a magnitude shell
+    :param tiles: the tiles queried in place of the sky range, if the night was planned (see pal.astorb.planner)
+    :return: the query parameters
+    """
+    ra_min, ra_max, dec_min, dec_max = sky_range
+    params = {
+        "date": date.strftime("%Y-%m-%d"),
+        # Rounded so that recomputing the sky range does not change the key
+        "ra_min": round(float(ra_min), 6),
+        "ra_max": round(float(ra_max), 6),
+        "dec_min": round(float(dec_min), 6),
+        "dec_max": round(float(dec_max), 6),
+        "mag_lim": float(mag_lim),
+        "fields": " ".join(fields.split()),
+    }
+    if mag_min is not None:
+        params["mag_min"] = float(mag_min)
+    if tiles is not None:
+        params["tiles"] = [[round(float(bound), 6) for bound in tile] for tile in tiles]
+    return params
+
+def query_key(params: dict) -> str:
+    """ Hash a set of query parameters.
+    :param params: the parameters returned by query_params
+    :return: the cache key
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+class QueryCache():
+    cache_dir = None
+    manifest = None
+
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        """ Load the cache manifest.
+        :param cache_dir: the directory the cache is stored in
+        """
+        self.cache_dir = cache_dir
+        self.manifest = {"entries": {}, "stats": {"hits": 0, "filtered_hits": 0, "misses": 0}}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        manifest_name = os.path.join(self.cache_dir, "manifest.json")
+        if os.path.exists(manifest_name):
+            with open(manifest_name, 'r') as f:
+                self.manifest = json.load(f)
+
+    def lookup(self, params: dict) -> np.ndarray:
+        """ Find the cached results of a query.
+        An entry with the same parameters but a deeper limiting magnitude also answers the query,
+        by filtering its rows on v_mag.
+        :param params: the parameters returned by query_params
+        :return: the results of the query as a structured array, or None if it is not cached
+        """
+        key = query_key(params)
+        with self._lock:
+            hit = key in self.manifest['entries']
+            if hit:
+                self._count('hits')
+            else:
+                # Use the shallowest cached entry that is at least as deep as the query
+                deeper = [
+                    (entry['params']['mag_lim'], entry_key) for entry_key, entry in self.manifest['entries'].items()
+                    if entry['params']['mag_lim'] > params['mag_lim']
+                    and {k: v for k, v in entry['params'].items() if k != 'mag_lim'} == {k: v for k, v in params.items() if k != 'mag_lim'}
+                ]
+                self._count('filtered_hits' if deeper else 'misses')
+
+        if hit:
+            return self._read(key)
+        if not deeper:
+            return None
+
+        _, entry_key = min(deeper)
+        data = self._read(entry_key)
+        return data[data['v_mag'] <= params['mag_lim']]
+
+    def store(self, params: dict, data: np.ndarray):
+        """ Store the results of a query.
+        :param params: the parameters returned by query_params
+        :param data: the results of the query as a structured array
+        """
+        key = query_key(params)
+        np.save(os.path.join(self.cache_dir, f"{key}.npy"), data)
+
+        with self._lock:
+            self.manifest['entries'][key] = {"params": params, "rows": len(data), "created": datetime.now().isoformat(timespec='seconds')}
+            self._save()
+
+    def stats(self) -> dict:
+        """ Get the hit and miss statistics of the cache.
+        :return: the number of hits, filtered hits and misses
+        """
+        with self._lock:
+            return dict(self.manifest['stats'])
+
+    def _read(self, key: str) -> np.ndarray:
+        file_name = os.path.join(self.cache_dir, f"{key}.npy")
+        if not os.path.exists(file_name):
+            # Entries cached before the columnar format was introduced
+            with open(os.path.join(self.cache_dir, f"{key}.json"), 'r') as f:
+                return flatten(json.load(f))
+        return np.load(file_name)
+
+    def save(self):
+        """ Write the manifest, with the statistics counted since it was last written. """
+        with self._lock:
+            self._save()
+
+    def _count(self, stat: str):
+        # Counted in memory only, so a lookup does not rewrite the manifest
+        self.manifest['stats'][stat] += 1
+
+    def _save(self):
+        # Write to a temporary file first so an interrupted run cannot corrupt the manifest
+        manifest_name = os.path.join(self.cache_dir, "manifest.json")
+        with open(f"{manifest_name}.tmp", 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(f"{manifest_name}.tmp", manifest_name)
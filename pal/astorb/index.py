@@ -0,0 +1,308 @@
+from collections import OrderedDict
+import numpy as np
+import os
+import threading
+
+from pal.astorb.product import load_ephemera
+
+"""
+    Contains the SkyIndex class, a spatial index over the propogated positions of a night's asteroids.
+    The sky is split into declination bands of roughly square RA/Dec tiles, and for every time step the
+    asteroids are sorted by tile. The tiles of a band are contiguous in the sorted order, so a cone or
+    polygon query only has to read one or two slices per band, including across RA = 0/360.
+    All angles are in radians, as in the ephemera written by pal.astorb.propogate.
+    Also contains the IndexCache class, which keeps the most recently used nights loaded and indexed.
+"""
+
+class SkyIndex():
+    tile_size = None
+    offsets = None
+    ra = None
+    dec = None
+
+    def __init__(self, ra: np.ndarray, dec: np.ndarray, offsets: np.ndarray, tile_size: float = np.radians(1)):
+        """ Build the index over the propogated positions.
+        :param ra: the right ascension of each asteroid at each time step, shape (n_asteroids, n_steps)
+        :param dec: the declination of each asteroid at each time step, shape (n_asteroids, n_steps)
+        :param offsets: the time steps in minutes after the ephemeris epoch
+        :param tile_size: the height of each declination band, and the approximate width of each tile
+        """
+        self.ra = np.asarray(ra)
+        self.dec = np.asarray(dec)
+        self.offsets = np.asarray(offsets)
+        self.tile_size = tile_size
+        self._max_motion = None
+
+        # Number of tiles in each declination band, shrinking toward the poles to keep tiles roughly square
+        self.n_bands = int(np.ceil(np.pi / tile_size))
+        band_edges = -np.pi / 2 + np.arange(self.n_bands + 1) * tile_size
+        widest = np.cos(np.clip(np.minimum(np.abs(band_edges[:-1]), np.abs(band_edges[1:])), 0, np.pi / 2))
+        widest[(band_edges[:-1] < 0) & (band_edges[1:] > 0)] = 1
+        self.band_tiles = np.maximum(1, np.floor(2 * np.pi * widest / tile_size)).astype(np.int64)
+        self.band_start = np.concatenate([[0], np.cumsum(self.band_tiles)])
+        self.n_tiles = int(self.band_start[-1])
+
+        # Sort the asteroids by tile at every step, and record where each tile starts in the sorted order
+        n_asteroids, n_steps = self.ra.shape
+        tiles = self._tiles(self.ra, self.dec).T
+        self.order = np.argsort(tiles, axis=1, kind='stable').astype(np.int32)
+        sorted_tiles = np.take_along_axis(tiles, self.order, axis=1)
+        step_base = np.arange(n_steps)[:, None] * self.n_tiles
+        keys = (sorted_tiles + step_base).ravel()
+        bounds = step_base + np.arange(self.n_tiles + 1)[None, :]
+        self.tile_start = np.searchsorted(keys, bounds.ravel()).reshape(bounds.shape) - np.arange(n_steps)[:, None] * n_asteroids
+
+    def step_at(self, offset: float) -> int:
+        """ Get the time step closest to a time.
+        :param offset: the time in minutes after the ephemeris epoch
+        :return: the index of the closest time step
+        """
+        return int(np.argmin(np.abs(self.offsets - offset)))
+
+    def cone(self, ra: float, dec: float, radius: float, step: int) -> np.ndarray:
+        """ Find the asteroids within a cone at a time step.
+        :param ra: the right ascension of the center of the cone
+        :param dec: the declination of the center of the cone
+        :param radius: the radius of the cone
+        :param step: the index of the time step
+        :return: the indices of the asteroids inside the cone
+        """
+        candidates = self._candidates(ra, dec, radius, step)
+        distance = angular_distance(ra, dec, self.ra[candidates, step], self.dec[candidates, step])
+        return np.sort(candidates[distance <= radius])
+
+    def polygon(self, vertices_ra: np.ndarray, vertices_dec: np.ndarray, step: int) -> np.ndarray:
+        """ Find the asteroids inside a spherical polygon at a time step, such as a camera footprint.
+        The polygon must be smaller than a hemisphere and its edges are treated as great circles.
+        :param vertices_ra: the right ascension of each vertex, in order around the polygon
+        :param vertices_dec: the declination of each vertex, in order around the polygon
+        :param step: the index of the time step
+        :return: the indices of the asteroids inside the polygon
+        """
+        vertices_ra = np.asarray(vertices_ra, dtype=np.float64)
+        vertices_dec = np.asarray(vertices_dec, dtype=np.float64)
+
+        center_ra, center_dec, radius = bounding_cone(vertices_ra, vertices_dec)
+
+        candidates = self._candidates(center_ra, center_dec, radius, step)
+        candidates = candidates[angular_distance(center_ra, center_dec, self.ra[candidates, step], self.dec[candidates, step]) <= radius]
+
+        # Great circles project to straight lines in the gnomonic projection, so a planar test is exact
+        x, y = gnomonic(center_ra, center_dec, self.ra[candidates, step], self.dec[candidates, step])
+        vx, vy = gnomonic(center_ra, center_dec, vertices_ra, vertices_dec)
+        inside = point_in_polygon(x, y, vx, vy)
+
+        return np.sort(candidates[inside])
+
+    def interpolate(self, rows: np.ndarray, offset: float) -> tuple[np.ndarray, np.ndarray]:
+        """ Interpolate the positions of some asteroids to a time between the time steps.
+        Times outside the night are extrapolated from the nearest pair of steps.
+        :param rows: the indices of the asteroids
+        :param offset: the time in minutes after the ephemeris epoch
+        :return: the right ascension and declination of each asteroid at that time
+        """
+        if len(self.offsets) == 1:
+            return self.ra[rows, 0], self.dec[rows, 0]
+
+        step = int(np.clip(np.searchsorted(self.offsets, offset) - 1, 0, len(self.offsets) - 2))
+        fraction = (offset - self.offsets[step]) / (self.offsets[step + 1] - self.offsets[step])
+
+        # Interpolate the RA along the shortest way around the sky, so that it wraps past 0/360
+        ra0, ra1 = self.ra[rows, step], self.ra[rows, step + 1]
+        delta_ra = np.mod(ra1 - ra0 + np.pi, 2 * np.pi) - np.pi
+        ra = np.mod(ra0 + fraction * delta_ra, 2 * np.pi)
+        dec = self.dec[rows, step] + fraction * (self.dec[rows, step + 1] - self.dec[rows, step])
+
+        return ra, dec
+
+    def polygon_at(self, vertices_ra: np.ndarray, vertices_dec: np.ndarray, offset: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Find the asteroids inside a spherical polygon at any time during the night.
+        Candidates are taken from the closest time step, widened by the largest distance any asteroid
+        moves in one step, and then tested at their interpolated positions.
+        :param vertices_ra: the right ascension of each vertex, in order around the polygon
+        :param vertices_dec: the declination of each vertex, in order around the polygon
+        :param offset: the time in minutes after the ephemeris epoch
+        :return: the indices of the asteroids inside the polygon, and their interpolated right ascension and declination
+        """
+        vertices_ra = np.asarray(vertices_ra, dtype=np.float64)
+        vertices_dec = np.asarray(vertices_dec, dtype=np.float64)
+        center_ra, center_dec, radius = bounding_cone(vertices_ra, vertices_dec)
+
+        step = self.step_at(offset)
+        steps_away = max(1, int(np.ceil(abs(offset - self.offsets[step]) / self.step_length()))) if len(self.offsets) > 1 else 0
+        candidates = self._candidates(center_ra, center_dec, radius + steps_away * self.max_motion(), step)
+
+        ra, dec = self.interpolate(candidates, offset)
+        near = angular_distance(center_ra, center_dec, ra, dec) <= radius
+        candidates, ra, dec = candidates[near], ra[near], dec[near]
+
+        x, y = gnomonic(center_ra, center_dec, ra, dec)
+        vx, vy = gnomonic(center_ra, center_dec, vertices_ra, vertices_dec)
+        inside = point_in_polygon(x, y, vx, vy)
+
+        order = np.argsort(candidates[inside])
+        return candidates[inside][order], ra[inside][order], dec[inside][order]
+
+    def step_length(self) -> float:
+        """ Get the shortest time between two time steps.
+        :return: the time in minutes
+        """
+        return float(np.min(np.diff(self.offsets)))
+
+    def max_motion(self) -> float:
+        """ Get the largest distance any asteroid moves between two consecutive time steps.
+        :return: the distance in radians
+        """
+        if self._max_motion is None:
+            if self.ra.shape[0] == 0 or self.ra.shape[1] < 2:
+                self._max_motion = 0.0
+            else:
+                motion = angular_distance(self.ra[:, :-1], self.dec[:, :-1], self.ra[:, 1:], self.dec[:, 1:])
+                self._max_motion = float(np.max(motion))
+        return self._max_motion
+
+    def _tiles(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        band = np.clip(((dec + np.pi / 2) / self.tile_size).astype(np.int64), 0, self.n_bands - 1)
+        n_tiles = self.band_tiles[band]
+        column = np.minimum((np.mod(ra, 2 * np.pi) / (2 * np.pi) * n_tiles).astype(np.int64), n_tiles - 1)
+        return self.band_start[band] + column
+
+    def _candidates(self, ra: float, dec: float, radius: float, step: int) -> np.ndarray:
+        # Gather the asteroids in every tile the cone can touch, one or two slices per declination band
+        ra = ra % (2 * np.pi)
+        first_band = max(0, int((dec - radius + np.pi / 2) / self.tile_size))
+        last_band = min(self.n_bands - 1, int((dec + radius + np.pi / 2) / self.tile_size))
+        tile_start = self.tile_start[step]
+        order = self.order[step]
+
+        # Largest RA offset of any point in the cone, or the whole band if the cone reaches a pole
+        if abs(dec) + radius >= np.pi / 2:
+            half_width = np.pi
+        else:
+            half_width = np.arcsin(np.sin(radius) / np.cos(dec))
+
+        slices = []
+        for band in range(first_band, last_band + 1):
+            n_tiles = self.band_tiles[band]
+            low = int(np.floor((ra - half_width) / (2 * np.pi) * n_tiles))
+            high = int(np.floor((ra + half_width) / (2 * np.pi) * n_tiles))
+
+            # Split the span of tiles where it wraps past RA = 0/360
+            if high - low + 1 >= n_tiles:
+                spans = [(0, n_tiles - 1)]
+            elif low < 0:
+                spans = [(low + n_tiles, n_tiles - 1), (0, high)]
+            elif high >= n_tiles:
+                spans = [(low, n_tiles - 1), (0, high - n_tiles)]
+            else:
+                spans = [(low, high)]
+
+            for low, high in spans:
+                start = tile_start[self.band_start[band] + low]
+                end = tile_start[self.band_start[band] + high + 1]
+                if end > start:
+                    slices.append(order[start:end])
+
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(slices).astype(np.int64)
+
+def load_index(file_name: str, tile_size: float = np.radians(1)) -> tuple[SkyIndex, dict[str, np.ndarray]]:
+    """ Build the index for a night of ephemera written by pal.astorb.propogate.
+    :param file_name: the ephemera file
+    :param tile_size: the size of the index tiles
+    :return: the index, and the ephemera it was built from
+    """
+    ephemera = load_ephemera(file_name)
+    return SkyIndex(ephemera['ra'], ephemera['dec'], ephemera['offsets'], tile_size), ephemera
+
+class IndexCache():
+    maxsize = None
+    entries = None
+
+    def __init__(self, maxsize: int = 1):
+        """ Initializes an empty cache.
+        :param maxsize: the number of nights to keep loaded
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_name: str) -> tuple[SkyIndex, dict[str, np.ndarray]]:
+        """ Get the index of a night of ephemera, loading it if it is not cached or its file has changed since.
+        :param file_name: the ephemera file
+        :return: the index, and the ephemera it was built from
+        """
+        mtime = os.path.getmtime(file_name)
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if entry is not None and entry[0] == mtime:
+                self.entries.move_to_end(file_name)
+                return entry[1], entry[2]
+
+        index, ephemera = load_index(file_name)
+        with self.lock:
+            self.entries[file_name] = (mtime, index, ephemera)
+            self.entries.move_to_end(file_name)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return index, ephemera
+
+def bounding_cone(vertices_ra: np.ndarray, vertices_dec: np.ndarray) -> tuple[float, float, float]:
+    """ Bound a polygon by a cone around the center of its vertices.
+    :param vertices_ra: the right ascension of each vertex
+    :param vertices_dec: the declination of each vertex
+    :return: the right ascension and declination of the center, and the radius of the cone
+    """
+    center = to_vector(vertices_ra, vertices_dec).sum(axis=0)
+    center /= np.linalg.norm(center)
+    center_ra = np.arctan2(center[1], center[0]) % (2 * np.pi)
+    center_dec = np.arcsin(np.clip(center[2], -1, 1))
+    radius = float(np.max(angular_distance(center_ra, center_dec, vertices_ra, vertices_dec)))
+    return center_ra, center_dec, radius
+
+def to_vector(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """ Convert spherical coordinates to unit vectors.
+    :param ra: the right ascension
+    :param dec: the declination
+    :return: the unit vectors, shape (n, 3)
+    """
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+def angular_distance(ra1, dec1, ra2, dec2) -> np.ndarray:
+    """ Get the angular distance between two sets of points, using the haversine formula.
+    :return: the angular distance in radians
+    """
+    sin_dec = np.sin((dec2 - dec1) / 2)
+    sin_ra = np.sin((ra2 - ra1) / 2)
+    a = sin_dec**2 + np.cos(dec1) * np.cos(dec2) * sin_ra**2
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def gnomonic(ra0: float, dec0: float, ra: np.ndarray, dec: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Project points onto the plane tangent to the sphere at (ra0, dec0).
+    :return: the projected x and y coordinates
+    """
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    x = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    y = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+    return x, y
+
+def point_in_polygon(x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray) -> np.ndarray:
+    """ Test which points are inside a planar polygon, by ray casting.
+    :param x: the x coordinates of the points
+    :param y: the y coordinates of the points
+    :param vx: the x coordinates of the vertices
+    :param vy: the y coordinates of the vertices
+    :return: a boolean array, True where the point is inside
+    """
+    inside = np.zeros(len(x), dtype=bool)
+    for i in range(len(vx)):
+        x1, y1 = vx[i - 1], vy[i - 1]
+        x2, y2 = vx[i], vy[i]
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intersect = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < intersect)
+    return inside
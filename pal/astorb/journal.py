@@ -0,0 +1,230 @@
+from datetime import datetime
+import json
+import numpy as np
+import os
+import requests
+import time
+from typing import Iterator
+
+from pal.astorb.cache import query_key
+from pal.astorb.query import Query
+from pal.astorb.storage import OBSERVABLE_DTYPE, flatten, write_rows
+from pal.utils.metrics import Metrics
+
+"""
+    Contains the Journal class, the on-disk output of a single night's query while it is being paged.
+    Each page is flattened into observable records and appended to the journal as it arrives, and the
+    last asteroid number of the page is saved as a checkpoint. Only one page is ever held in memory,
+    and an interrupted run resumes paging from the last completed page instead of starting the night over.
+    Has the functions:
+        fetch_region(): Pages through a query of one region of the sky into its journal.
+        fetch_regions(): Pages through several regions, on one or several nights, packing them into each request.
+        merge_journals(): Merges the journals of a night's regions in asteroid number order, dropping duplicates.
+"""
+
+JOURNAL_DIR = "pal/results/cache/journal"
+PAGE_SIZE = 1000
+# The most regions packed into one request by fetch_regions, which bounds the size of each response
+BATCH_SIZE = 16
+
+class Journal():
+    params = None
+    key = None
+    rows_file = None
+    checkpoint_file = None
+
+    def __init__(self, params: dict, journal_dir: str = JOURNAL_DIR):
+        """ Initializes the journal for a query.
+        :param params: the query parameters returned by query_params
+        :param journal_dir: the directory journals are stored in
+        """
+        self.params = params
+        self.key = query_key(params)
+        self.rows_file = os.path.join(journal_dir, f"{self.key}.rows")
+        self.checkpoint_file = os.path.join(journal_dir, f"{self.key}.json")
+        os.makedirs(journal_dir, exist_ok=True)
+
+    def resume(self) -> tuple[int, int, bool]:
+        """ Read the checkpoint left by a previous run.
+        :return: the number of rows received so far, the last asteroid number, and whether the night is complete
+        """
+        if not os.path.exists(self.checkpoint_file) or not os.path.exists(self.rows_file):
+            self.remove()
+            return 0, 0, False
+
+        with open(self.checkpoint_file, 'r') as f:
+            checkpoint = json.load(f)
+
+        # Drop any page written after the checkpoint, so new pages are appended cleanly
+        os.truncate(self.rows_file, checkpoint['rows'] * OBSERVABLE_DTYPE.itemsize)
+
+        return checkpoint['rows'], checkpoint['last_id'], checkpoint['complete']
+
+    def append(self, page: np.ndarray, last_id: int, complete: bool):
+        """ Append a page to the journal and move the checkpoint past it.
+        :param page: the page flattened into a structured array (see pal.astorb.storage.flatten)
+        :param last_id: the last asteroid number of the page, which the next page continues from
+        :param complete: whether this is the last page of the night
+        """
+        with open(self.rows_file, 'ab') as f:
+            f.write(np.ascontiguousarray(page, dtype=OBSERVABLE_DTYPE).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            rows = f.tell() // OBSERVABLE_DTYPE.itemsize
+
+        # Write the checkpoint only once the page is on disk
+        with open(f"{self.checkpoint_file}.tmp", 'w') as f:
+            json.dump({"rows": rows, "last_id": int(last_id), "complete": complete}, f)
+        os.replace(f"{self.checkpoint_file}.tmp", self.checkpoint_file)
+
+    def read(self) -> np.ndarray:
+        """ Read the journaled rows into memory.
+        :return: the rows as a structured array
+        """
+        if not os.path.exists(self.rows_file):
+            return np.empty(0, dtype=OBSERVABLE_DTYPE)
+        return np.fromfile(self.rows_file, dtype=OBSERVABLE_DTYPE)
+
+    def write(self, file_name: str) -> str:
+        """ Write the journaled rows to an observable file, copying them without loading them into memory.
+        :param file_name: the observable file to write
+        :return: the file name
+        """
+        return write_rows(self.rows_file, file_name)
+
+    def remove(self):
+        """ Remove the journal once the night's results have been written. """
+        for file_name in (self.rows_file, self.checkpoint_file):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+def fetch_region(date: datetime, sky_range: tuple[float, float, float, float], v_mag: float, params: dict, session: requests.Session = None, url: str = None, mag_min: float = None, metrics: Metrics = None) -> Journal:
+    """ Page through every asteroid in a region of the sky on a single night, into the region's journal.
+    :param date: the date to query the database for
+    :param sky_range: the region to query (ra_min, ra_max, dec_min, dec_max) in radians
+    :param v_mag: the limiting magnitude of the query
+    :param params: the query parameters the journal is kept under
+    :param session: the HTTP session to post the queries with
+    :param url: the GraphQL endpoint to query
+    :param mag_min: the bright magnitude limit of the query, if it selects a magnitude shell
+    :param metrics: the measurements of the run to record each page in, if any
+    :return: the completed journal
+    """
+    query = Query(url=url, session=session)
+    b_ra_min, b_ra_max, b_dec_min, b_dec_max = sky_range
+
+    # Continue from the last page completed by an interrupted run, if there was one
+    journal = Journal(params)
+    _, last_id, complete = journal.resume()
+
+    # Page through the results, requerying with the last asteroid id while full pages are returned.
+    # Each page is decoded once, flattened and appended to the journal, so only one page is held in memory.
+    while not complete:
+        start = time.perf_counter()
+        query.build_query(ra_min=b_ra_min, ra_max=b_ra_max, dec_min=b_dec_min, dec_max=b_dec_max, date=date, mag_lim=v_mag, last_id=last_id, mag_min=mag_min)
+        build_time = time.perf_counter() - start
+        query.get_results()
+
+        start = time.perf_counter()
+        page = flatten(query.data['data']['ephemeris'])
+        query.data = None
+        parse_time = time.perf_counter() - start
+
+        complete = len(page) < PAGE_SIZE
+        if not complete:
+            last_id = int(page['ast_number'][-1])
+
+        start = time.perf_counter()
+        journal.append(page, last_id, complete)
+        write_time = time.perf_counter() - start
+
+        if metrics is not None:
+            metrics.record(
+                "page", date=params['date'], query=journal.key, rows=len(page), bytes=query.bytes_received, retries=query.retries,
+                build_time=build_time, http_latency=query.latency, parse_time=query.decode_time + parse_time, write_time=write_time,
+            )
+
+    return journal
+
+def fetch_regions(regions: list[tuple[datetime, tuple[float, float, float, float], dict]], v_mag: float, session: requests.Session = None, url: str = None, mag_min: float = None, metrics: Metrics = None, batch_size: int = BATCH_SIZE) -> list[Journal]:
+    """ Page through several regions of the sky, on one or several nights, into their journals.
+    Up to batch_size regions are packed into each request as GraphQL aliases, so small nights share a round trip.
+    Each region keeps its own cursor, and a region whose last page has arrived gives its place to the next.
+    :param regions: the date, region (ra_min, ra_max, dec_min, dec_max) in radians and query parameters of each journal
+    :param v_mag: the limiting magnitude of the queries
+    :param session: the HTTP session to post the queries with
+    :param url: the GraphQL endpoint to query
+    :param mag_min: the bright magnitude limit of the queries, if they select a magnitude shell
+    :param metrics: the measurements of the run to record each page in, if any
+    :param batch_size: the most regions packed into one request
+    :return: the completed journal of each region
+    """
+    query = Query(url=url, session=session)
+
+    # Continue each region from the last page completed by an interrupted run, if there was one
+    journals = [Journal(params) for _, _, params in regions]
+    checkpoints = [journal.resume() for journal in journals]
+    last_ids = [last_id for _, last_id, _ in checkpoints]
+    complete = [done for _, _, done in checkpoints]
+
+    while not all(complete):
+        batch = [i for i in range(len(regions)) if not complete[i]][:batch_size]
+
+        start = time.perf_counter()
+        query.build_batch({
+            f"r{i}": dict(zip(('ra_min', 'ra_max', 'dec_min', 'dec_max'), regions[i][1]), date=regions[i][0], mag_lim=v_mag, last_id=last_ids[i], mag_min=mag_min)
+            for i in batch
+        })
+        build_time = time.perf_counter() - start
+        query.get_results()
+
+        # The cost of the request is shared evenly between the pages it carried, and its retries counted once
+        for i in batch:
+            start = time.perf_counter()
+            page = flatten(query.data['data'][f"r{i}"])
+            parse_time = time.perf_counter() - start
+
+            complete[i] = len(page) < PAGE_SIZE
+            if not complete[i]:
+                last_ids[i] = int(page['ast_number'][-1])
+
+            start = time.perf_counter()
+            journals[i].append(page, last_ids[i], complete[i])
+            write_time = time.perf_counter() - start
+
+            if metrics is not None:
+                metrics.record(
+                    "page", date=regions[i][2]['date'], query=journals[i].key, rows=len(page), bytes=query.bytes_received // len(batch), retries=query.retries if i == batch[0] else 0,
+                    build_time=build_time / len(batch), http_latency=query.latency / len(batch), parse_time=query.decode_time / len(batch) + parse_time,
+                    write_time=write_time, batch=len(batch),
+                )
+        query.data = None
+
+    return journals
+
+def merge_journals(journals: list[Journal], chunk_rows: int = PAGE_SIZE) -> Iterator[np.ndarray]:
+    """ Merge the journals of a night's regions, a chunk at a time, dropping the asteroids returned by several regions.
+    Regions are paged in asteroid number order, so each journal is sorted and the merge never holds more than
+    a chunk of each journal in memory.
+    :param journals: the completed journals of the night
+    :param chunk_rows: the number of rows read from a journal at a time
+    :return: chunks of the merged rows, in asteroid number order
+    """
+    files = [open(journal.rows_file, 'rb') for journal in journals if os.path.exists(journal.rows_file)]
+    try:
+        buffers = [np.fromfile(f, dtype=OBSERVABLE_DTYPE, count=chunk_rows) for f in files]
+        while any(len(buffer) for buffer in buffers):
+            # Every copy of an asteroid up to the smallest last number in the buffers has been read
+            bound = min(buffer['ast_number'][-1] for buffer in buffers if len(buffer))
+            taken = []
+            for i, buffer in enumerate(buffers):
+                end = np.searchsorted(buffer['ast_number'], bound, side='right')
+                taken.append(buffer[:end])
+                buffers[i] = buffer[end:] if end < len(buffer) else np.fromfile(files[i], dtype=OBSERVABLE_DTYPE, count=chunk_rows)
+
+            rows = np.concatenate(taken)
+            _, first = np.unique(rows['ast_number'], return_index=True)
+            yield rows[first]
+    finally:
+        for f in files:
+            f.close()
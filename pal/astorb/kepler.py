@@ -0,0 +1,248 @@
+from astropy.coordinates import EarthLocation, get_body_barycentric
+from astropy.time import Time
+import math
+import numpy as np
+
+"""
+    Contains the two-body (Keplerian) motion of asteroids around the Sun, computed from their osculating
+    orbital elements with NumPy, every asteroid and every time at once. The elements are heliocentric,
+    referred to the ecliptic and equinox of J2000, with angles in radians and the epoch of osculation as a
+    TT Julian date (see pal.astorb.mirror).
+
+    The positions returned are astrometric: corrected for light-time, and seen from the geocenter or from a
+    telescope's location, but without aberration, as star catalogues and plate solutions are. Has the functions:
+        solve_kepler(): Solves Kepler's equation for the eccentric anomaly.
+        observe(): Gets the geocentric right ascension, declination and V magnitude of asteroids at a time.
+        elements_from_state(): Gets the orbital elements of a heliocentric position and velocity.
+"""
+
+# Gaussian gravitational constant, the mean motion in radians per day of a body on a 1 AU orbit
+GAUSS_K = 0.01720209895
+# Speed of light in AU per day
+LIGHT_SPEED = 173.1446326846693
+# Obliquity of the ecliptic at J2000, which rotates the ecliptic elements into the equatorial (ICRS) frame
+OBLIQUITY = math.radians(84381.448 / 3600)
+# Coefficients of the two phase functions of the H-G magnitude system (Bowell et al. 1989)
+PHASE_A = (3.33, 1.87)
+PHASE_B = (0.63, 1.22)
+# The number of object-epochs computed at once, which keeps the temporary arrays in the CPU cache
+CHUNK_SIZE = 1 << 14
+
+class Orbits():
+    count = None
+    axes = None
+
+    def __init__(self, elements: dict[str, np.ndarray]):
+        """ Set up the orbits of a set of asteroids, precomputing everything that does not depend on time.
+        :param elements: the columns epoch, a, e, i, node, peri and M of the asteroids, and optionally H and G
+                         (a structured array, a Mirror or a dict of columns)
+        """
+        a = np.asarray(elements['a'], dtype=np.float64)
+        e = np.asarray(elements['e'], dtype=np.float64)
+        self.count = len(a)
+        self.a = a
+        # Only elliptic orbits are propogated, the others are NaN
+        self.e = np.where(e < 1, e, np.nan)
+        self.b = a * np.sqrt(1 - self.e * self.e)
+        self.mean_motion = GAUSS_K / a ** 1.5
+        self.epoch = np.asarray(elements['epoch'], dtype=np.float64)
+        self.mean_anomaly = np.asarray(elements['M'], dtype=np.float64)
+
+        names = elements.dtype.names if hasattr(elements, 'dtype') else elements.keys()
+        self.h = np.asarray(elements['H'], dtype=np.float64) if 'H' in names else None
+        self.g = np.asarray(elements['G'], dtype=np.float64) if 'G' in names else None
+
+        cos_node, sin_node = np.cos(elements['node']), np.sin(elements['node'])
+        cos_peri, sin_peri = np.cos(elements['peri']), np.sin(elements['peri'])
+        cos_i, sin_i = np.cos(elements['i']), np.sin(elements['i'])
+
+        # Unit vectors toward perihelion (P) and 90 degrees ahead of it in the orbit (Q), in the ecliptic frame
+        p = np.stack([cos_node * cos_peri - sin_node * sin_peri * cos_i, sin_node * cos_peri + cos_node * sin_peri * cos_i, sin_peri * sin_i])
+        q = np.stack([-cos_node * sin_peri - sin_node * cos_peri * cos_i, -sin_node * sin_peri + cos_node * cos_peri * cos_i, cos_peri * sin_i])
+
+        # Rotated by the obliquity into the equatorial frame, shaped (2, 3, number of asteroids)
+        self.axes = np.stack([ecliptic_to_equatorial(p), ecliptic_to_equatorial(q)])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def state(self, jd_tt: np.ndarray, rows: slice = slice(None)) -> tuple[np.ndarray, np.ndarray]:
+        """ Get the heliocentric positions and velocities of the asteroids.
+        :param jd_tt: the times as TT Julian dates, shaped (number of times,)
+        :param rows: the asteroids to compute
+        :return: the equatorial positions in AU and velocities in AU per day, each shaped (3, number of asteroids, number of times)
+        """
+        a, e, b = self.a[rows, None], self.e[rows, None], self.b[rows, None]
+        mean_motion = self.mean_motion[rows, None]
+
+        anomaly = solve_kepler(self.mean_anomaly[rows, None] + mean_motion * (jd_tt[None, :] - self.epoch[rows, None]), e)
+        cos_anomaly, sin_anomaly = np.cos(anomaly), np.sin(anomaly)
+
+        # Position and velocity in the orbital plane, with x toward perihelion
+        x = a * (cos_anomaly - e)
+        y = b * sin_anomaly
+        rate = mean_motion / (1 - e * cos_anomaly)
+        vx = -a * sin_anomaly * rate
+        vy = b * cos_anomaly * rate
+
+        p, q = self.axes[0][:, rows, None], self.axes[1][:, rows, None]
+        return p * x + q * y, p * vx + q * vy
+
+    def observe(self, times: Time, location: EarthLocation = None, light_time: bool = True, magnitudes: bool = True) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+        """ Get the astrometric positions and brightness of the asteroids at every time.
+        :param times: the times, a 1-D Time array
+        :param location: the location of the telescope to observe from. Default is the geocenter.
+        :param light_time: whether to correct the positions for the light-time from the asteroids
+        :param magnitudes: whether to compute the V magnitudes, which needs the H and G columns
+        :return: the right ascensions and declinations in radians, and the V magnitudes (None if not computed),
+                 each shaped (number of asteroids, number of times)
+        """
+        times = times.reshape((-1,))
+        jd_tt = times.tt.jd
+        observer = observer_positions(times, location)[:, None, :]
+        magnitudes = magnitudes and self.h is not None
+
+        shape = (self.count, len(times))
+        ra, dec = np.empty(shape), np.empty(shape)
+        v_mag = np.empty(shape) if magnitudes else None
+
+        # The asteroids are computed in chunks of rows, so each chunk's temporary arrays stay small
+        step = max(1, CHUNK_SIZE // max(len(times), 1))
+        for start in range(0, self.count, step):
+            rows = slice(start, start + step)
+            position, velocity = self.state(jd_tt, rows)
+            geocentric = position - observer
+            distance = np.sqrt(np.einsum('i...,i...->...', geocentric, geocentric))
+
+            if light_time:
+                # The asteroid is seen where it was when the light left it. A linear step back along its
+                # velocity is accurate to well under a milliarcsecond over the light-time of a main belt asteroid.
+                delay = distance / LIGHT_SPEED
+                velocity *= delay
+                position -= velocity
+                geocentric -= velocity
+                distance = np.sqrt(np.einsum('i...,i...->...', geocentric, geocentric))
+
+            ra[rows] = np.remainder(np.arctan2(geocentric[1], geocentric[0]), 2 * np.pi)
+            dec[rows] = np.arcsin(geocentric[2] / distance)
+            if magnitudes:
+                v_mag[rows] = magnitude(self.h[rows, None], self.g[rows, None], position, geocentric, distance)
+
+        return ra, dec, v_mag
+
+def solve_kepler(mean_anomaly: np.ndarray, eccentricity: np.ndarray, tolerance: float = 1e-12, max_iterations: int = 30) -> np.ndarray:
+    """ Solve Kepler's equation, M = E - e sin(E), for the eccentric anomaly by Newton's method.
+    :param mean_anomaly: the mean anomalies in radians
+    :param eccentricity: the eccentricities, broadcast against the mean anomalies. Only elliptic orbits (e < 1) are solved, others are NaN.
+    :param tolerance: the largest correction of the last iteration, in radians
+    :param max_iterations: the largest number of iterations
+    :return: the eccentric anomalies in radians
+    """
+    mean_anomaly = np.remainder(mean_anomaly, 2 * np.pi)
+    eccentricity = np.where(eccentricity < 1, eccentricity, np.nan)
+
+    # Starting from pi converges for every elliptic orbit, starting from M + e sin(M) takes three or four
+    # iterations for the near-circular orbits of most asteroids
+    anomaly = mean_anomaly + eccentricity * np.sin(mean_anomaly)
+    if np.any(eccentricity >= 0.8):
+        anomaly = np.where(eccentricity < 0.8, anomaly, np.pi)
+
+    # Each anomaly stops being corrected once it has converged, so its value does not depend on the others
+    # solved with it, and propogating in tiles or shards gives the same result as propogating all at once
+    active = np.ones(anomaly.shape, dtype=bool)
+    for _ in range(max_iterations):
+        correction = anomaly - eccentricity * np.sin(anomaly) - mean_anomaly
+        correction /= 1 - eccentricity * np.cos(anomaly)
+        correction *= active
+        anomaly -= correction
+        active &= np.abs(correction) > tolerance
+        if not active.any():
+            break
+    return anomaly
+
+def observe(elements: dict[str, np.ndarray], time: Time, location: EarthLocation = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Get the astrometric positions and brightness of asteroids at a single time.
+    :param elements: the columns epoch, a, e, i, node, peri, M, H and G of the asteroids
+    :param time: the time
+    :param location: the location of the telescope to observe from. Default is the geocenter.
+    :return: the right ascensions and declinations in radians, and the V magnitudes
+    """
+    ra, dec, v_mag = Orbits(elements).observe(time.reshape((1,)), location)
+    return ra[:, 0], dec[:, 0], v_mag[:, 0]
+
+def observer_positions(times: Time, location: EarthLocation = None) -> np.ndarray:
+    """ Get the heliocentric positions of an observer from astropy's built-in solar system ephemeris.
+    :param times: the times, a 1-D Time array
+    :param location: the location of the telescope. Default is the geocenter.
+    :return: the equatorial (ICRS) positions in AU, shaped (3, number of times)
+    """
+    earth = (get_body_barycentric('earth', times) - get_body_barycentric('sun', times)).xyz.to_value('AU')
+    if location is not None:
+        # The GCRS axes are those of the ICRS, to far better than the precision of a two-body orbit
+        position, _ = location.get_gcrs_posvel(times)
+        earth = earth + position.xyz.to_value('AU')
+    return earth
+
+def magnitude(h: np.ndarray, g: np.ndarray, heliocentric: np.ndarray, geocentric: np.ndarray, distance: np.ndarray) -> np.ndarray:
+    """ Get the apparent V magnitudes of asteroids in the H-G system.
+    :param h: the absolute magnitudes
+    :param g: the slope parameters
+    :param heliocentric: the heliocentric positions in AU, shaped (3, ...)
+    :param geocentric: the positions relative to the observer in AU, shaped (3, ...)
+    :param distance: the distances from the observer in AU
+    :return: the V magnitudes
+    """
+    sun_distance = np.sqrt(np.einsum('i...,i...->...', heliocentric, heliocentric))
+    cos_phase = np.einsum('i...,i...->...', heliocentric, geocentric) / (sun_distance * distance)
+    tan_half_phase = np.sqrt(np.clip((1 - cos_phase) / (1 + cos_phase), 0, None))
+
+    phase_1 = np.exp(-PHASE_A[0] * tan_half_phase ** PHASE_B[0])
+    phase_2 = np.exp(-PHASE_A[1] * tan_half_phase ** PHASE_B[1])
+    return h + 5 * np.log10(sun_distance * distance) - 2.5 * np.log10((1 - g) * phase_1 + g * phase_2)
+
+def ecliptic_to_equatorial(vector: np.ndarray) -> np.ndarray:
+    """ Rotate vectors, shaped (3, ...), from the J2000 ecliptic frame into the equatorial frame. """
+    cos_obliquity, sin_obliquity = math.cos(OBLIQUITY), math.sin(OBLIQUITY)
+    return np.stack([vector[0], cos_obliquity * vector[1] - sin_obliquity * vector[2], sin_obliquity * vector[1] + cos_obliquity * vector[2]])
+
+def elements_from_state(position: np.ndarray, velocity: np.ndarray, jd_tt: float) -> dict[str, np.ndarray]:
+    """ Get the osculating orbital elements of heliocentric positions and velocities.
+    :param position: the equatorial (ICRS) positions in AU, shaped (3, number of asteroids)
+    :param velocity: the equatorial velocities in AU per day, shaped (3, number of asteroids)
+    :param jd_tt: the time of the positions, as a TT Julian date
+    :return: the columns epoch, a, e, i, node, peri and M, in the frame and units used by Orbits
+    """
+    cos_obliquity, sin_obliquity = math.cos(OBLIQUITY), math.sin(OBLIQUITY)
+
+    def to_ecliptic(vector):
+        return np.stack([vector[0], cos_obliquity * vector[1] + sin_obliquity * vector[2], -sin_obliquity * vector[1] + cos_obliquity * vector[2]])
+
+    r, v = to_ecliptic(np.asarray(position, dtype=np.float64)), to_ecliptic(np.asarray(velocity, dtype=np.float64))
+    mu = GAUSS_K ** 2
+    distance = np.linalg.norm(r, axis=0)
+    momentum = np.cross(r, v, axis=0)
+    momentum_norm = np.linalg.norm(momentum, axis=0)
+
+    a = 1 / (2 / distance - np.sum(v * v, axis=0) / mu)
+    eccentricity_vector = np.cross(v, momentum, axis=0) / mu - r / distance
+    e = np.linalg.norm(eccentricity_vector, axis=0)
+    i = np.arccos(momentum[2] / momentum_norm)
+    node = np.arctan2(momentum[0], -momentum[1])
+
+    # Angles in the orbital plane are measured from the ascending node
+    node_axis = np.stack([np.cos(node), np.sin(node), np.zeros_like(node)])
+    normal_axis = np.cross(momentum / momentum_norm, node_axis, axis=0)
+    peri = np.arctan2(np.sum(eccentricity_vector * normal_axis, axis=0), np.sum(eccentricity_vector * node_axis, axis=0))
+    latitude = np.arctan2(np.sum(r * normal_axis, axis=0), np.sum(r * node_axis, axis=0))
+    true_anomaly = latitude - peri
+    anomaly = 2 * np.arctan2(np.sqrt(1 - e) * np.sin(true_anomaly / 2), np.sqrt(1 + e) * np.cos(true_anomaly / 2))
+
+    return {
+        'epoch': np.full(len(a), jd_tt),
+        'a': a,
+        'e': e,
+        'i': i,
+        'node': np.remainder(node, 2 * np.pi),
+        'peri': np.remainder(peri, 2 * np.pi),
+        'M': np.remainder(anomaly - e * np.sin(anomaly), 2 * np.pi),
+    }
@@ -0,0 +1,307 @@
+import csv
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import math
+import numpy as np
+import os
+import shutil
+from typing import TYPE_CHECKING
+
+from pal.astorb.storage import OBSERVABLE_DTYPE
+
+if TYPE_CHECKING:  # planner imports astropy, which the mirror is used without
+    from pal.astorb.planner import Plan
+
+"""
+    Contains the local mirror of the Astorb orbital element catalogue, which lets the pipeline find the
+    observable asteroids of a night without querying AstorbDB (see pipeline(source='local')).
+    The mirror is built once from a bulk export, such as Lowell's astorb.dat(.gz) or a CSV file, and updated
+    incrementally from later exports, which only need to hold the orbits that changed.
+
+    It is stored under pal/results/mirror as one .npy file per column, sorted by ast_number, so each column
+    is memory-mapped and contiguous for the vectorized two-body propogation (see pal.astorb.kepler.Orbits).
+    Each build or update writes a new generation directory and then points manifest.json at it, so a run
+    that has the previous generation mapped keeps reading consistent columns. Has the functions:
+        build_mirror(): Builds the mirror from a bulk export.
+        update_mirror(): Merges a later export into the mirror.
+        read_export(): Reads the orbital elements of an export file.
+"""
+
+MIRROR_DIR = "pal/results/mirror"
+
+# Angles are stored in radians, the epoch of osculation as a TT Julian date.
+# Designations are stored as ASCII bytes, which take a quarter of the space of the unicode observable column.
+ELEMENTS_DTYPE = np.dtype([
+    ('ast_number', np.int64),
+    ('designation', 'S18'),
+    ('epoch', np.float64),
+    ('a', np.float64),
+    ('e', np.float64),
+    ('i', np.float64),
+    ('node', np.float64),
+    ('peri', np.float64),
+    ('M', np.float64),
+    ('H', np.float64),
+    ('G', np.float64),
+])
+
+# The columns of astorb.dat used, as (start, end) character positions (see the astorb.dat format description)
+ASTORB_COLUMNS = {
+    'ast_number': (0, 6),
+    'designation': (7, 25),
+    'H': (42, 47),
+    'G': (48, 53),
+    'epoch': (106, 114),
+    'M': (115, 125),
+    'peri': (126, 136),
+    'node': (137, 147),
+    'i': (148, 157),
+    'e': (158, 168),
+    'a': (169, 182),
+}
+
+# Slope parameter assumed for asteroids without one
+DEFAULT_G = 0.15
+
+class Mirror():
+    manifest = None
+    columns = None
+    _orbits = None
+
+    def __init__(self, mirror_dir: str = MIRROR_DIR):
+        """ Open the mirror, memory-mapping each of its columns.
+        :param mirror_dir: the directory of the mirror
+        :raises FileNotFoundError: if no mirror has been built
+        """
+        manifest_file = os.path.join(mirror_dir, "manifest.json")
+        if not os.path.exists(manifest_file):
+            raise FileNotFoundError(f"No local mirror in {mirror_dir}. Build one with: python -m pal mirror build <export file>")
+
+        with open(manifest_file, 'r') as f:
+            self.manifest = json.load(f)
+        self.mirror_dir = mirror_dir
+        generation_dir = os.path.join(mirror_dir, self.manifest['generation'])
+        self.columns = {name: np.load(os.path.join(generation_dir, f"{name}.npy"), mmap_mode='r') for name in ELEMENTS_DTYPE.names}
+
+    def __len__(self) -> int:
+        return len(self.columns['ast_number'])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def find(self, ast_number: int) -> int | None:
+        """ Find an asteroid in the mirror.
+        :param ast_number: the asteroid number
+        :return: the row of the asteroid, or None if it is not in the mirror
+        """
+        numbers = self.columns['ast_number']
+        row = int(np.searchsorted(numbers, ast_number))
+        if row < len(numbers) and numbers[row] == ast_number:
+            return row
+        return None
+
+    def orbits(self, ast_numbers: np.ndarray = None):
+        """ Get the orbits of asteroids in the mirror, ready to propogate (see pal.astorb.kepler.Orbits).
+        The orbits of the whole mirror are set up once and kept.
+        :param ast_numbers: the asteroid numbers, each of which must be in the mirror. Default is every asteroid.
+        :return: the orbits, in the order of ast_numbers
+        """
+        from pal.astorb.kepler import Orbits
+
+        if ast_numbers is None:
+            if self._orbits is None:
+                self._orbits = Orbits(self.columns)
+            return self._orbits
+
+        rows = np.searchsorted(self.columns['ast_number'], ast_numbers)
+        return Orbits({name: column[rows] for name, column in self.columns.items()})
+
+    def select(self, date: datetime, sky_range: tuple[float, float, float, float], v_mag: float, tiles: list[tuple[float, float, float, float]] = None, plan: 'Plan' = None) -> np.ndarray | tuple[np.ndarray, int]:
+        """ Select the asteroids inside a sky range on a date, as the ephemeris query of AstorbDB does.
+        :param date: the date, whose geocentric positions are computed at UTC midnight
+        :param sky_range: the sky range (ra_min, ra_max, dec_min, dec_max) in radians
+        :param v_mag: the limiting magnitude
+        :param tiles: the sky ranges to select from instead, as planned by pal.astorb.planner, if any
+        :param plan: the plan of the night (see pal.astorb.planner) to select the tiles of instead, if any.
+                     The asteroids the single box it replaced would have selected are then counted too.
+        :return: the selected asteroids as a structured array with the OBSERVABLE_DTYPE columns,
+                 and the number the plan's single box would have selected if a plan is given
+        """
+        from astropy.time import Time
+        import astropy.units as u
+
+        time = Time(date, scale='utc').reshape((1,))
+        ra, dec, v = (column[:, 0] for column in self.orbits().observe(time))
+        if plan is not None:
+            tiles = plan.tiles
+            box_rows = int(np.count_nonzero(plan.box_contains(ra, dec) & (v <= v_mag)))
+        inside = np.zeros(len(ra), dtype=bool)
+        for ra_min, ra_max, dec_min, dec_max in (tiles if tiles is not None else [sky_range]):
+            inside |= (ra >= ra_min) & (ra <= ra_max) & (dec >= dec_min) & (dec <= dec_max)
+        rows = np.flatnonzero(inside & (v <= v_mag))
+
+        # The rates are measured over the following hour, for the selected asteroids only
+        ast_numbers = self.columns['ast_number'][rows]
+        ra, dec, v = ra[rows], dec[rows], v[rows]
+        later_ra, later_dec, _ = self.orbits(ast_numbers).observe(time + 1 * u.hour, magnitudes=False)
+        arcsec = math.degrees(3600)
+
+        data = np.empty(len(rows), dtype=OBSERVABLE_DTYPE)
+        data['ast_number'] = ast_numbers
+        data['designation'] = np.char.decode(self.columns['designation'][rows], 'ascii')
+        data['ra'] = ra
+        data['dec'] = dec
+        data['ra_rate'] = np.remainder(later_ra[:, 0] - ra + np.pi, 2 * np.pi) - np.pi
+        data['ra_rate'] *= np.cos(dec) * arcsec
+        data['dec_rate'] = (later_dec[:, 0] - dec) * arcsec
+        data['v_mag'] = v
+        if plan is not None:
+            return data, box_rows
+        return data
+
+def build_mirror(export_file: str, mirror_dir: str = MIRROR_DIR) -> int:
+    """ Build the mirror from a bulk export, replacing any existing mirror.
+    :param export_file: the export file (see read_export)
+    :param mirror_dir: the directory of the mirror
+    :return: the number of asteroids in the mirror
+    """
+    elements = read_export(export_file)
+    write_mirror(elements, mirror_dir, {"built": datetime.now().isoformat(timespec='seconds'), "sources": [os.path.basename(export_file)]})
+    return len(elements)
+
+def update_mirror(export_file: str, mirror_dir: str = MIRROR_DIR) -> tuple[int, int]:
+    """ Merge a later export into the mirror. Asteroids already in the mirror have their elements replaced,
+    others are added. Asteroids missing from the export are kept as they are.
+    :param export_file: the export file (see read_export), holding every orbit or only those that changed
+    :param mirror_dir: the directory of the mirror
+    :return: the number of asteroids updated, and the number added
+    """
+    mirror = Mirror(mirror_dir)
+    updates = read_export(export_file)
+
+    elements = np.empty(len(mirror), dtype=ELEMENTS_DTYPE)
+    for name in ELEMENTS_DTYPE.names:
+        elements[name] = mirror[name]
+
+    numbers = elements['ast_number']
+    rows = np.searchsorted(numbers, updates['ast_number'])
+    found = rows < len(numbers)
+    found[found] = numbers[rows[found]] == updates['ast_number'][found]
+    elements[rows[found]] = updates[found]
+    elements = np.concatenate([elements, updates[~found]])
+    elements = elements[np.argsort(elements['ast_number'], kind='stable')]
+
+    manifest = dict(mirror.manifest)
+    manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+    manifest['sources'] = manifest.get('sources', []) + [os.path.basename(export_file)]
+    write_mirror(elements, mirror_dir, manifest)
+    return int(found.sum()), int((~found).sum())
+
+def write_mirror(elements: np.ndarray, mirror_dir: str, manifest: dict):
+    """ Write the columns of the mirror as a new generation, then point the manifest at it.
+    :param elements: the orbital elements as a structured array with the ELEMENTS_DTYPE columns, sorted by ast_number
+    :param mirror_dir: the directory of the mirror
+    :param manifest: the description of the mirror. Its generation and row count are set here.
+    """
+    generation = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    generation_dir = os.path.join(mirror_dir, generation)
+    os.makedirs(generation_dir, exist_ok=True)
+    for name in ELEMENTS_DTYPE.names:
+        np.save(os.path.join(generation_dir, f"{name}.npy"), np.ascontiguousarray(elements[name]))
+
+    manifest_file = os.path.join(mirror_dir, "manifest.json")
+    previous = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            previous = json.load(f).get('generation')
+
+    manifest = {**manifest, "generation": generation, "rows": len(elements)}
+    with open(manifest_file + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+    # Runs that have the previous generation mapped keep reading it until they close it
+    if previous is not None and previous != generation:
+        shutil.rmtree(os.path.join(mirror_dir, previous), ignore_errors=True)
+
+def read_export(file_name: str) -> np.ndarray:
+    """ Read the orbital elements of an export file.
+    Two formats are read: astorb.dat (optionally gzipped), and CSV files with a header naming the columns
+    ast_number, designation, epoch, a, e, i, node, peri, M, H and G (G is optional). CSV angles are in degrees,
+    and the epoch is either a Julian date or a YYYYMMDD date.
+    Unnumbered asteroids are given a negative ast_number derived from their designation, so they keep the same key between exports.
+    :param file_name: the export file
+    :return: the orbital elements as a structured array with the ELEMENTS_DTYPE columns, sorted by ast_number
+    """
+    opener = gzip.open if file_name.endswith('.gz') else open
+    with opener(file_name, 'rt', encoding='ascii', errors='replace') as f:
+        if file_name.removesuffix('.gz').endswith('.csv'):
+            columns = read_csv(f)
+        else:
+            columns = read_astorb(f)
+
+    elements = np.empty(len(columns['a']), dtype=ELEMENTS_DTYPE)
+    elements['designation'] = [designation.strip().encode('ascii', 'replace')[:18] for designation in columns['designation']]
+    elements['ast_number'] = [
+        int(number) if number.strip() else unnumbered_key(designation.strip())
+        for number, designation in zip(columns['ast_number'], columns['designation'])
+    ]
+
+    epoch = np.array(columns['epoch'], dtype=np.float64)
+    # Dates of osculation written as YYYYMMDD are converted to Julian dates of 0h TT
+    dates = epoch > 1e7
+    yyyymmdd = epoch[dates].astype(np.int64)
+    epoch[dates] = julian_date(yyyymmdd // 10000, yyyymmdd // 100 % 100, yyyymmdd % 100)
+    elements['epoch'] = epoch
+
+    for name in ('a', 'e', 'H'):
+        elements[name] = np.array(columns[name], dtype=np.float64)
+    elements['G'] = [float(g) if str(g).strip() else DEFAULT_G for g in columns['G']]
+    for name in ('i', 'node', 'peri', 'M'):
+        elements[name] = np.radians(np.array(columns[name], dtype=np.float64))
+
+    # Later rows of the same asteroid replace earlier ones
+    _, last = np.unique(elements['ast_number'][::-1], return_index=True)
+    return elements[len(elements) - 1 - last]
+
+def read_astorb(f) -> dict[str, list[str]]:
+    """ Read the columns of an astorb.dat file.
+    :param f: the open file
+    :return: the text of each column
+    """
+    columns = {name: [] for name in ASTORB_COLUMNS}
+    for line in f:
+        if len(line) < ASTORB_COLUMNS['a'][1]:
+            continue
+        for name, (start, end) in ASTORB_COLUMNS.items():
+            columns[name].append(line[start:end])
+    return columns
+
+def read_csv(f) -> dict[str, list[str]]:
+    """ Read the columns of a CSV export.
+    :param f: the open file
+    :return: the text of each column
+    """
+    reader = csv.DictReader(f)
+    missing = {'designation', 'epoch', 'a', 'e', 'i', 'node', 'peri', 'M', 'H'} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f"The export is missing the columns: {', '.join(sorted(missing))}")
+
+    columns = {name: [] for name in ELEMENTS_DTYPE.names}
+    for row in reader:
+        for name in columns:
+            columns[name].append(row.get(name) or '')
+    return columns
+
+def unnumbered_key(designation: str) -> int:
+    """ Get the key of an unnumbered asteroid: a negative number derived from its designation. """
+    return -int(hashlib.sha1(designation.encode()).hexdigest()[:15], 16) - 1
+
+def julian_date(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """ Get the Julian dates of 0h on Gregorian calendar dates. """
+    a = (14 - month) // 12
+    y = year + 4800 - a
+    m = month + 12 * a - 3
+    return day + (153 * m + 2) // 5 + 365 * y + y // 4 - y // 100 + y // 400 - 32045 - 0.5
@@ -1,106 +1,364 @@
+from astropy.time import Time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from datetime import datetime
-import json
 import numpy as np
-import os
+import requests
 import time
 from tqdm import tqdm
 
-from pal.astorb.query import Query
+from pal.astorb.cache import QueryCache, query_params
+from pal.astorb.journal import Journal, fetch_region, fetch_regions, merge_journals
+from pal.astorb.mirror import Mirror
+from pal.astorb.planner import Plan, plan_nights
+from pal.astorb.query import Query, create_session
+from pal.astorb.reuse import query_run
+from pal.astorb.storage import ObservableWriter, load_observable, observable_file, write_observable
+from pal.utils.metrics import Metrics
 from pal.utils.telescope import Telescope
 
 """
     This script is the main pipeline for the target finding program. 
     It allows the user to input dates manually or use a preset file to query the database for targets.
     The results are written to a file for further analysis.
+    Several nights can be queried concurrently, sharing one pooled HTTP session, and several nights can be
+    packed into each request as GraphQL aliases, each paging on its own.
+    Each page is flattened and journaled as it arrives, which bounds memory by one page and lets
+    an interrupted night resume from its last completed page.
+    With source='local', the nights are selected from the local mirror of the orbital elements
+    (see pal.astorb.mirror) instead, which needs no connection to the database.
+    Unless disabled, each night is queried as the few tiles of sky the telescope can actually observe
+    (see pal.astorb.planner), rather than one box around the night's LST range.
 """
 
-def pipeline(dates: list[datetime], telescope: Telescope, mag_lim: bool) -> list[str]:
+def pipeline(dates: list[datetime], telescope: Telescope, mag_lim: bool, workers: int = 1, url: str = None, reuse: int = 1, tolerance: float = None, session: requests.Session = None, metrics: Metrics = None, source: str = 'remote', plan: bool = True, batch: int = 1) -> list[str]:
     """ Query the Lowell Observatory Astorb database for asteroids visible in the sky at the time of observation.
     :param dates: the dates to query the database for
     :param telescope: the telescope to use for the query
-    :return: a list of asteroids visible in the sky at the time of observation
+    :param mag_lim: whether to apply the telescope's limiting magnitude to the query
+    :param workers: the number of nights to query concurrently
+    :param url: the GraphQL endpoint to query. Defaults to the AstorbDB API.
+    :param reuse: the largest number of consecutive nights one query is reused for, by local propogation (see pal.astorb.reuse)
+    :param tolerance: the largest predicted position error in arcseconds before a reused query is refreshed
+    :param session: the HTTP session to post the queries with. A pooled session is created and closed if none is given.
+    :param metrics: the measurements of the run to record each night and page in, if any
+    :param source: where to find the asteroids: 'remote' to query AstorbDB, or 'local' to select them from the local mirror
+    :param plan: whether to query the tiles of sky observable on each night (see pal.astorb.planner) instead of one box.
+                 Reused queries always use the box, as their anchors are propogated across it.
+    :param batch: the number of nights packed into each request to the database, as GraphQL aliases. Not used with reuse.
+    :return: a list of files containing the asteroids visible in the sky, one per date
     """
+    if source not in ('remote', 'local'):
+        raise ValueError(f"Unknown source: {source}. Use 'remote' or 'local'.")
 
     if mag_lim:
         v_mag = telescope.mag_lim
     else:
         v_mag = 30
 
-    files = []
+    files = [None] * len(dates)
+    pending = []
     total_asteroids = 0
+    planned_rows = box_rows = 0
+    cache = QueryCache()
+    start_stats = cache.stats()
 
-    loop = tqdm(dates, desc="Querying database", leave=False)
-    for date in loop:
+    # Compute the sky range of every night in one vectorized pass
+    with metrics.stage("sky_ranges", nights=len(dates)) if metrics is not None else nullcontext():
+        if plan and (source == 'local' or reuse <= 1):
+            plans = plan_nights(dates, telescope)
+            sky_ranges = [night.box for night in plans]
+        else:
+            plans = [None] * len(dates)
+            sky_ranges = get_sky_ranges(dates, telescope)
 
-        num_asteroids_day = 0
-        file_name = already_queried(date, telescope)
+    if source == 'local':
+        return select_nights(dates, telescope, v_mag, sky_ranges, workers, metrics, plans)
+
+    loop = tqdm(total=len(dates), desc="Querying database", leave=False)
+    for i, date in enumerate(dates):
+        start_time = time.time()
+        params = query_params(date, sky_ranges[i], v_mag, Query.fields, tiles=plans[i].tiles if plans[i] is not None else None)
+        file_name = already_queried(date, telescope, params, cache)
         if file_name != False:
-            files.append(file_name)
+            files[i] = file_name
+            if metrics is not None:
+                elapsed = time.time() - start_time
+                metrics.night(params['date'], "cache", len(load_observable(file_name)), elapsed, elapsed)
             loop.set_description(f"Data for {date} already queried. Skipping.", refresh=True)
-            continue
-        
+            loop.update(1)
+        else:
+            pending.append((i, params))
 
-        start_time = time.time()
+    # One pooled session is shared by every query so connections are kept alive between pages and nights
+    own_session = session is None
+    if own_session:
+        session = create_session(workers)
 
-        query = Query()
-
-        # Get the sky range for the given date
-        b_ra_min, b_ra_max, b_dec_min, b_dec_max = get_sky_range(date, telescope)
-
-        # Build the query and get the results
-        query.build_query(ra_min=b_ra_min, ra_max=b_ra_max, dec_min=b_dec_min, dec_max=b_dec_max, date=date, mag_lim=v_mag)
-        query.get_results()
-
-        if not query.response.ok:
-            raise ValueError("Query error: ", query.response)
-
-        response = query.response.json()['data']['ephemeris']
-        data = response
-        num_asteroids = len(response)
-        num_asteroids_day += num_asteroids
-        total_asteroids += num_asteroids
-        last_id = response[-1]['minorplanet']['ast_number']
-
-        continue_query = True
-        while continue_query:
-            if num_asteroids == 1000:
-                #requery for the same date with the last asteroid id as the new limit
-                query.build_query(ra_min=b_ra_min, ra_max=b_ra_max, dec_min=b_dec_min, dec_max=b_dec_max, date=date, mag_lim=v_mag, last_id=last_id)
-                query.get_results()
-                response = query.response.json()['data']['ephemeris']
-                last_id = response[-1]['minorplanet']['ast_number']
-                data.extend(response)
-                num_asteroids = len(response)
-                num_asteroids_day += num_asteroids
-                total_asteroids += num_asteroids
-            else:
-                continue_query = False
-
-        # Write the results to a file
-        files.append(log_obserbable_asteroids(data, date, telescope.slug))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if reuse > 1:
+            # Split the pending dates into runs of consecutive nights, each reusing its anchor queries
+            runs = []
+            for i, _ in pending:
+                if runs and runs[-1][-1] == i - 1:
+                    runs[-1].append(i)
+                else:
+                    runs.append([i])
+            futures = {executor.submit(query_run, dates[run], [sky_ranges[i] for i in run], telescope, v_mag, reuse, tolerance, session, url, cache, metrics): run for run in runs}
+        elif batch > 1:
+            # Pack the pending dates into each request, batch nights at a time
+            chunks = [pending[j:j + batch] for j in range(0, len(pending), batch)]
+            futures = {
+                executor.submit(query_nights, dates[[i for i, _ in chunk]], telescope, v_mag, session, url, [sky_ranges[i] for i, _ in chunk], cache, [params for _, params in chunk], metrics, [plans[i] for i, _ in chunk]): [i for i, _ in chunk]
+                for chunk in chunks
+            }
+        else:
+            futures = {executor.submit(query_night, dates[i], telescope, v_mag, session, url, sky_ranges[i], cache, params, metrics, plans[i]): [i] for i, params in pending}
 
-        end_time = time.time()
-        date_str = date.strftime("%Y-%m-%d")
-        desc = f"Data for {date_str} written to file. {num_asteroids_day} asteroids observable. Time elapsed: {end_time - start_time:.2f} seconds. "
-        loop.set_description(desc, refresh=True)
+        for future in as_completed(futures):
+            results = future.result()
+            if isinstance(results, tuple):
+                results = [results]
+            for i, (file_name, num_asteroids_day, elapsed) in zip(futures[future], results):
+                files[i] = file_name
+                total_asteroids += num_asteroids_day
+                if plans[i] is not None:
+                    planned_rows += num_asteroids_day
+                    box_rows += plans[i].estimate_box_rows(num_asteroids_day)
+
+                date_str = dates[i].strftime("%Y-%m-%d")
+                desc = f"Data for {date_str} written to file. {num_asteroids_day} asteroids observable. Time elapsed: {elapsed:.2f} seconds. "
+                loop.set_description(desc, refresh=True)
+                loop.update(1)
+
+    if own_session:
+        session.close()
 
+    cache.save()
+    stats = {stat: count - start_stats[stat] for stat, count in cache.stats().items()}
     if total_asteroids != 0:
-        desc = f"Ephemera complete. Total of {total_asteroids} asteroids observable."
+        desc = f"Ephemera complete. Total of {total_asteroids} asteroids observable. "
     else:
         desc = "Ephemera complete. All dates have already been queried. "
+    desc += f"Query cache: {stats['hits']} hits, {stats['filtered_hits']} filtered hits, {stats['misses']} misses."
+    if planned_rows:
+        desc += f" Query plan: {planned_rows} rows from the observable tiles, against an estimated {box_rows} from the single box (from its area)."
     loop.set_description(desc, refresh=True)
     print(loop)
 
     return files
 
+def query_night(date: datetime, telescope: Telescope, v_mag: float, session: requests.Session = None, url: str = None, sky_range: tuple[float, float, float, float] = None, cache: QueryCache = None, params: dict = None, metrics: Metrics = None, plan: Plan = None) -> tuple[str, int, float]:
+    """ Query the database for every asteroid observable on a single night and write them to a file.
+    :param date: the date to query the database for
+    :param telescope: the telescope to use for the query
+    :param v_mag: the limiting magnitude of the query
+    :param session: the HTTP session to post the queries with
+    :param url: the GraphQL endpoint to query
+    :param sky_range: the precomputed sky range for the date. Computed from the telescope if not given.
+    :param cache: the query cache to store the results in, if any
+    :param params: the query parameters the results are cached under
+    :param metrics: the measurements of the run to record the night and its pages in, if any
+    :param plan: the tiles to query instead of the sky range, each into its own journal, if any
+    :return: the file name, the number of asteroids observable, and the time elapsed in seconds
+    """
+    start_time = time.time()
+
+    # Get the sky range for the given date
+    if sky_range is None:
+        sky_range = get_sky_range(date, telescope)
+
+    if params is None:
+        params = query_params(date, sky_range, v_mag, Query.fields)
+
+    if plan is None:
+        journals = [fetch_region(date, sky_range, v_mag, params, session, url, metrics=metrics)]
+    else:
+        # Each tile is paged into its own journal, so an interrupted night resumes tile by tile, and the tiles share each request
+        journals = fetch_regions([(date, tile, query_params(date, tile, v_mag, Query.fields)) for tile in plan.tiles], v_mag, session, url, metrics=metrics)
+
+    write_start = time.time()
+    file_name, num_asteroids = write_night(date, telescope, journals, params, cache)
+
+    end_time = time.time()
+    if metrics is not None:
+        metrics.night(params['date'], "query", num_asteroids, end_time - start_time, end_time - write_start)
+        if plan is not None:
+            record_plan(metrics, params['date'], plan, num_asteroids)
+    return file_name, num_asteroids, end_time - start_time
+
+def query_nights(dates: list[datetime], telescope: Telescope, v_mag: float, session: requests.Session, url: str, sky_ranges: list[tuple[float, float, float, float]], cache: QueryCache, params: list[dict], metrics: Metrics = None, plans: list[Plan] = None) -> list[tuple[str, int, float]]:
+    """ Query the database for several nights at once, packing the nights (and their tiles) into each request, and write each night to a file.
+    Per-request latency dominates small nights, so a week of nights costs about as many round trips as its largest night.
+    :param dates: the dates to query the database for
+    :param telescope: the telescope to use for the query
+    :param v_mag: the limiting magnitude of the query
+    :param session: the HTTP session to post the queries with
+    :param url: the GraphQL endpoint to query
+    :param sky_ranges: the sky range of each date
+    :param cache: the query cache to store the results in, if any
+    :param params: the query parameters each night's results are cached under
+    :param metrics: the measurements of the run to record the nights and their pages in, if any
+    :param plans: the tiles to query on each date instead of its sky range, if any
+    :return: the file name, the number of asteroids observable, and the time elapsed in seconds of each night.
+             The time spent paging is shared evenly between the nights.
+    """
+    start_time = time.time()
+    if plans is None:
+        plans = [None] * len(dates)
+
+    # One journal per night, or per tile of a planned night, each paged under its own alias
+    regions = []
+    nights = []
+    for i, date in enumerate(dates):
+        if plans[i] is None:
+            regions.append((date, sky_ranges[i], params[i]))
+            nights.append(i)
+        else:
+            for tile in plans[i].tiles:
+                regions.append((date, tile, query_params(date, tile, v_mag, Query.fields)))
+                nights.append(i)
+    journals = fetch_regions(regions, v_mag, session, url, metrics=metrics)
+    fetch_time = (time.time() - start_time) / len(dates)
+
+    results = []
+    for i, date in enumerate(dates):
+        write_start = time.time()
+        file_name, num_asteroids = write_night(date, telescope, [journal for journal, night in zip(journals, nights) if night == i], params[i], cache)
+
+        end_time = time.time()
+        seconds = fetch_time + end_time - write_start
+        if metrics is not None:
+            metrics.night(params[i]['date'], "query", num_asteroids, seconds, end_time - write_start)
+            if plans[i] is not None:
+                record_plan(metrics, params[i]['date'], plans[i], num_asteroids)
+        results.append((file_name, num_asteroids, seconds))
+    return results
+
+def write_night(date: datetime, telescope: Telescope, journals: list[Journal], params: dict, cache: QueryCache = None) -> tuple[str, int]:
+    """ Write the journals of a night to its observable file, cache the results and remove the journals.
+    :param date: the date of the night
+    :param telescope: the telescope the night was queried for
+    :param journals: the completed journals of the night, one per region queried
+    :param params: the query parameters the results are cached under
+    :param cache: the query cache to store the results in, if any
+    :return: the file name, and the number of asteroids observable
+    """
+    if len(journals) == 1:
+        # Write the results to a file, streaming them from the journal
+        file_name = journals[0].write(observable_file(date, telescope.slug))
+    else:
+        # Tiles share their edges, so an asteroid on one is returned twice. The journals are merged a chunk at a time.
+        with ObservableWriter(observable_file(date, telescope.slug)) as writer:
+            for rows in merge_journals(journals):
+                writer.write(rows)
+        file_name = writer.file_name
+    data = load_observable(file_name)
+
+    if cache is not None:
+        cache.store(params, data)
+    for journal in journals:
+        journal.remove()
+    return file_name, len(data)
+
+def select_nights(dates: list[datetime], telescope: Telescope, v_mag: float, sky_ranges: list[tuple[float, float, float, float]], workers: int = 1, metrics: Metrics = None, plans: list[Plan] = None) -> list[str]:
+    """ Select the asteroids observable on each night from the local mirror, and write them to files.
+    The query cache is not used, as selecting a night locally takes about as long as looking it up.
+    :param dates: the dates to select the asteroids for
+    :param telescope: the telescope to select the asteroids for
+    :param v_mag: the limiting magnitude
+    :param sky_ranges: the sky range of each date
+    :param workers: the number of nights to select concurrently
+    :param metrics: the measurements of the run to record each night in, if any
+    :param plans: the tiles to select from on each date instead of its sky range, if any
+    :return: a list of files containing the asteroids visible in the sky, one per date
+    """
+    mirror = Mirror()
+    files = [None] * len(dates)
+    total_asteroids = 0
+    box_rows = 0
+    if plans is None:
+        plans = [None] * len(dates)
+
+    loop = tqdm(total=len(dates), desc="Selecting from local mirror", leave=False)
+    # NumPy releases the GIL in the propogation, so nights can be selected concurrently
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(select_night, dates[i], telescope, v_mag, sky_ranges[i], mirror, metrics, plans[i]): i for i in range(len(dates))}
+        for future in as_completed(futures):
+            i = futures[future]
+            files[i], num_asteroids_day, box_rows_day, elapsed = future.result()
+            total_asteroids += num_asteroids_day
+            box_rows += box_rows_day
+
+            date_str = dates[i].strftime("%Y-%m-%d")
+            loop.set_description(f"Data for {date_str} written to file. {num_asteroids_day} asteroids observable. Time elapsed: {elapsed:.2f} seconds. ", refresh=True)
+            loop.update(1)
+
+    desc = f"Ephemera complete. Total of {total_asteroids} asteroids observable, selected from the local mirror of {len(mirror)} orbits."
+    if box_rows:
+        desc += f" Query plan: {total_asteroids} rows from the observable tiles, against {box_rows} from the single box."
+    loop.set_description(desc, refresh=True)
+    print(loop)
+    return files
+
+def select_night(date: datetime, telescope: Telescope, v_mag: float, sky_range: tuple[float, float, float, float], mirror: Mirror, metrics: Metrics = None, plan: Plan = None) -> tuple[str, int, int, float]:
+    """ Select the asteroids observable on a single night from the local mirror and write them to a file.
+    :param date: the date to select the asteroids for
+    :param telescope: the telescope to select the asteroids for
+    :param v_mag: the limiting magnitude
+    :param sky_range: the sky range of the date
+    :param mirror: the local mirror of the orbital elements
+    :param metrics: the measurements of the run to record the night in, if any
+    :param plan: the tiles to select from instead of the sky range, if any
+    :return: the file name, the number of asteroids observable, the number the plan's single box would have selected
+             (0 without a plan), and the time elapsed in seconds
+    """
+    start_time = time.time()
+    box_rows = 0
+    if plan is not None:
+        data, box_rows = mirror.select(date, sky_range, v_mag, plan=plan)
+    else:
+        data = mirror.select(date, sky_range, v_mag)
+
+    write_start = time.time()
+    file_name = write_observable(data, date, telescope.slug)
+
+    end_time = time.time()
+    if metrics is not None:
+        metrics.night(date.strftime("%Y-%m-%d"), "mirror", len(data), end_time - start_time, end_time - write_start)
+        if plan is not None:
+            record_plan(metrics, date.strftime("%Y-%m-%d"), plan, len(data), box_rows)
+    return file_name, len(data), box_rows, end_time - start_time
+
+def record_plan(metrics: Metrics, date: str, plan: Plan, rows: int, box_rows: int = None):
+    """ Record how a night's query plan compares with the single box it replaced.
+    :param metrics: the measurements of the run
+    :param date: the date of the night, YYYY-MM-DD
+    :param plan: the plan of the night
+    :param rows: the number of asteroids the plan returned
+    :param box_rows: the number of asteroids the box would have returned, if counted. Otherwise it is estimated from the areas.
+    """
+    estimated = box_rows is None
+    if estimated:
+        box_rows = plan.estimate_box_rows(rows)
+    metrics.record("plan", date=date, tiles=len(plan), rows=rows, box_rows=box_rows, rows_saved=box_rows - rows, estimated=estimated, area=plan.area, box_area=plan.box_area)
+
 def get_sky_range(date: datetime, telescope: Telescope) -> tuple[float, float, float, float]:
     """ Get the right ascension and declination range for the given date.
     :param date: the date to calculate the range for
     :param telescope: the telescope to calculate the range for
     :return: the right ascension and declination range for the given date (ra_min, ra_max, dec_min, dec_max)
     """
-    # Collect the right ascension range for the date
-    ra_min, ra_max = telescope.get_ra_range(date)
+    return get_sky_ranges(Time(date, scale='utc').reshape((1,)), telescope)[0]
+
+def get_sky_ranges(dates: Time, telescope: Telescope) -> list[tuple[float, float, float, float]]:
+    """ Get the right ascension and declination range for every date in one vectorized pass.
+    :param dates: the dates to calculate the ranges for
+    :param telescope: the telescope to calculate the ranges for
+    :return: the right ascension and declination range for each date (ra_min, ra_max, dec_min, dec_max)
+    """
+    # Collect the right ascension ranges for the dates
+    ra_min, ra_max = telescope.get_ra_ranges(dates)
     dec_min, dec_max = telescope.get_dec_range()
 
     # Add buffer to the ra and dec values, convert to radians
@@ -109,32 +367,27 @@ def get_sky_range(date: datetime, telescope: Telescope) -> tuple[float, float, f
     b_dec_min = (dec_min - 5) * np.pi / 180
     b_dec_max = (dec_max + 5) * np.pi / 180
 
-    return b_ra_min, b_ra_max, b_dec_min, b_dec_max
+    return [(float(r_min), float(r_max), b_dec_min, b_dec_max) for r_min, r_max in zip(b_ra_min, b_ra_max)]
 
-def log_obserbable_asteroids(data: list[dict], date: datetime, slug: str) -> str:
-    """ Write the observable asteroids to a file.
-    :param data: the data to write to the file
+def log_obserbable_asteroids(data: np.ndarray, date: datetime, slug: str) -> str:
+    """ Write the observable asteroids to a file in the columnar format.
+    :param data: the observable asteroids as a structured array (see pal.astorb.storage.flatten)
     :param date: the date the data was collected
+    :param slug: the telescope slug
+    :return: the file name
     """
-    # Create the file name
-    date_str = date.strftime("%Y-%m-%d")
-    file_name = f"pal/results/observable/{slug}_{date_str}.json"
+    return write_observable(data, date, slug)
 
-    # Write the data to the file
-    with open(file_name, 'w') as f:
-        json.dump(data, f, indent=4)
-
-    return file_name
-
-def already_queried(date: datetime, telescope: Telescope) -> bool:
-    """ Check if the data for the given date has already been queried.
+def already_queried(date: datetime, telescope: Telescope, params: dict, cache: QueryCache) -> str | bool:
+    """ Check if a query with the same parameters has already been made for the given date.
+    If so, the cached results are written to the date's observable file.
     :param date: the date to check
     :param telescope: the telescope to check
+    :param params: the query parameters returned by query_params
+    :param cache: the query cache to check
     :return: the file name if the data has already been queried, False otherwise
     """
-    date_str = date.strftime("%Y-%m-%d")
-    file_name = f"pal/results/observable/{telescope.slug}_{date_str}.json"
-    if os.path.exists(file_name):
-        return file_name
-    else:
-        return False
\ No newline at end of file
+    data = cache.lookup(params)
+    if data is None:
+        return False
+    return log_obserbable_asteroids(data, date, telescope.slug)
\ No newline at end of file
@@ -0,0 +1,253 @@
+from astropy.time import Time
+import astropy.units as u
+import math
+import numpy as np
+
+from pal.utils.telescope import Telescope
+
+"""
+    Contains the query planner, which finds the part of the sky a telescope can observe on a night and
+    covers it with a few wrap-safe RA/Dec tiles, each queried on its own (see pal.astorb.pipeline.query_night).
+
+    The single box the pipeline used to query spans the LST range of the night with a flat 5 degree buffer on
+    every side. Its right ascension is not wrapped, so a night whose LST range passes 360 degrees silently
+    loses the asteroids past it, and it ignores the altitude the telescope can point down to.
+    The planner instead takes, for each declination, the right ascensions that come within the telescope's
+    hour angle limit while above its altitude limit at some time during the night. It widens them by a margin
+    on the sky for the motion of the asteroids between the ephemeris epoch and the night, and merges strips of
+    declination into tiles while doing so adds little area. Has the functions:
+        plan_nights(): Plans the queries of every night at once.
+        union_tiles(): Covers the tiles of several telescopes with tiles that do not overlap, to query shared sky once.
+"""
+
+# Degrees on the sky the region is widened by, for asteroids moving into it between UTC midnight and the night
+MARGIN = 1.0
+# The buffer of the single box the pipeline queried before the planner
+BOX_BUFFER = 5.0
+# The declination step the region is computed at, in degrees
+STRIP_HEIGHT = 0.5
+# Tiles are merged while there are more than MAX_TILES, or while merging adds less than this fraction of the region's area
+MAX_TILES = 4
+MERGE_TOLERANCE = 0.02
+# Sidereal degrees per solar hour
+SIDEREAL_RATE = 15.041068640
+
+class Plan():
+    tiles = None
+    box = None
+    area = None
+    box_area = None
+
+    def __init__(self, tiles: list[tuple[float, float, float, float]], box: tuple[float, float, float, float]):
+        """ Describe the queries of a night.
+        :param tiles: the tiles to query (ra_min, ra_max, dec_min, dec_max) in radians, each with 0 <= ra_min <= ra_max <= 2 pi
+        :param box: the single box the pipeline queried before the planner, in radians, with its right ascension unwrapped
+        """
+        self.tiles = tiles
+        self.box = box
+        self.area = sum(tile_area(tile) for tile in tiles)
+        # Only the part of the box between 0 and 2 pi matches any asteroid
+        self.box_area = tile_area((max(box[0], 0.0), min(box[1], 2 * math.pi), box[2], box[3]))
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def contains(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        """ Check which positions are inside a tile of the plan.
+        :param ra: the right ascensions in radians, between 0 and 2 pi
+        :param dec: the declinations in radians
+        :return: whether each position is inside a tile
+        """
+        inside = np.zeros(np.shape(ra), dtype=bool)
+        for ra_min, ra_max, dec_min, dec_max in self.tiles:
+            inside |= (ra >= ra_min) & (ra <= ra_max) & (dec >= dec_min) & (dec <= dec_max)
+        return inside
+
+    def box_contains(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        """ Check which positions the single box query would have returned, with its unwrapped right ascension.
+        :param ra: the right ascensions in radians, between 0 and 2 pi
+        :param dec: the declinations in radians
+        :return: whether each position is inside the box
+        """
+        ra_min, ra_max, dec_min, dec_max = self.box
+        return (ra >= ra_min) & (ra <= ra_max) & (dec >= dec_min) & (dec <= dec_max)
+
+    def estimate_box_rows(self, rows: int) -> int:
+        """ Estimate the number of rows the single box would have returned, from the rows returned by the tiles,
+        assuming the asteroids are spread evenly over the sky. They cluster along the ecliptic, so this is rough;
+        where the positions are known, count them with box_contains instead.
+        :param rows: the number of rows returned by the tiles
+        :return: the estimated number of rows of the box
+        """
+        if self.area <= 0:
+            return rows
+        return int(round(rows * self.box_area / self.area))
+
+def plan_nights(dates: Time, telescope: Telescope) -> list[Plan]:
+    """ Plan the queries of every night at once.
+    :param dates: the dates to plan
+    :param telescope: the telescope to plan for
+    :return: the plan of each date
+    """
+    dates = Time(dates, scale='utc')
+    night_start, night_end, lst = telescope.get_nights(dates)
+    hours_start = (night_start - dates).to_value(u.hour)
+    hours_end = (night_end - dates).to_value(u.hour)
+    lst_start = lst.deg + hours_start * SIDEREAL_RATE
+    lst_end = lst.deg + hours_end * SIDEREAL_RATE
+
+    # A UTC day that starts and ends in the dark holds the end of one night and the start of the next, with daylight
+    # between. Its observable sky runs from the LST of the evening dusk, a sidereal day earlier, to that of the morning dawn.
+    split = np.nonzero((hours_start < 1 / 60) & (hours_end > 24 - 2 / 60))[0]
+    if len(split):
+        dawn, dusk = telescope.get_daylight(dates[split])
+        gap = ~np.isnan(dawn)
+        lst_start[split[gap]] = lst.deg[split[gap]] + dusk[gap] / 60 * SIDEREAL_RATE - 360
+        lst_end[split[gap]] = lst.deg[split[gap]] + dawn[gap] / 60 * SIDEREAL_RATE
+
+    edges, half_widths = region_half_widths(telescope.latitude, telescope.dec_min, telescope.dec_max, telescope.min_altitude, telescope.hour_angle_limit)
+
+    plans = []
+    for start, end, lst_deg, h_start, h_end in zip(lst_start, lst_end, lst.deg, hours_start, hours_end):
+        # The box queried before the planner, which advanced the LST at the solar rate
+        box = (
+            math.radians(lst_deg + h_start * 15 - BOX_BUFFER), math.radians(lst_deg + h_end * 15 + BOX_BUFFER),
+            math.radians(telescope.dec_min - BOX_BUFFER), math.radians(telescope.dec_max + BOX_BUFFER),
+        )
+        plans.append(Plan(plan_tiles(edges, half_widths, start, end), box))
+    return plans
+
+def region_half_widths(latitude: float, dec_min: float, dec_max: float, min_altitude: float, hour_angle_limit: float) -> tuple[np.ndarray, np.ndarray]:
+    """ Get how far either side of the LST range of a night the observable region reaches, in strips of declination.
+    :param latitude: the latitude of the telescope in degrees
+    :param dec_min: the lowest declination the telescope observes, in degrees
+    :param dec_max: the highest declination the telescope observes, in degrees
+    :param min_altitude: the lowest altitude the telescope observes at, in degrees
+    :param hour_angle_limit: the largest hour angle from the meridian the telescope observes at, in degrees
+    :return: the declination edges of the strips in degrees, and the half width of each strip in degrees of
+             right ascension (NaN where nothing is observable, 180 or more where every right ascension is)
+    """
+    low = max(dec_min - MARGIN, -90.0)
+    high = min(dec_max + MARGIN, 90.0)
+    edges = np.linspace(low, high, max(int(math.ceil((high - low) / STRIP_HEIGHT)), 1) + 1)
+
+    # The hour angle at which each declination sets below the altitude limit
+    dec = np.radians(np.clip(edges, dec_min, dec_max))
+    phi = math.radians(latitude)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_setting = (math.sin(math.radians(min_altitude)) - math.sin(phi) * np.sin(dec)) / (math.cos(phi) * np.cos(dec))
+    setting = np.degrees(np.arccos(np.clip(cos_setting, -1, 1)))
+    reach = np.where(cos_setting > 1, np.nan, np.minimum(setting, hour_angle_limit))
+    reach[(edges < dec_min - MARGIN) | (edges > dec_max + MARGIN)] = np.nan
+
+    # Asteroids up to MARGIN degrees away from the region can move into it, in declination and in right ascension
+    steps = int(math.ceil(MARGIN / STRIP_HEIGHT))
+    padded = np.pad(reach, steps, constant_values=np.nan)
+    with np.errstate(invalid='ignore'):
+        reach = np.nanmax(np.lib.stride_tricks.sliding_window_view(padded, 2 * steps + 1), axis=1) if np.isfinite(reach).any() else reach
+    cos_dec = np.maximum(np.cos(np.radians(edges)), 1e-6)
+    reach = reach + np.minimum(MARGIN / cos_dec, 180.0)
+
+    # Each strip reaches as far as the further of its edges
+    half_widths = np.fmax(reach[:-1], reach[1:])
+    return edges, half_widths
+
+def union_tiles(tiles: list[tuple[float, float, float, float]]) -> list[tuple[float, float, float, float]]:
+    """ Cover the union of several tiles with tiles that do not overlap, so that sky shared by the tiles is queried once.
+    The tiles are cut into bands at every declination edge, the right ascension spans of each band are merged,
+    and neighbouring bands with the same spans are joined again.
+    :param tiles: the tiles (ra_min, ra_max, dec_min, dec_max) in radians, each with 0 <= ra_min <= ra_max <= 2 pi
+    :return: the tiles covering their union, sharing at most their edges
+    """
+    edges = sorted({tile[2] for tile in tiles} | {tile[3] for tile in tiles})
+    union = []
+    group = None
+    for low, high in zip(edges[:-1], edges[1:]):
+        spans = []
+        for ra_min, ra_max in sorted((tile[0], tile[1]) for tile in tiles if tile[2] <= low and tile[3] >= high):
+            if spans and ra_min <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], ra_max))
+            else:
+                spans.append((ra_min, ra_max))
+
+        if group is not None and group[2] == spans:
+            group[1] = high
+            continue
+        if group is not None:
+            union.extend((ra_min, ra_max, group[0], group[1]) for ra_min, ra_max in group[2])
+        group = [low, high, spans]
+
+    if group is not None:
+        union.extend((ra_min, ra_max, group[0], group[1]) for ra_min, ra_max in group[2])
+    return union
+
+def plan_tiles(edges: np.ndarray, half_widths: np.ndarray, lst_start: float, lst_end: float) -> list[tuple[float, float, float, float]]:
+    """ Cover the observable region of a night with a few wrap-safe tiles.
+    :param edges: the declination edges of the strips, from region_half_widths
+    :param half_widths: the half width of each strip, from region_half_widths
+    :param lst_start: the LST at the start of the night in degrees
+    :param lst_end: the LST at the end of the night in degrees, unwrapped so that it follows lst_start
+    :return: the tiles (ra_min, ra_max, dec_min, dec_max) in radians
+    """
+    # Each run of observable strips starts as one tile per strip, as [ra_min, ra_max, dec_min, dec_max] in unwrapped degrees
+    tiles = []
+    runs = []
+    for i, half_width in enumerate(half_widths):
+        if np.isnan(half_width):
+            continue
+        tile = [lst_start - half_width, lst_end + half_width, edges[i], edges[i + 1]]
+        if tile[1] - tile[0] >= 360:
+            tile[0], tile[1] = lst_start - 180, lst_start + 180
+        if tiles and tiles[-1][3] == tile[2]:
+            runs[-1].append(len(tiles))
+        else:
+            runs.append([len(tiles)])
+        tiles.append(tile)
+
+    total_area = sum(degree_area(tile) for tile in tiles)
+    merged = [[tiles[i] for i in run] for run in runs]
+
+    # Merge the neighbouring tiles of a run that add the least area, until few enough remain and every merge would add much
+    while True:
+        best = None
+        for r, run in enumerate(merged):
+            for i in range(len(run) - 1):
+                union = merge(run[i], run[i + 1])
+                added = degree_area(union) - degree_area(run[i]) - degree_area(run[i + 1])
+                if best is None or added < best[0]:
+                    best = (added, r, i, union)
+        count = sum(len(run) for run in merged)
+        if best is None or (count <= MAX_TILES and best[0] > MERGE_TOLERANCE * total_area):
+            break
+        _, r, i, union = best
+        merged[r][i:i + 2] = [union]
+
+    return [wrapped for run in merged for tile in run for wrapped in wrap(tile)]
+
+def merge(first: list[float], second: list[float]) -> list[float]:
+    """ Get the smallest tile covering two tiles, in unwrapped degrees. """
+    return [min(first[0], second[0]), max(first[1], second[1]), min(first[2], second[2]), max(first[3], second[3])]
+
+def wrap(tile: list[float]) -> list[tuple[float, float, float, float]]:
+    """ Split a tile in unwrapped degrees into one or two tiles in radians between 0 and 2 pi. """
+    ra_min, ra_max, dec_min, dec_max = tile
+    dec_min, dec_max = math.radians(dec_min), math.radians(dec_max)
+    if ra_max - ra_min >= 360:
+        return [(0.0, 2 * math.pi, dec_min, dec_max)]
+
+    start = ra_min % 360
+    end = start + (ra_max - ra_min)
+    if end <= 360:
+        return [(math.radians(start), math.radians(end), dec_min, dec_max)]
+    return [(math.radians(start), 2 * math.pi, dec_min, dec_max), (0.0, math.radians(end - 360), dec_min, dec_max)]
+
+def degree_area(tile: list[float]) -> float:
+    """ Get the area of a tile in unwrapped degrees, in square degrees. """
+    return tile_area((math.radians(tile[0]), math.radians(tile[1]), math.radians(tile[2]), math.radians(tile[3])))
+
+def tile_area(tile: tuple[float, float, float, float]) -> float:
+    """ Get the area on the sky of a tile in radians, in square degrees. Right ascension spans of more than 2 pi count once. """
+    ra_min, ra_max, dec_min, dec_max = tile
+    dec_min, dec_max = max(dec_min, -math.pi / 2), min(dec_max, math.pi / 2)
+    width = min(max(ra_max - ra_min, 0.0), 2 * math.pi)
+    return max(width * (math.sin(dec_max) - math.sin(dec_min)), 0.0) * math.degrees(1) ** 2
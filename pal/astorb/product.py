@@ -0,0 +1,279 @@
+from datetime import datetime
+import json
+import numpy as np
+import os
+import struct
+import zlib
+
+"""
+    Contains the ephemeris product format, which stores a night of propogated positions in chunks.
+    A product file holds the night's asteroid columns (number, designation, magnitude) in one chunk each,
+    then the right ascension and declination of every asteroid at each time step in a chunk per step,
+    and ends with a small JSON index of where every chunk is. Chunks can be compressed, so reading one
+    time slice only seeks to and decompresses that step's chunk, never the whole night.
+
+    The layout of a file is:
+        MAGIC, the chunks, the index as JSON, the length of the index as 8 bytes, MAGIC
+    Has the classes:
+        ProductWriter: Streams a night to a product file, one time step (or block of steps) at a time.
+        EphemerisProduct: Reads the columns and time slices of a product file.
+    And the functions:
+        ephemera_file(): Gets the file name of a night's ephemeris product.
+        find_ephemera(): Finds a night's ephemera, written as a product or as an .npz file by earlier versions.
+        load_ephemera(): Loads a whole night of ephemera in either format.
+"""
+
+EPHEMERA_DIR = "pal/results/ephemera"
+MAGIC = b"PALEPH01"
+VERSION = 1
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+# The compression level of gzip chunks. Positions hardly compress further at higher levels, which are much slower.
+GZIP_LEVEL = 1
+COLUMNS = ('ast_number', 'designation', 'v_mag')
+
+def ephemera_file(date: datetime | str, slug: str) -> str:
+    """ Get the file name of a night's ephemeris product.
+    :param date: the date of the night, or its YYYY-MM-DD string
+    :param slug: the telescope slug
+    :return: the file name
+    """
+    date_str = date if isinstance(date, str) else date.strftime("%Y-%m-%d")
+    return os.path.join(EPHEMERA_DIR, f"{slug}_{date_str}.eph")
+
+def find_ephemera(date: datetime | str, slug: str) -> str:
+    """ Find a night's ephemera. Nights propogated before the product format are found as .npz files.
+    :param date: the date of the night, or its YYYY-MM-DD string
+    :param slug: the telescope slug
+    :return: the file name, which may not exist
+    """
+    file_name = ephemera_file(date, slug)
+    legacy = os.path.splitext(file_name)[0] + '.npz'
+    if not os.path.exists(file_name) and os.path.exists(legacy):
+        return legacy
+    return file_name
+
+def load_ephemera(file_name: str) -> dict[str, np.ndarray]:
+    """ Load a whole night of ephemera.
+    :param file_name: a product file, or an .npz file written before the product format
+    :return: the offsets, ast_number, designation, v_mag, ra and dec arrays. The positions are shaped (asteroids, time steps).
+    """
+    if file_name.endswith('.npz'):
+        with np.load(file_name) as f:
+            return dict(f)
+
+    with EphemerisProduct(file_name) as product:
+        ephemera = {name: product.column(name) for name in COLUMNS}
+        ephemera['offsets'] = product.offsets
+        ephemera['ra'], ephemera['dec'] = product.positions()
+    return ephemera
+
+class ProductWriter():
+    file_name = None
+    compression = None
+    index = None
+
+    def __init__(self, file_name: str, columns: dict[str, np.ndarray], offsets: np.ndarray, compression: str = 'none', **metadata):
+        """ Start writing a product file. It is written to a temporary file and only takes its name once closed,
+        so a reader never sees a partial night.
+        :param file_name: the product file
+        :param columns: the asteroid columns: ast_number, designation and v_mag
+        :param offsets: the time steps in minutes after the ephemeris epoch
+        :param compression: the compression of the chunks: 'none', 'gzip', or 'zstd' (needs the zstandard package)
+        :param metadata: other fields to keep in the index, such as the date and telescope slug
+        """
+        self.file_name = file_name
+        self.compress = compressor(compression)
+        self.compression = compression
+        self.rows = len(columns['ast_number'])
+        self.index = {
+            "version": VERSION, "compression": compression, "rows": self.rows,
+            "offsets": [float(offset) for offset in offsets], "columns": {}, "steps": [], **metadata,
+        }
+
+        self.file = open(f"{file_name}.tmp", 'wb')
+        self.file.write(MAGIC)
+        for name in COLUMNS:
+            self.index['columns'][name] = self._write_chunk(np.asarray(columns[name]))
+
+    def write_step(self, ra: np.ndarray, dec: np.ndarray):
+        """ Write the positions of every asteroid at the next time step.
+        :param ra: the right ascensions in radians
+        :param dec: the declinations in radians
+        """
+        if len(self.index['steps']) >= len(self.index['offsets']):
+            raise ValueError(f"Every one of the {len(self.index['offsets'])} time steps of {self.file_name} is already written.")
+        self.index['steps'].append(self._write_chunk(np.stack([ra, dec])))
+
+    def write_steps(self, ra: np.ndarray, dec: np.ndarray):
+        """ Write the positions of every asteroid at the next few time steps.
+        :param ra: the right ascensions in radians, shaped (asteroids, time steps)
+        :param dec: the declinations in radians, shaped (asteroids, time steps)
+        """
+        for step in range(ra.shape[1]):
+            self.write_step(ra[:, step], dec[:, step])
+
+    def close(self) -> str:
+        """ Write the index and give the file its name.
+        :return: the file name
+        """
+        if len(self.index['steps']) != len(self.index['offsets']):
+            raise ValueError(f"Only {len(self.index['steps'])} of the {len(self.index['offsets'])} time steps of {self.file_name} were written.")
+        index = json.dumps(self.index).encode()
+        self.file.write(index)
+        self.file.write(struct.pack('<Q', len(index)))
+        self.file.write(MAGIC)
+        self.file.close()
+        os.replace(f"{self.file_name}.tmp", self.file_name)
+        return self.file_name
+
+    def abort(self):
+        """ Stop writing and remove the temporary file. """
+        self.file.close()
+        if os.path.exists(f"{self.file_name}.tmp"):
+            os.remove(f"{self.file_name}.tmp")
+
+    def __enter__(self) -> 'ProductWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write_chunk(self, array: np.ndarray) -> dict:
+        array = np.ascontiguousarray(array)
+        data = array.tobytes() if self.compress is None else self.compress(shuffle(array))
+        chunk = {"offset": self.file.tell(), "length": len(data), "dtype": array.dtype.str, "shape": list(array.shape)}
+        self.file.write(data)
+        return chunk
+
+class EphemerisProduct():
+    file_name = None
+    index = None
+    offsets = None
+
+    def __init__(self, file_name: str):
+        """ Open a product file and read its index.
+        :param file_name: the product file
+        """
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        self.file.seek(-len(MAGIC) - 8, os.SEEK_END)
+        length, = struct.unpack('<Q', self.file.read(8))
+        if self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise ValueError(f"{file_name} is not an ephemeris product, or was not completely written.")
+        self.file.seek(-len(MAGIC) - 8 - length, os.SEEK_END)
+        self.index = json.loads(self.file.read(length))
+        self.decompress = decompressor(self.index['compression'])
+        self.offsets = np.array(self.index['offsets'])
+
+    def __len__(self) -> int:
+        return self.index['rows']
+
+    def column(self, name: str) -> np.ndarray:
+        """ Read an asteroid column.
+        :param name: ast_number, designation or v_mag
+        :return: the column
+        """
+        return self._read_chunk(self.index['columns'][name])
+
+    def step(self, step: int) -> tuple[np.ndarray, np.ndarray]:
+        """ Read the positions of every asteroid at one time step.
+        :param step: the index of the time step
+        :return: the right ascensions and declinations in radians
+        """
+        ra, dec = self._read_chunk(self.index['steps'][step])
+        return ra, dec
+
+    def at(self, offset: float) -> tuple[int, np.ndarray, np.ndarray]:
+        """ Read the positions of every asteroid at the time step nearest to a time.
+        :param offset: the time in minutes after the ephemeris epoch
+        :return: the index of the time step, and the right ascensions and declinations in radians
+        """
+        step = int(np.abs(self.offsets - offset).argmin())
+        return (step, *self.step(step))
+
+    def positions(self, steps: range | list[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """ Read the positions of every asteroid at several time steps.
+        :param steps: the indexes of the time steps. Default is every step.
+        :return: the right ascensions and declinations in radians, shaped (asteroids, time steps)
+        """
+        if steps is None:
+            steps = range(len(self.offsets))
+        ra = np.empty((len(self), len(steps)))
+        dec = np.empty((len(self), len(steps)))
+        for i, step in enumerate(steps):
+            ra[:, i], dec[:, i] = self.step(step)
+        return ra, dec
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> 'EphemerisProduct':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_chunk(self, chunk: dict) -> np.ndarray:
+        self.file.seek(chunk['offset'])
+        data = self.file.read(chunk['length'])
+        dtype = np.dtype(chunk['dtype'])
+        if self.decompress is None:
+            return np.frombuffer(data, dtype=dtype).reshape(chunk['shape'])
+        return unshuffle(self.decompress(data), dtype, chunk['shape'])
+
+def compressor(compression: str):
+    """ Get the function that compresses a chunk.
+    :param compression: 'none', 'gzip' or 'zstd'
+    :return: the function, or None if the chunks are not compressed
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}. Use one of {', '.join(COMPRESSIONS)}.")
+    if compression == 'gzip':
+        return lambda data: zlib.compress(data, GZIP_LEVEL)
+    if compression == 'zstd':
+        return zstandard().ZstdCompressor().compress
+    return None
+
+def decompressor(compression: str):
+    """ Get the function that decompresses a chunk.
+    :param compression: 'none', 'gzip' or 'zstd'
+    :return: the function, or None if the chunks are not compressed
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}. Use one of {', '.join(COMPRESSIONS)}.")
+    if compression == 'gzip':
+        return zlib.decompress
+    if compression == 'zstd':
+        return zstandard().ZstdDecompressor().decompress
+    return None
+
+def zstandard():
+    """ Import the zstandard package, which is only needed for zstd compression. """
+    try:
+        import zstandard
+    except ModuleNotFoundError:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard). Use gzip instead.") from None
+    return zstandard
+
+def shuffle(array: np.ndarray) -> bytes:
+    """ Group the bytes of an array by their position in each element, before compressing it.
+    The sign, exponent and leading bits of neighbouring positions are alike, so grouping them compresses better.
+    :param array: the array
+    :return: the shuffled bytes
+    """
+    itemsize = array.dtype.itemsize
+    return np.ascontiguousarray(array.reshape(-1).view(np.uint8).reshape(-1, itemsize).T).tobytes()
+
+def unshuffle(data: bytes, dtype: np.dtype, shape: list[int]) -> np.ndarray:
+    """ Undo shuffle.
+    :param data: the shuffled bytes
+    :param dtype: the data type of the array
+    :param shape: the shape of the array
+    :return: the array
+    """
+    grouped = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(grouped.T).view(dtype).reshape(shape)
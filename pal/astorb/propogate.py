@@ -1,10 +1,296 @@
+from astropy.time import Time
+import astropy.units as u
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime
+import numpy as np
+import os
+import time
+
+from pal.astorb.mirror import Mirror
+from pal.astorb.product import ProductWriter, ephemera_file
+from pal.astorb.storage import RATE_SCALE
+from pal.utils.asteroid import AsteroidTable
+from pal.utils.metrics import Metrics
+from pal.utils.shared import SharedArray
+from pal.utils.telescope import Telescope, get_telescope
 
 """
     This module contains the functions to propogate the on-sky positions of asteroids throughout the night.
+    A night's observable set is loaded into NumPy arrays, and the positions of every asteroid at every
+    time step are computed in a single broadcast operation: either by applying each asteroid's rates,
+    or, for nights selected from the local mirror, by two-body propogation of its orbit (see pal.astorb.kepler).
+
+    With several processes, the nights are split into blocks of time steps and tiles of rows, and propogated in a
+    process pool. The workers memory-map their inputs from the observable files and the mirror, and write their rows
+    of a block's positions straight into shared memory, so no arrays are pickled. Each block is streamed to its
+    night's product once all of its tiles are done, and as every row is computed on its own, the ephemera do not
+    depend on the number of processes.
+
+    The ephemera of each night are written as an ephemeris product (see pal.astorb.product), one chunk per time step.
+    In this process, a night is propogated a block of time steps at a time and each block streamed to its product,
+    so only a block of positions is ever held in memory.
 """
 
-# TODO: Check if cos(delta_ra) is correct
+# The number of asteroids in each tile of a night propogated by a worker process
+TILE_SIZE = 20000
+# The number of time steps of a night propogated at once, in this process or by the process pool
+STEP_BLOCK = 8
+# The most bytes of positions the process pool holds in shared memory at once
+MAX_SHARED_BYTES = 2**30
+
+def propogate(results: list[str], telescope: Telescope, interval: int = 15, metrics: Metrics = None, mirror: Mirror = None, processes: int = 1, tile_size: int = TILE_SIZE, compression: str = 'none') -> list[str]:
+    """ Propogate the positions of the observable asteroids throughout each night.
+    :param results: the list of observable asteroid files, one per night
+    :param telescope: the telescope the asteroids were queried for
+    :param interval: the time between propogation steps in minutes
+    :param metrics: the measurements of the run to record each stage of each night in, if any
+    :param mirror: the local mirror the nights were selected from, if any. The positions are then propogated
+                   along each asteroid's orbit and seen from the telescope, instead of along its rates.
+    :param processes: the number of processes to propogate the nights in. Default is 1, in this process.
+    :param tile_size: the number of asteroids in each tile of a night given to a process
+    :param compression: the compression of the ephemeris products: 'none', 'gzip' or 'zstd'
+    :return: a list of file paths to the ephemera
+    """
+    files = []
+    if not results:
+        return files
+
+    def stage(name, **fields):
+        return metrics.stage(name, **fields) if metrics is not None else nullcontext()
+
+    # Compute the twilight bounds of every night in one vectorized pass
+    dates = [date_from_file(file_name) for file_name in results]
+    with stage("night_geometry", nights=len(dates)):
+        starts, ends, _ = telescope.get_nights(Time(dates, format='datetime', scale='utc'))
+
+    if processes > 1:
+        return propogate_sharded(results, dates, starts, ends, telescope, interval, processes, tile_size, metrics, mirror, compression)
+
+    for file_name, date, start, end in zip(results, dates, starts, ends):
+        night_start, night_end = start.datetime, end.datetime
+        date_str = date.strftime("%Y-%m-%d")
+
+        with stage("load", date=date_str):
+            asteroids = AsteroidTable.load(file_name)
+        offsets = get_time_steps(date, night_start, night_end, interval)
+
+        # Propogation and writing alternate block by block, so their times are added up and recorded as two stages
+        propogate_time = write_time = 0
+        with ProductWriter(ephemera_file(date, telescope.slug), asteroids_columns(asteroids), offsets, compression, date=date_str, slug=telescope.slug) as writer:
+            for block in range(0, len(offsets), STEP_BLOCK):
+                block_start = time.perf_counter()
+                if mirror is not None:
+                    ra, dec = propogate_orbits(asteroids, offsets[block:block + STEP_BLOCK], date, telescope, mirror)
+                else:
+                    ra, dec = propogate_positions(asteroids, offsets[block:block + STEP_BLOCK])
+                write_start = time.perf_counter()
+                writer.write_steps(ra, dec)
+                propogate_time += write_start - block_start
+                write_time += time.perf_counter() - write_start
+        files.append(writer.file_name)
+
+        if metrics is not None:
+            metrics.record("stage", stage="propogate", date=date_str, rows=len(asteroids), seconds=propogate_time)
+            metrics.record("stage", stage="write_ephemera", date=date_str, seconds=write_time)
+
+    return files
+
+def propogate_sharded(results: list[str], dates: list[datetime], starts: Time, ends: Time, telescope: Telescope, interval: int, processes: int,
+                      tile_size: int = TILE_SIZE, metrics: Metrics = None, mirror: Mirror = None, compression: str = 'none', max_shared_bytes: int = MAX_SHARED_BYTES) -> list[str]:
+    """ Propogate the nights in a pool of processes, each night split into blocks of time steps and tiles of rows.
+    The blocks are streamed to the nights' products in order as they finish, and new blocks wait for earlier ones
+    to be written while the positions in shared memory would exceed max_shared_bytes.
+    :param results: the list of observable asteroid files, one per night
+    :param dates: the date of each night
+    :param starts: the start of each night
+    :param ends: the end of each night
+    :param telescope: the telescope the asteroids were queried for
+    :param interval: the time between propogation steps in minutes
+    :param processes: the number of processes
+    :param tile_size: the number of asteroids in each tile
+    :param metrics: the measurements of the run to record each night in, if any
+    :param mirror: the local mirror the nights were selected from, if any
+    :param compression: the compression of the ephemeris products
+    :param max_shared_bytes: the most bytes of positions held in shared memory at once. A block larger than this is still propogated, on its own.
+    :return: a list of file paths to the ephemera, in the order of the results
+    """
+    files = [None] * len(results)
+    nights = {}
+    blocks = {}
+    futures = {}
+    shared_bytes = 0
+    mirror_dir = mirror.mirror_dir if mirror is not None else None
+
+    def write_ready(i):
+        # Stream the finished blocks of a night to its product in order, and close it after the last one
+        nonlocal shared_bytes
+        night = nights[i]
+        while night['next'] in night['done']:
+            block = night['done'].pop(night['next'])
+            write_start = time.perf_counter()
+            night['writer'].write_steps(block['ra'].array, block['dec'].array)
+            night['write_time'] += time.perf_counter() - write_start
+            block['ra'].close()
+            block['dec'].close()
+            shared_bytes -= block['bytes']
+            night['next'] += STEP_BLOCK
+
+        if night['next'] >= len(night['offsets']):
+            nights.pop(i)
+            files[i] = night['writer'].close()
+            if metrics is not None:
+                date_str = dates[i].strftime("%Y-%m-%d")
+                metrics.record("stage", stage="propogate", date=date_str, rows=night['rows'], tiles=night['tiles'], seconds=time.perf_counter() - night['start'] - night['write_time'])
+                metrics.record("stage", stage="write_ephemera", date=date_str, seconds=night['write_time'])
+
+    def collect():
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            i, step = futures.pop(future)
+            future.result()
+            blocks[i, step]['remaining'] -= 1
+            if blocks[i, step]['remaining'] == 0:
+                nights[i]['done'][step] = blocks.pop((i, step))
+                write_ready(i)
+
+    executor = ProcessPoolExecutor(max_workers=processes)
+    try:
+        for i, (file_name, date, start, end) in enumerate(zip(results, dates, starts, ends)):
+            asteroids = AsteroidTable.load(file_name)
+            offsets = get_time_steps(date, start.datetime, end.datetime, interval)
+            tiles = range(0, len(asteroids), tile_size)
+            date_str = date.strftime("%Y-%m-%d")
+            nights[i] = {
+                'writer': ProductWriter(ephemera_file(date, telescope.slug), asteroids_columns(asteroids), offsets, compression, date=date_str, slug=telescope.slug),
+                'offsets': offsets, 'rows': len(asteroids), 'tiles': len(tiles), 'next': 0, 'done': {}, 'start': time.perf_counter(), 'write_time': 0,
+            }
+
+            for step in range(0, len(offsets), STEP_BLOCK):
+                shape = (len(asteroids), len(offsets[step:step + STEP_BLOCK]))
+                size = 2 * shape[0] * shape[1] * np.dtype(np.float64).itemsize
+                # Blocks in flight are held in shared memory until written, so only a bounded number of bytes is started ahead
+                while blocks and (shared_bytes + size > max_shared_bytes or len(blocks) >= 2 * processes):
+                    collect()
+
+                block = {'ra': SharedArray(shape), 'dec': SharedArray(shape), 'bytes': size, 'remaining': len(tiles)}
+                shared_bytes += size
+                if not tiles:
+                    nights[i]['done'][step] = block
+                    write_ready(i)
+                    continue
+
+                blocks[i, step] = block
+                for row in tiles:
+                    future = executor.submit(
+                        propogate_tile, file_name, date, offsets[step:step + STEP_BLOCK], row, min(row + tile_size, len(asteroids)),
+                        block['ra'].spec, block['dec'].spec, telescope.name, mirror_dir,
+                    )
+                    futures[future] = (i, step)
+
+        while futures:
+            collect()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        # Free the shared memory and remove the partial products of nights left unfinished by an error
+        for block in [*blocks.values(), *(block for night in nights.values() for block in night['done'].values())]:
+            block['ra'].close()
+            block['dec'].close()
+        for night in nights.values():
+            night['writer'].abort()
+
+    return files
+
+def propogate_tile(file_name: str, date: datetime, offsets: np.ndarray, start: int, stop: int, ra_spec: tuple, dec_spec: tuple, telescope: str, mirror_dir: str = None) -> int:
+    """ Propogate a tile of a night's asteroids in a worker process, writing the positions into the night's shared arrays.
+    :param file_name: the observable asteroid file of the night
+    :param date: the date of the night
+    :param offsets: the time steps in minutes after the ephemeris epoch
+    :param start: the first row of the tile
+    :param stop: the row after the last row of the tile
+    :param ra_spec: the spec of the night's shared right ascensions (see pal.utils.shared.SharedArray)
+    :param dec_spec: the spec of the night's shared declinations
+    :param telescope: the name of the telescope
+    :param mirror_dir: the directory of the local mirror to propogate the orbits from, if any
+    :return: the number of asteroids propogated
+    """
+    asteroids = AsteroidTable.load(file_name)[start:stop]
+    if mirror_dir is not None:
+        ra, dec = propogate_orbits(asteroids, offsets, date, get_telescope(telescope), Mirror(mirror_dir))
+    else:
+        ra, dec = propogate_positions(asteroids, offsets)
+
+    with SharedArray.attach(ra_spec) as shared_ra, SharedArray.attach(dec_spec) as shared_dec:
+        shared_ra.array[start:stop] = ra
+        shared_dec.array[start:stop] = dec
+    return stop - start
+
+def get_time_steps(date: datetime, night_start: datetime, night_end: datetime, interval: int) -> np.ndarray:
+    """ Get the propogation time steps for the night, relative to the ephemeris epoch.
+    :param date: the ephemeris epoch (UTC midnight of the query date)
+    :param night_start: the start of the astronomical night
+    :param night_end: the end of the astronomical night
+    :param interval: the time between propogation steps in minutes
+    :return: the time steps in minutes after the ephemeris epoch
+    """
+    start = (night_start - date).total_seconds() / 60
+    end = (night_end - date).total_seconds() / 60
+    return np.arange(start, end + interval / 2, interval, dtype=np.float64)
+
+def propogate_positions(asteroids: AsteroidTable, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Propogate the positions of every asteroid to every time step.
+    :param asteroids: the observable asteroids
+    :param offsets: the time steps in minutes after the ephemeris epoch
+    :return: the right ascension and declination in radians, each of shape (n_asteroids, n_steps)
+    """
+    dec = asteroids['dec'][:, None]
+    # The RA rate is the on-sky rate (dRA/dt * cos(dec)), so it is divided by cos(dec) before being applied
+    ra_rate = asteroids['ra_rate'][:, None] * RATE_SCALE / np.cos(dec)
+    dec_rate = asteroids['dec_rate'][:, None] * RATE_SCALE
+    steps = offsets[None, :]
+
+    ra = np.mod(asteroids['ra'][:, None] + ra_rate * steps, 2 * np.pi)
+    dec = np.clip(dec + dec_rate * steps, -np.pi / 2, np.pi / 2)
+
+    return ra, dec
+
+def propogate_orbits(asteroids: AsteroidTable, offsets: np.ndarray, date: datetime, telescope: Telescope, mirror: Mirror) -> tuple[np.ndarray, np.ndarray]:
+    """ Propogate the orbit of every asteroid to every time step, as seen from the telescope.
+    :param asteroids: the observable asteroids, each of which must be in the mirror
+    :param offsets: the time steps in minutes after the ephemeris epoch
+    :param date: the ephemeris epoch
+    :param telescope: the telescope the asteroids are seen from
+    :param mirror: the local mirror of the orbital elements
+    :return: the right ascension and declination in radians, each of shape (n_asteroids, n_steps)
+    """
+    times = Time(date, scale='utc') + offsets * u.min
+    ra, dec, _ = mirror.orbits(asteroids['ast_number']).observe(times, telescope.location, magnitudes=False)
+    return ra, dec
+
+def log_ephemera(asteroids: AsteroidTable, offsets: np.ndarray, ra: np.ndarray, dec: np.ndarray, date: datetime, slug: str, compression: str = 'none') -> str:
+    """ Write the propogated positions of a night to its ephemeris product.
+    :param asteroids: the observable asteroids
+    :param offsets: the time steps in minutes after the ephemeris epoch
+    :param ra: the propogated right ascensions
+    :param dec: the propogated declinations
+    :param date: the ephemeris epoch
+    :param slug: the telescope slug
+    :param compression: the compression of the product: 'none', 'gzip' or 'zstd'
+    :return: the file name
+    """
+    date_str = date.strftime("%Y-%m-%d")
+    with ProductWriter(ephemera_file(date_str, slug), asteroids_columns(asteroids), offsets, compression, date=date_str, slug=slug) as writer:
+        writer.write_steps(ra, dec)
+    return writer.file_name
+
+def asteroids_columns(asteroids: AsteroidTable) -> dict[str, np.ndarray]:
+    """ Get the columns of the observable asteroids kept in their ephemeris product. """
+    return {"ast_number": asteroids['ast_number'], "designation": asteroids['designation'], "v_mag": asteroids['v_mag']}
 
-def propogate(results):
-    ephemera = results
-    return ephemera
\ No newline at end of file
+def date_from_file(file_name: str) -> datetime:
+    """ Get the date of a night from its observable asteroid file name.
+    :param file_name: a file name of the form {slug}_{YYYY-MM-DD}.npy
+    :return: the date as a datetime at UTC midnight
+    """
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    return datetime.strptime(stem.rsplit('_', 1)[1], '%Y-%m-%d')
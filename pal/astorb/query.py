@@ -1,28 +1,73 @@
 import requests
+from requests.adapters import HTTPAdapter
 import time
 
+from pal.astorb.throttle import CircuitOpen, ConnectionFailed, QueryError, QueryTimeout, Throttle, check_response, get_throttle
+
 """
     Contains the Query class, which is used to build and post queries to the AstorbDB GraphQL API.
     Has the functions:
         __init__(): Initializes the Query object with the API url.
         build_query(): Builds the query based on the inputs.
-        get_results(): Posts the query and stores the results in the query object.
+        build_batch(): Builds one query packing several selections, each under its own alias.
+        get_results(): Posts the query and stores the results in the query object, along with its latency,
+                       size and number of retries.
+    And the function:
+        create_session(): Creates a pooled HTTP session that can be shared between queries.
 """
 
+API_URL = 'https://astorbdb.lowell.edu/v1/graphql'
+
+def create_session(pool_size: int = 1) -> requests.Session:
+    """ Creates an HTTP session with keep-alive connections that can be shared between queries.
+    :param pool_size: The maximum number of simultaneous connections to the API.
+    :return: The session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class Query():
+    # The fields selected for each ephemeris row
+    fields = """minorplanet {
+                ast_number
+                designameByIdDesignationPrimary {
+                    str_designame
+                }
+                }
+                ra
+                ra_rate
+                dec
+                dec_rate
+                v_mag"""
     url = None
+    session = None
+    throttle = None
     query = None
     response = None
     data = None
+    # Measurements of the last call of get_results
+    retries = 0
+    latency = None
+    bytes_received = 0
+    decode_time = None
 
 
-    def __init__(self):
-        """ Initializes the Query object with the API url."""
-        self.url = 'https://astorbdb.lowell.edu/v1/graphql'
+    def __init__(self, url: str = None, session: requests.Session = None, throttle: Throttle = None):
+        """ Initializes the Query object with the API url.
+        :param url: The GraphQL endpoint. Defaults to the AstorbDB API.
+        :param session: A session to post the query with. A new session is created if none is given.
+        :param throttle: The rate limit and retry policy to post with. Defaults to the one shared by every query to the url.
+        """
+        self.url = url if url is not None else API_URL
+        self.session = session if session is not None else requests.Session()
+        self.throttle = throttle if throttle is not None else get_throttle(self.url)
     
 
     # Builds the query based on the inputs
-    def build_query(self, ra_min, ra_max, dec_min, dec_max, date, mag_lim, last_id=0):
+    def build_query(self, ra_min, ra_max, dec_min, dec_max, date, mag_lim, last_id=0, mag_min=None):
         """ Builds the GraphQL query based on the inputs.
         :param ra_min: The minimum right ascension.
         :param ra_max: The maximum right ascension.
@@ -31,62 +76,103 @@ class Query():
         :param date: The date of the observation.
         :param mag_lim: The magnitude limit.
         :param last_id: The last asteroid id to continue the query
+        :param mag_min: The optional bright magnitude limit, to select a magnitude shell.
         """ 
         self.query = f"""query ExampleQuery {{
-            ephemeris(
+            {self.selection(ra_min, ra_max, dec_min, dec_max, date, mag_lim, last_id, mag_min)}
+        }}"""
+
+    def build_batch(self, selections):
+        """ Builds one GraphQL query packing several ephemeris selections, for different dates or regions of the sky.
+        Each selection is answered under its own alias in the response data, and pages from its own last asteroid id.
+        :param selections: The arguments of build_query for each selection, by alias.
+        """
+        aliased = "\n            ".join(f"{alias}: {self.selection(**arguments)}" for alias, arguments in selections.items())
+        self.query = f"""query BatchQuery {{
+            {aliased}
+        }}"""
+
+    def selection(self, ra_min, ra_max, dec_min, dec_max, date, mag_lim, last_id=0, mag_min=None):
+        """ Builds the ephemeris selection of a query. The arguments are those of build_query.
+        :return: The selection, with its filters and fields.
+        """
+        v_mag = f'_lte: "{mag_lim}"' if mag_min is None else f'_gte: "{mag_min}", _lte: "{mag_lim}"'
+        return f"""ephemeris(
                 where: {{
                 eph_date: {{_eq: "{date}"}},
                 ra:       {{_gte: "{ra_min}", _lte: "{ra_max}"}}, 
                 dec:      {{_gte: "{dec_min}", _lte: "{dec_max}"}},
-                v_mag:    {{_lte: "{mag_lim}"}},
+                v_mag:    {{{v_mag}}},
                 minorplanet: {{ast_number: {{_gt: "{last_id}" }} }}
                 }}
                 order_by: {{id_minorplanet: asc}}
             ) {{
-                minorplanet {{
-                ast_number
-                designameByIdDesignationPrimary {{
-                    str_designame
-                }}
-                }}
-                ra
-                ra_rate
-                dec
-                dec_rate
-                v_mag
-            }}
-        }}"""
+                {self.fields}
+            }}"""
     
 
     # Posts the query and returns the results
-    def get_results(self, max_retries=5):
+    def get_results(self, max_retries=None):
         """ Posts the query and stores the results in the query object.
-        :param max_retries: The maximum number of retries for the query.
+        Requests are rate limited, timed out and retried with backoff by the endpoint's shared throttle (see throttle.py).
+        :param max_retries: The maximum number of times the query is posted. Defaults to the throttle's setting.
+                            Waits for an open circuit breaker are not counted, as nothing is posted.
+        :raises QueryError: The typed error of the last attempt, carrying its underlying exception, once every attempt has failed.
         """
-        retry_count = 0
-        try:
-            # Retry the request if it fails
-            while retry_count < max_retries:
+        throttle = self.throttle
+        if max_retries is None:
+            max_retries = throttle.max_retries
+        self.retries = 0
+        self.bytes_received = 0
+
+        error = None
+        attempt = 0
+        while True:
+            self.retries = attempt
+            probe = False
+            try:
+                probe = throttle.before_request()
+
                 # Post the query
-                self.response = requests.post(
-                    "https://astorbdb.lowell.edu/v1/graphql",
-                    json={"query": self.query},
-                )
-
-                # Check if the response is successful and not empty
-                if self.response.status_code == 200:
-                    try:
-                        self.data = self.response.json()
-                        if self.data:
-                            return # Return if the response is successful
-                        else:
-                            print("Received empty JSON response. Retrying...")
-                    except ValueError:  # includes simplejson.decoder.JSONDecodeError
-                        print("Failed to decode JSON. Retrying...")
-                else:
-                    print(f"Request failed with status code: ", self.response.status_code)
-
-                retry_count += 1
-                time.sleep(1 + retry_count)  # Wait for 1+ seconds before retrying, to not overwhelm the server
-        except Exception as e:
-            raise IOError("Error posting query: {e}")
+                start = time.perf_counter()
+                try:
+                    self.response = self.session.post(
+                        self.url,
+                        json={"query": self.query},
+                        timeout=throttle.timeout,
+                    )
+                except requests.Timeout as e:
+                    raise QueryTimeout(f"Request timed out: {e}", cause=e) from e
+                except requests.RequestException as e:
+                    raise ConnectionFailed(f"Error posting query: {e}", cause=e) from e
+                self.latency = time.perf_counter() - start
+                self.bytes_received += len(self.response.content)
+
+                # Check the response is successful, and decode it
+                start = time.perf_counter()
+                self.data = check_response(self.response)
+                self.decode_time = time.perf_counter() - start
+
+                throttle.record_success()
+                return
+            except CircuitOpen as e:
+                # Wait for the circuit to let a probe through. Nothing was posted, so it is not counted as an attempt.
+                print(f"{e} Retrying in {e.retry_after:.1f} seconds...")
+                time.sleep(e.retry_after)
+                continue
+            except QueryError as e:
+                if not e.retryable:
+                    raise
+                error = e
+                throttle.record_failure(e)
+                delay = throttle.backoff(attempt, e.retry_after)
+            finally:
+                # A probe that ended in any other way must not leave the circuit open for good
+                if probe:
+                    throttle.release()
+
+            attempt += 1
+            if attempt >= max_retries:
+                raise error
+            print(f"{error} Retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
@@ -0,0 +1,175 @@
+from astropy.time import Time
+import astropy.units as u
+import numpy as np
+import os
+import requests
+import time
+
+from pal.astorb.cache import QueryCache, query_key, query_params
+from pal.astorb.index import angular_distance
+from pal.astorb.journal import JOURNAL_DIR, fetch_region
+from pal.astorb.propogate import propogate_positions
+from pal.astorb.query import Query
+from pal.astorb.storage import OBSERVABLE_DTYPE, write_observable
+from pal.utils.asteroid import AsteroidTable
+from pal.utils.metrics import Metrics
+from pal.utils.telescope import Telescope
+
+"""
+    Contains the functions to reuse one AstorbDB query across several consecutive nights.
+    An anchor night is queried over the sky ranges of the whole run of nights, and the nights after it
+    are predicted locally by propogating the anchor positions forward with their rates. Only the asteroids
+    near the edges of each night's field, or near its limiting magnitude, are queried again to correct
+    for drift. The drift measured on those asteroids decides when a new anchor night is needed.
+"""
+
+# Width of the field edges that are re-queried on predicted nights, in radians
+MARGIN = np.radians(0.5)
+# Width of the magnitude shell below the limiting magnitude that is re-queried on predicted nights
+MAG_MARGIN = 0.5
+
+def query_run(dates: Time, sky_ranges: list[tuple[float, float, float, float]], telescope: Telescope, v_mag: float, reuse: int, tolerance: float = None, session: requests.Session = None, url: str = None, cache: QueryCache = None, metrics: Metrics = None) -> list[tuple[str, int, float]]:
+    """ Query a run of consecutive nights, reusing each anchor query for up to `reuse` nights.
+    :param dates: the consecutive dates of the run
+    :param sky_ranges: the sky range of each date
+    :param telescope: the telescope to use for the query
+    :param v_mag: the limiting magnitude of the query
+    :param reuse: the largest number of nights one query is used for
+    :param tolerance: the largest predicted position error in arcseconds before a new anchor night is queried
+    :param session: the HTTP session to post the queries with
+    :param url: the GraphQL endpoint to query
+    :param cache: the query cache to store the anchor nights in, if any
+    :param metrics: the measurements of the run to record each night and page in, if any
+    :return: the file name, number of asteroids observable, and time elapsed in seconds for each date
+    """
+    results = []
+    i = 0
+    while i < len(dates):
+        start_time = time.time()
+        block = range(i, min(i + reuse, len(dates)))
+
+        # Query the anchor night over the union of the block's fields, widened by the margin
+        box = (
+            min(sky_ranges[j][0] for j in block) - MARGIN,
+            max(sky_ranges[j][1] for j in block) + MARGIN,
+            min(sky_ranges[j][2] for j in block) - MARGIN,
+            max(sky_ranges[j][3] for j in block) + MARGIN,
+        )
+        anchor_params = query_params(dates[i], box, v_mag, Query.fields)
+        journal = fetch_region(dates[i], box, v_mag, anchor_params, session, url, metrics=metrics)
+        anchor_file = journal.write(os.path.join(JOURNAL_DIR, f"{query_key(anchor_params)}.npy"))
+        journal.remove()
+        anchor = AsteroidTable.load(anchor_file)
+
+        # The anchor night itself is exactly what a query over its own field would return
+        night = in_box(anchor.ra, anchor.dec, sky_ranges[i])
+        data = anchor[night].to_records()
+        write_start = time.time()
+        if cache is not None:
+            cache.store(query_params(dates[i], sky_ranges[i], v_mag, Query.fields), data)
+        results.append((write_observable(data, dates[i], telescope.slug), len(data), time.time() - start_time))
+        if metrics is not None:
+            metrics.night(anchor_params['date'], "anchor", len(data), results[-1][2], time.time() - write_start)
+
+        # Predict the following nights until the block ends or the drift grows past the tolerance
+        error = None
+        j = i + 1
+        while j < block.stop:
+            nights = (dates[j] - dates[i]).to_value(u.day)
+            if tolerance is not None and error is not None:
+                measured_error, measured_nights = error
+                if measured_error * (nights / measured_nights)**2 > tolerance:
+                    break
+
+            start_time = time.time()
+            margin = MARGIN
+            if error is not None:
+                # Widen the re-queried edges if the drift is larger than the margin
+                margin = max(MARGIN, 3 * np.radians(error[0] / 3600) * (nights / error[1])**2)
+
+            data, measured_error = predict_night(anchor, dates[i], dates[j], sky_ranges[j], v_mag, margin, session, url, metrics)
+            if measured_error is not None:
+                error = (measured_error, nights)
+            write_start = time.time()
+            results.append((write_observable(data, dates[j], telescope.slug), len(data), time.time() - start_time))
+            if metrics is not None:
+                metrics.night(dates[j].strftime("%Y-%m-%d"), "predicted", len(data), results[-1][2], time.time() - write_start)
+            j += 1
+
+        del anchor
+        os.remove(anchor_file)
+        i = j
+
+    return results
+
+def predict_night(anchor: AsteroidTable, anchor_date: Time, date: Time, sky_range: tuple[float, float, float, float], v_mag: float, margin: float, session: requests.Session = None, url: str = None, metrics: Metrics = None) -> tuple[np.ndarray, float]:
+    """ Predict a night's observable asteroids from an anchor night, re-querying the field edges and magnitude shell.
+    :param anchor: the asteroids of the anchor night, over a field covering this night's
+    :param anchor_date: the date of the anchor night
+    :param date: the date to predict
+    :param sky_range: the sky range of the date
+    :param v_mag: the limiting magnitude
+    :param margin: the width of the field edges to re-query, in radians
+    :param session: the HTTP session to post the queries with
+    :param url: the GraphQL endpoint to query
+    :param metrics: the measurements of the run to record each page in, if any
+    :return: the observable asteroids as a structured array, and the drift measured on the re-queried asteroids in arcseconds
+    """
+    ra_min, ra_max, dec_min, dec_max = sky_range
+    interior = (ra_min + margin, ra_max - margin, dec_min + margin, dec_max - margin)
+    if interior[0] >= interior[1] or interior[2] >= interior[3]:
+        regions = [(sky_range, None)]
+    else:
+        regions = [
+            # The four edges of the field, at every magnitude
+            ((ra_min, interior[0], dec_min, dec_max), None),
+            ((interior[1], ra_max, dec_min, dec_max), None),
+            ((interior[0], interior[1], dec_min, interior[2]), None),
+            ((interior[0], interior[1], interior[3], dec_max), None),
+            # The magnitude shell inside the field
+            (interior, v_mag - MAG_MARGIN),
+        ]
+
+    # Query the regions where the prediction is not trusted
+    actual = []
+    for region, mag_min in regions:
+        params = query_params(date, region, v_mag, Query.fields, mag_min=mag_min)
+        journal = fetch_region(date, region, v_mag, params, session, url, mag_min=mag_min, metrics=metrics)
+        actual.append(journal.read())
+        journal.remove()
+    actual = np.concatenate(actual)
+    _, unique = np.unique(actual['ast_number'], return_index=True)
+    actual = actual[unique]
+
+    # Propogate the anchor positions to the date, and trust them inside the field and away from the magnitude limit
+    minutes = (date - anchor_date).to_value(u.minute)
+    ra, dec = propogate_positions(anchor, np.array([minutes]))
+    ra, dec = ra[:, 0], dec[:, 0]
+    trusted = in_box(ra, dec, interior) & (anchor.v_mag <= v_mag - MAG_MARGIN)
+    trusted &= ~np.isin(anchor.ast_number, actual['ast_number'])
+
+    predicted = anchor[trusted].to_records()
+    predicted['ra'] = ra[trusted]
+    predicted['dec'] = dec[trusted]
+
+    # Measure the drift on the asteroids that were both predicted and re-queried
+    _, in_anchor, in_actual = np.intersect1d(anchor.ast_number, actual['ast_number'], return_indices=True)
+    measured_error = None
+    if len(in_anchor):
+        drift = angular_distance(ra[in_anchor], dec[in_anchor], actual['ra'][in_actual], actual['dec'][in_actual])
+        measured_error = float(np.degrees(np.percentile(drift, 95)) * 3600)
+
+    data = np.concatenate([predicted, actual]).astype(OBSERVABLE_DTYPE)
+    data = data[np.argsort(data['ast_number'], kind='stable')]
+
+    return data, measured_error
+
+def in_box(ra: np.ndarray, dec: np.ndarray, sky_range: tuple[float, float, float, float]) -> np.ndarray:
+    """ Test which positions fall inside a sky range, with the same bounds the database query applies.
+    :param ra: the right ascensions in radians
+    :param dec: the declinations in radians
+    :param sky_range: the sky range (ra_min, ra_max, dec_min, dec_max) in radians
+    :return: a boolean array, True where the position is inside
+    """
+    ra_min, ra_max, dec_min, dec_max = sky_range
+    return (ra >= ra_min) & (ra <= ra_max) & (dec >= dec_min) & (dec <= dec_max)
@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, nullcontext
+from datetime import datetime
+import numpy as np
+import requests
+import time
+from tqdm import tqdm
+from typing import Iterable
+
+from pal.astorb.cache import QueryCache, query_params
+from pal.astorb.journal import Journal, fetch_regions, merge_journals
+from pal.astorb.mirror import Mirror
+from pal.astorb.planner import plan_nights, union_tiles
+from pal.astorb.query import Query, create_session
+from pal.astorb.storage import ObservableWriter, load_observable, observable_file, write_observable
+from pal.utils.metrics import Metrics
+from pal.utils.telescope import Telescope
+
+"""
+    Contains the batch mode of the pipeline for several telescopes at once.
+    The positions returned by AstorbDB are geocentric, so a row is the same whichever site asked for it.
+    For each date, the tiles planned for every telescope (see pal.astorb.planner) are merged into tiles that
+    do not overlap, and those are queried once at the deepest limiting magnitude of the telescopes.
+    The rows are then fanned out to each telescope, keeping those inside its own tiles and brighter than
+    its own limiting magnitude, which are exactly the rows its own query would have returned. Sky seen by
+    several sites is only queried once, so a batch costs about as much as its largest site.
+    Has the function:
+        query_sites(): Finds the observable asteroids of several telescopes on every date, sharing the queries.
+"""
+
+def query_sites(dates: list[datetime], telescopes: list[Telescope], mag_lim: bool, workers: int = 1, url: str = None, session: requests.Session = None, metrics: Metrics = None, source: str = 'remote', batch: int = 1) -> dict[str, list[str]]:
+    """ Find the asteroids observable by several telescopes on every date, querying the sky they share only once.
+    :param dates: the dates to query the database for
+    :param telescopes: the telescopes to find the asteroids for
+    :param mag_lim: whether to apply each telescope's limiting magnitude
+    :param workers: the number of requests to make concurrently
+    :param url: the GraphQL endpoint to query. Defaults to the AstorbDB API.
+    :param session: the HTTP session to post the queries with. A pooled session is created and closed if none is given.
+    :param metrics: the measurements of the run to record each night and page in, if any
+    :param source: where to find the asteroids: 'remote' to query AstorbDB, or 'local' to select them from the local mirror
+    :param batch: the number of nights packed into each request to the database
+    :return: the files of each telescope's observable asteroids, one per date, by telescope name
+    """
+    if source not in ('remote', 'local'):
+        raise ValueError(f"Unknown source: {source}. Use 'remote' or 'local'.")
+
+    v_mags = {telescope.name: telescope.mag_lim if mag_lim else 30 for telescope in telescopes}
+    v_mag = max(v_mags.values())
+
+    with metrics.stage("sky_ranges", nights=len(dates), telescopes=len(telescopes)) if metrics is not None else nullcontext():
+        plans = {telescope.name: plan_nights(dates, telescope) for telescope in telescopes}
+    regions = [union_tiles([tile for telescope in telescopes for tile in plans[telescope.name][i].tiles]) for i in range(len(dates))]
+
+    # Each site's night is cached as its own planned query would be, so later single-site runs reuse it
+    cache = QueryCache()
+    params = {
+        telescope.name: [query_params(date, plan.box, v_mags[telescope.name], Query.fields, tiles=plan.tiles) for date, plan in zip(dates, plans[telescope.name])]
+        for telescope in telescopes
+    }
+    files = {telescope.name: [None] * len(dates) for telescope in telescopes}
+    received_rows = site_rows = 0
+
+    loop = tqdm(total=len(dates), desc="Querying database for every site", leave=False)
+    pending = []
+    for i, date in enumerate(dates):
+        cached = {telescope.name: cache.lookup(params[telescope.name][i]) for telescope in telescopes} if source == 'remote' else {}
+        if cached and all(data is not None for data in cached.values()):
+            for telescope in telescopes:
+                files[telescope.name][i] = write_observable(cached[telescope.name], date, telescope.slug)
+            loop.set_description(f"Data for {date.strftime('%Y-%m-%d')} already queried for every site. Skipping.", refresh=True)
+            loop.update(1)
+        else:
+            pending.append(i)
+
+    def fan_out(i: int, chunks: Iterable[np.ndarray], seconds: float):
+        """ Write the rows of the shared regions of a night to the observable file of each site, a chunk at a time. """
+        nonlocal received_rows, site_rows
+        date_str = dates[i].strftime("%Y-%m-%d")
+        write_start = time.time()
+        rows = 0
+        with ExitStack() as stack:
+            writers = {telescope.name: stack.enter_context(ObservableWriter(observable_file(dates[i], telescope.slug))) for telescope in telescopes}
+            for data in chunks:
+                rows += len(data)
+                for telescope in telescopes:
+                    inside = plans[telescope.name][i].contains(data['ra'], data['dec']) & (data['v_mag'] <= v_mags[telescope.name])
+                    writers[telescope.name].write(data[inside])
+
+        for telescope in telescopes:
+            files[telescope.name][i] = writers[telescope.name].file_name
+            if source == 'remote':
+                cache.store(params[telescope.name][i], load_observable(files[telescope.name][i]))
+            if metrics is not None:
+                metrics.record("site", date=date_str, telescope=telescope.name, rows=writers[telescope.name].rows, tiles=len(plans[telescope.name][i]))
+            site_rows += writers[telescope.name].rows
+        received_rows += rows
+
+        if metrics is not None:
+            write_time = time.time() - write_start
+            metrics.night(date_str, "shared" if source == 'remote' else "mirror", rows, seconds + write_time, write_time)
+        loop.set_description(f"Data for {date_str} written for {len(telescopes)} sites. {rows} asteroids in the shared regions. ", refresh=True)
+        loop.update(1)
+
+    if source == 'local':
+        mirror = Mirror()
+        # NumPy releases the GIL in the propogation, so nights can be selected concurrently
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(select_regions, mirror, dates[i], regions[i], v_mag): i for i in pending}
+            for future in as_completed(futures):
+                data, seconds = future.result()
+                fan_out(futures[future], [data], seconds)
+    else:
+        own_session = session is None
+        if own_session:
+            session = create_session(workers)
+
+        # Pack the pending dates into each request, batch nights at a time, each region of a night under its own alias
+        chunks = [pending[j:j + batch] for j in range(0, len(pending), batch)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch_shared, dates[chunk], [regions[i] for i in chunk], v_mag, session, url, metrics): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                for i, (journals, seconds) in zip(futures[future], future.result()):
+                    # Regions share their edges, so an asteroid on one is returned twice. The merge drops the copies.
+                    fan_out(i, merge_journals(journals), seconds)
+                    for journal in journals:
+                        journal.remove()
+
+        if own_session:
+            session.close()
+
+    cache.save()
+    desc = f"Ephemera complete for {len(telescopes)} sites."
+    if received_rows:
+        desc += f" Shared regions: {received_rows} rows, against {site_rows} for the sites queried one at a time."
+    loop.set_description(desc, refresh=True)
+    print(loop)
+
+    return files
+
+def fetch_shared(dates: list[datetime], regions: list[list[tuple[float, float, float, float]]], v_mag: float, session: requests.Session = None, url: str = None, metrics: Metrics = None) -> list[tuple[list[Journal], float]]:
+    """ Query the shared regions of several nights, packing them into each request.
+    :param dates: the dates to query
+    :param regions: the regions of each date, which do not overlap
+    :param v_mag: the limiting magnitude of the queries
+    :param session: the HTTP session to post the queries with
+    :param url: the GraphQL endpoint to query
+    :param metrics: the measurements of the run to record each page in, if any
+    :return: the completed journals of each date, one per region, and the time spent on it in seconds. The time spent paging is shared evenly between the dates.
+    """
+    start_time = time.time()
+    queries = [(date, region, query_params(date, region, v_mag, Query.fields)) for date, night in zip(dates, regions) for region in night]
+    nights = [i for i, night in enumerate(regions) for _ in night]
+    journals = fetch_regions(queries, v_mag, session, url, metrics=metrics)
+    fetch_time = (time.time() - start_time) / len(dates)
+    return [([journal for journal, owner in zip(journals, nights) if owner == i], fetch_time) for i in range(len(dates))]
+
+def select_regions(mirror: Mirror, date: datetime, regions: list[tuple[float, float, float, float]], v_mag: float) -> tuple[np.ndarray, float]:
+    """ Select the asteroids inside the shared regions of a night from the local mirror.
+    :param mirror: the local mirror of the orbital elements
+    :param date: the date
+    :param regions: the regions of the date
+    :param v_mag: the limiting magnitude
+    :return: the selected asteroids, and the time spent selecting them in seconds
+    """
+    start_time = time.time()
+    data = mirror.select(date, None, v_mag, tiles=regions)
+    return data, time.time() - start_time
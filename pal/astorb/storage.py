@@ -0,0 +1,152 @@
+from datetime import datetime
+import json
+import math
+import numpy as np
+import os
+import shutil
+
+"""
+    Contains the functions to store observable asteroids in a compact columnar format.
+    Each night is a NumPy structured array with one typed column per field, saved as a .npy file
+    that can be memory-mapped without parsing. Has the functions:
+        flatten(): Flattens the nested rows returned by AstorbDB into a structured array.
+        write_observable(): Writes a night's observable asteroids to disk.
+        load_observable(): Loads (memory-maps) a night's observable asteroids.
+        convert(): Converts an observable file written as JSON to the columnar format.
+        write_rows(): Writes a file of raw rows to an observable file, without loading them into memory.
+    And the class:
+        ObservableWriter: Streams a night's observable asteroids to disk a chunk at a time.
+"""
+
+OBSERVABLE_DIR = "pal/results/observable"
+
+# Positions are returned by AstorbDB in radians (see get_sky_range), rates in arcseconds per hour.
+# RATE_SCALE converts a rate to radians per minute. It is computed without astropy.units, so that
+# reading stored results does not pay for importing astropy.
+RATE_SCALE = math.radians(1 / 3600) / 60
+
+OBSERVABLE_DTYPE = np.dtype([
+    ('ast_number', np.int64),
+    ('designation', 'U32'),
+    ('ra', np.float64),
+    ('ra_rate', np.float64),
+    ('dec', np.float64),
+    ('dec_rate', np.float64),
+    ('v_mag', np.float64),
+])
+
+def flatten(rows: list[dict]) -> np.ndarray:
+    """ Flatten the nested ephemeris rows returned by AstorbDB into a structured array.
+    :param rows: the rows of one or more query pages
+    :return: the rows as a structured array with the OBSERVABLE_DTYPE columns
+    """
+    array = np.empty(len(rows), dtype=OBSERVABLE_DTYPE)
+    if not rows:
+        return array
+
+    array['ast_number'] = [row['minorplanet']['ast_number'] for row in rows]
+    array['designation'] = [row['minorplanet']['designameByIdDesignationPrimary']['str_designame'] for row in rows]
+    for field in ('ra', 'ra_rate', 'dec', 'dec_rate', 'v_mag'):
+        array[field] = [row[field] for row in rows]
+
+    return array
+
+def observable_file(date: datetime, slug: str) -> str:
+    """ Get the file name of a night's observable asteroids.
+    :param date: the date of the night
+    :param slug: the telescope slug
+    :return: the file name
+    """
+    date_str = date.strftime("%Y-%m-%d")
+    return os.path.join(OBSERVABLE_DIR, f"{slug}_{date_str}.npy")
+
+def write_observable(data: np.ndarray, date: datetime, slug: str) -> str:
+    """ Write a night's observable asteroids to disk.
+    :param data: the structured array returned by flatten
+    :param date: the date of the night
+    :param slug: the telescope slug
+    :return: the file name
+    """
+    file_name = observable_file(date, slug)
+    np.save(file_name, np.asarray(data, dtype=OBSERVABLE_DTYPE))
+    return file_name
+
+def write_rows(rows_file: str, file_name: str) -> str:
+    """ Write a file of raw OBSERVABLE_DTYPE rows to an observable file, copying them without loading them into memory.
+    :param rows_file: the file of raw rows, which may not exist if there are none
+    :param file_name: the observable file to write
+    :return: the file name
+    """
+    rows = os.path.getsize(rows_file) // OBSERVABLE_DTYPE.itemsize if os.path.exists(rows_file) else 0
+    with open(file_name, 'wb') as out:
+        header = {"descr": np.lib.format.dtype_to_descr(OBSERVABLE_DTYPE), "fortran_order": False, "shape": (rows,)}
+        np.lib.format.write_array_header_1_0(out, header)
+        if rows:
+            with open(rows_file, 'rb') as f:
+                shutil.copyfileobj(f, out)
+    return file_name
+
+class ObservableWriter():
+    file_name = None
+    rows = 0
+
+    def __init__(self, file_name: str):
+        """ Start writing an observable file whose number of rows is not known in advance.
+        The rows are appended to a raw file, and the observable file is written from it once closed.
+        :param file_name: the observable file
+        """
+        self.file_name = file_name
+        self.rows_file = f"{file_name}.rows"
+        self.file = open(self.rows_file, 'wb')
+
+    def write(self, data: np.ndarray):
+        """ Append a chunk of observable asteroids.
+        :param data: the chunk as a structured array
+        """
+        self.file.write(np.ascontiguousarray(data, dtype=OBSERVABLE_DTYPE).tobytes())
+        self.rows += len(data)
+
+    def close(self) -> str:
+        """ Write the observable file and remove the raw rows.
+        :return: the file name
+        """
+        self.file.close()
+        write_rows(self.rows_file, self.file_name)
+        os.remove(self.rows_file)
+        return self.file_name
+
+    def abort(self):
+        """ Stop writing and remove the raw rows. """
+        self.file.close()
+        if os.path.exists(self.rows_file):
+            os.remove(self.rows_file)
+
+    def __enter__(self) -> 'ObservableWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def load_observable(file_name: str, mmap: bool = True) -> np.ndarray:
+    """ Load a night's observable asteroids.
+    :param file_name: the file written by write_observable. A JSON file is converted first.
+    :param mmap: whether to memory-map the file instead of reading it into memory
+    :return: the structured array of observable asteroids
+    """
+    if file_name.endswith('.json'):
+        file_name = convert(file_name)
+    return np.load(file_name, mmap_mode='r' if mmap else None)
+
+def convert(file_name: str) -> str:
+    """ Convert an observable file written as JSON to the columnar format.
+    :param file_name: the JSON file written by earlier versions of the pipeline
+    :return: the file name of the converted file
+    """
+    new_file_name = os.path.splitext(file_name)[0] + '.npy'
+    with open(file_name, 'r') as f:
+        data = flatten(json.load(f))
+    np.save(new_file_name, data)
+    return new_file_name
@@ -0,0 +1,277 @@
+import random
+import threading
+import time
+
+import requests
+
+from pal.utils import config
+
+"""
+    Contains the retry and throttle layer used by Query.get_results, and the errors it raises.
+    Every query to the same endpoint shares one Throttle, made of:
+        - a TokenBucket that limits the request rate of every concurrent query together. The rate is halved
+          when the endpoint answers 429 Too Many Requests, and creeps back up with each success.
+        - a CircuitBreaker that stops every query from posting once the endpoint keeps failing, and lets a
+          single probe through after a pause to tell when it has recovered.
+        - jittered exponential backoff between retries, and a timeout on every request, so a slow or
+          failing request is retried instead of stalling its night.
+    The settings are read from the [AstorbDB] section of pal/config/database.ini. Has the function:
+        get_throttle(): Gets the throttle shared by every query to an endpoint.
+"""
+
+class QueryError(IOError):
+    """ A query to the database failed. The underlying exception, if any, is kept in cause. """
+    retryable = False
+
+    def __init__(self, message: str, cause: Exception = None, status_code: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.cause = cause
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class QueryTimeout(QueryError):
+    """ The request timed out, connecting or waiting for the response. """
+    retryable = True
+
+class ConnectionFailed(QueryError):
+    """ The request could not reach the database. """
+    retryable = True
+
+class RateLimited(QueryError):
+    """ The database answered 429 Too Many Requests. """
+    retryable = True
+
+class ServerError(QueryError):
+    """ The database answered with a 5xx status. """
+    retryable = True
+
+class InvalidResponse(QueryError):
+    """ The response was empty or could not be decoded. """
+    retryable = True
+
+class GraphQLError(QueryError):
+    """ The database answered with GraphQL errors. Errors in the query itself are not retried. """
+
+    def __init__(self, message: str, errors: list[dict], **kwargs):
+        super().__init__(message, **kwargs)
+        self.errors = errors
+        codes = {error.get('extensions', {}).get('code') for error in errors}
+        self.retryable = not codes & {'validation-failed', 'parse-failed', 'invalid-headers', 'access-denied'}
+
+class CircuitOpen(QueryError):
+    """ The circuit breaker is open after repeated failures. retry_after is the time until it lets a probe through. """
+    retryable = True
+
+class TokenBucket():
+    rate = None
+    burst = None
+
+    def __init__(self, rate: float, burst: float, min_rate: float = None):
+        """ Set up a token bucket.
+        :param rate: the largest sustained number of requests per second. 0 for no limit.
+        :param burst: the number of requests that can be made at once after an idle period
+        :param min_rate: the lowest rate the bucket slows down to. Default is a tenth of the rate.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 10
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, waiting until one is available. Tokens are reserved in order, so waiting callers are served fairly. """
+        if not self.max_rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def slow_down(self):
+        """ Halve the rate, after the endpoint asked for fewer requests. """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        """ Raise the rate back toward its limit, after a successful request. """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker():
+    failures = None
+    opened_at = None
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """ Set up a closed circuit breaker.
+        :param failure_threshold: the number of consecutive failures that opens the circuit
+        :param reset_timeout: the time in seconds the circuit stays open before a probe is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_request(self) -> bool:
+        """ Check that a request may be posted.
+        :return: whether the request is the probe of an open circuit, which must end in record_success, record_failure or release
+        :raises CircuitOpen: if the circuit is open, or another request is already probing it
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0 and not self.probing:
+                self.probing = True
+                return True
+        raise CircuitOpen(f"Circuit open after {self.failures} consecutive failures.", retry_after=max(remaining, 1.0))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """ End a probe whose outcome is neither a success nor a failure, such as an error in the query itself.
+        The circuit stays open, and the next request probes it again.
+        """
+        with self.lock:
+            self.probing = False
+
+class Throttle():
+    bucket = None
+    breaker = None
+
+    def __init__(self, requests_per_second: float = 20, burst: float = 20, max_retries: int = 5, connect_timeout: float = 10,
+                 read_timeout: float = 60, backoff_base: float = 1, backoff_cap: float = 60, failure_threshold: int = 5, reset_timeout: float = 30):
+        """ Set up the throttle of an endpoint.
+        :param requests_per_second: the largest sustained request rate of every query together. 0 for no limit.
+        :param burst: the number of requests that can be made at once after an idle period
+        :param max_retries: the number of times a request is posted before its error is raised
+        :param connect_timeout: the time in seconds to wait for a connection
+        :param read_timeout: the time in seconds to wait for the response
+        :param backoff_base: the backoff before the first retry, in seconds. It doubles with each retry.
+        :param backoff_cap: the longest backoff in seconds
+        :param failure_threshold: the number of consecutive failures that opens the circuit breaker
+        :param reset_timeout: the time in seconds the circuit breaker stays open
+        """
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.timeout = (connect_timeout, read_timeout)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def before_request(self) -> bool:
+        """ Check the circuit breaker, and wait for the rate limit.
+        :return: whether the request is the probe of an open circuit
+        """
+        probe = self.breaker.before_request()
+        self.bucket.acquire()
+        return probe
+
+    def record_success(self):
+        self.breaker.record_success()
+        self.bucket.speed_up()
+
+    def record_failure(self, error: QueryError):
+        if isinstance(error, RateLimited):
+            self.bucket.slow_down()
+        self.breaker.record_failure()
+
+    def release(self):
+        self.breaker.release()
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        """ Get the time to wait before retrying.
+        :param attempt: the number of the failed attempt, starting from 0
+        :param retry_after: the wait asked for by the endpoint, if any
+        :return: the time to wait in seconds, with full jitter so concurrent queries do not retry in step
+        """
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+def check_response(response: requests.Response) -> dict:
+    """ Check a response and decode it.
+    :param response: the response to a query
+    :return: the decoded response
+    :raises QueryError: the typed error of an unsuccessful response
+    """
+    status = response.status_code
+    if status == 429 or status == 503:
+        error = RateLimited if status == 429 else ServerError
+        raise error(f"Request failed with status code {status}.", status_code=status, retry_after=retry_after(response))
+    if status >= 500:
+        raise ServerError(f"Request failed with status code {status}.", status_code=status)
+    if status != 200:
+        raise QueryError(f"Request failed with status code {status}: {response.text[:200]}", status_code=status)
+
+    try:
+        data = response.json()
+    except ValueError as e:  # includes simplejson.decoder.JSONDecodeError
+        raise InvalidResponse("Failed to decode JSON.", cause=e, status_code=status) from e
+    if not isinstance(data, dict):
+        raise InvalidResponse("Expected a JSON object.", status_code=status)
+    if not data:
+        raise InvalidResponse("Received empty JSON response.", status_code=status)
+    errors = data.get('errors')
+    if errors:
+        if not isinstance(errors, list) or not all(isinstance(error, dict) for error in errors):
+            raise InvalidResponse("Expected a list of GraphQL errors.", status_code=status)
+        raise GraphQLError(f"Query returned errors: {errors[0].get('message')}", errors, status_code=status)
+
+    return data
+
+def retry_after(response: requests.Response) -> float | None:
+    """ Get the wait asked for by a Retry-After header, in seconds. """
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+# Throttles shared by every query to each endpoint
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+def get_throttle(url: str) -> Throttle:
+    """ Get the throttle shared by every query to an endpoint, setting it up from pal/config/database.ini on first use.
+    :param url: the endpoint
+    :return: the throttle
+    """
+    with _throttles_lock:
+        if url not in _throttles:
+            settings = config.read('pal/config/database.ini')
+            options = {}
+            for option in ('requests_per_second', 'burst', 'max_retries', 'connect_timeout', 'read_timeout',
+                           'backoff_base', 'backoff_cap', 'failure_threshold', 'reset_timeout'):
+                value = config.expected_type(config.get(settings, 'AstorbDB', option))
+                if value is not None:
+                    options[option] = value
+            _throttles[url] = Throttle(**options)
+        return _throttles[url]
+
+def set_throttle(url: str, throttle: Throttle):
+    """ Set the throttle shared by every query to an endpoint, such as a local stand-in without limits.
+    :param url: the endpoint
+    :param throttle: the throttle
+    """
+    with _throttles_lock:
+        _throttles[url] = throttle
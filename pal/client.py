@@ -0,0 +1,91 @@
+import argparse
+import json
+import socket
+import sys
+from urllib import request as urlrequest
+
+"""
+    Thin client for the PAL daemon (see pal.utils.daemon).
+    It only imports the standard library, so each call costs a connection rather than a cold start of PAL.
+
+    Usage:
+        python -m pal.client ping
+        python -m pal.client field telescope=Pathfinder time=2025-01-08T04:00:00 'vertices=[[10, 20], [11, 20], [11, 21], [10, 21]]'
+        python -m pal.client crossmatch telescope=Pathfinder exposures=@batch.json
+        python -m pal.client ephemeris telescope=Pathfinder start_date=2025-01-08 end_date=2025-01-15 mag_lim=true
+
+    Parameter values are parsed as JSON where possible and kept as strings otherwise. A value starting
+    with @ is read from the named JSON file.
+"""
+
+SOCKET_PATH = "pal/results/pal.sock"
+
+def send(request: dict, socket_path: str = SOCKET_PATH, url: str = None, timeout: float = None) -> dict:
+    """ Send one request to the daemon.
+    :param request: the request, with a "request" key and its parameters
+    :param socket_path: the Unix socket the daemon listens on, if no url is given
+    :param url: the HTTP address the daemon listens on, as in http://127.0.0.1:8765
+    :param timeout: the time to wait for the response in seconds. Default is no limit.
+    :return: the daemon's response
+    """
+    if url is not None:
+        params = dict(request)
+        name = params.pop('request')
+        post = urlrequest.Request(f"{url.rstrip('/')}/{name}", data=json.dumps(params).encode(), headers={'Content-Type': 'application/json'})
+        try:
+            with urlrequest.urlopen(post, timeout=timeout) as response:
+                return json.load(response)
+        except urlrequest.HTTPError as e:
+            return json.load(e)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request).encode() + b'\n')
+        with connection.makefile('rb') as f:
+            return json.loads(f.readline())
+
+def parse_value(value: str):
+    """ Parse a parameter value given on the command line.
+    :param value: the value, as JSON, a plain string, or @ followed by a JSON file name
+    :return: the parsed value
+    """
+    if value.startswith('@'):
+        with open(value[1:], 'r') as f:
+            return json.load(f)
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m pal.client", description="Send a request to the PAL daemon.")
+    parser.add_argument('request', help="the request to send: ping, ephemeris, field, crossmatch or shutdown")
+    parser.add_argument('params', nargs='*', metavar='key=value', help="the parameters of the request")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="the Unix socket the daemon listens on")
+    parser.add_argument('--url', default=None, help="the HTTP address the daemon listens on, instead of the socket")
+    parser.add_argument('--timeout', type=float, default=None, help="the time to wait for the response in seconds")
+    args = parser.parse_args(argv)
+
+    request = {"request": args.request}
+    for param in args.params:
+        key, sep, value = param.partition('=')
+        if not sep:
+            parser.error(f"Parameters must be given as key=value, got: {param}")
+        request[key] = parse_value(value)
+
+    try:
+        response = send(request, args.socket, args.url, args.timeout)
+    except OSError as e:
+        print(f"Could not reach the PAL daemon: {e}", file=sys.stderr)
+        return 1
+
+    if response['status'] != 0:
+        print(response['error'], file=sys.stderr)
+        return response['status']
+
+    print(json.dumps(response['result']))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
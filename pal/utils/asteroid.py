@@ -1,16 +1,163 @@
+import math
+import numpy as np
+from typing import Iterable, Iterator
+
+from pal.astorb.storage import OBSERVABLE_DTYPE, RATE_SCALE, flatten, load_observable
+
 """
-    Contains the asteroid object and methods for propogation.
+    Contains the AsteroidTable container and the Asteroid row view.
+    An AsteroidTable holds a set of asteroids as one typed array per column, loaded directly from
+    query pages or (memory-mapped) from observable files. An Asteroid is a light view onto one row of a table.
 """
 
-class Asteroid:
-    def __init__(self, mpc, ra, ra_rate, dec, dec_rate, mag, name=None):
-        self.name = name
-        self.mpc = mpc
+COLUMNS = OBSERVABLE_DTYPE.names
+
+class AsteroidTable:
+    __slots__ = COLUMNS
+
+    def __init__(self, ast_number, designation, ra, ra_rate, dec, dec_rate, v_mag):
+        """ Create a table from one array per column. The arrays are not copied.
+        :param ast_number: the asteroid numbers
+        :param designation: the primary designations
+        :param ra: the right ascensions in radians
+        :param ra_rate: the on-sky right ascension rates in arcseconds per hour
+        :param dec: the declinations in radians
+        :param dec_rate: the declination rates in arcseconds per hour
+        :param v_mag: the apparent V magnitudes
+        """
+        self.ast_number = ast_number
+        self.designation = designation
         self.ra = ra
         self.ra_rate = ra_rate
         self.dec = dec
         self.dec_rate = dec_rate
-        self.app_mag = mag
+        self.v_mag = v_mag
+
+    @classmethod
+    def from_records(cls, records: np.ndarray) -> 'AsteroidTable':
+        """ Create a table of views onto the columns of a structured array, without copying it.
+        :param records: a structured array with the OBSERVABLE_DTYPE columns
+        :return: the table
+        """
+        return cls(*(records[column] for column in COLUMNS))
+
+    @classmethod
+    def from_pages(cls, pages: Iterable[list[dict]]) -> 'AsteroidTable':
+        """ Create a table from the pages returned by AstorbDB.
+        :param pages: the rows of each query page
+        :return: the table
+        """
+        records = [flatten(page) for page in pages]
+        return cls.from_records(np.concatenate(records) if records else np.empty(0, dtype=OBSERVABLE_DTYPE))
+
+    @classmethod
+    def load(cls, file_name: str, mmap: bool = True) -> 'AsteroidTable':
+        """ Load a table from an observable file.
+        :param file_name: the observable file written by the pipeline
+        :param mmap: whether to memory-map the file instead of reading it into memory
+        :return: the table
+        """
+        return cls.from_records(load_observable(file_name, mmap=mmap))
+
+    @classmethod
+    def concatenate(cls, tables: Iterable['AsteroidTable']) -> 'AsteroidTable':
+        """ Join several tables into one.
+        :param tables: the tables to join
+        :return: the joined table
+        """
+        tables = list(tables)
+        return cls(*(np.concatenate([getattr(table, column) for table in tables]) for column in COLUMNS))
+
+    def __len__(self) -> int:
+        return len(self.ast_number)
+
+    def __getitem__(self, key):
+        """ Get a column by name, a row view by position, or a sub-table by slice, mask or index array. """
+        if isinstance(key, str):
+            return getattr(self, key)
+        if isinstance(key, (int, np.integer)):
+            index = int(key)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("AsteroidTable index out of range")
+            return Asteroid(self, index)
+        return AsteroidTable(*(getattr(self, column)[key] for column in COLUMNS))
+
+    def __iter__(self) -> Iterator['Asteroid']:
+        for index in range(len(self)):
+            yield Asteroid(self, index)
+
+    def filter_magnitude(self, mag_lim: float) -> 'AsteroidTable':
+        """ Keep the asteroids at or brighter than a limiting magnitude.
+        :param mag_lim: the limiting magnitude
+        :return: the filtered table
+        """
+        return self[self.v_mag <= mag_lim]
+
+    def filter_region(self, ra_min: float, ra_max: float, dec_min: float, dec_max: float) -> 'AsteroidTable':
+        """ Keep the asteroids inside an RA/Dec box. The RA range may wrap past 0/360, as in ra_min > ra_max.
+        :param ra_min: the minimum right ascension in radians
+        :param ra_max: the maximum right ascension in radians
+        :param dec_min: the minimum declination in radians
+        :param dec_max: the maximum declination in radians
+        :return: the filtered table
+        """
+        ra = np.mod(self.ra, 2 * math.pi)
+        ra_min, ra_max = ra_min % (2 * math.pi), ra_max % (2 * math.pi)
+        if ra_min <= ra_max:
+            in_ra = (ra >= ra_min) & (ra <= ra_max)
+        else:
+            in_ra = (ra >= ra_min) | (ra <= ra_max)
+        return self[in_ra & (self.dec >= dec_min) & (self.dec <= dec_max)]
+
+    def to_records(self) -> np.ndarray:
+        """ Copy the table into a structured array, as written by the pipeline.
+        :return: the structured array
+        """
+        records = np.empty(len(self), dtype=OBSERVABLE_DTYPE)
+        for column in COLUMNS:
+            records[column] = getattr(self, column)
+        return records
+
+class Asteroid:
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table: AsteroidTable, index: int):
+        """ Create a view onto one row of a table.
+        :param table: the table the asteroid belongs to
+        :param index: the row of the asteroid
+        """
+        self.table = table
+        self.index = index
+
+    @property
+    def name(self) -> str:
+        return str(self.table.designation[self.index])
+
+    @property
+    def mpc(self) -> int:
+        return int(self.table.ast_number[self.index])
+
+    @property
+    def ra(self) -> float:
+        return float(self.table.ra[self.index])
+
+    @property
+    def ra_rate(self) -> float:
+        return float(self.table.ra_rate[self.index])
+
+    @property
+    def dec(self) -> float:
+        return float(self.table.dec[self.index])
+
+    @property
+    def dec_rate(self) -> float:
+        return float(self.table.dec_rate[self.index])
+
+    @property
+    def app_mag(self) -> float:
+        return float(self.table.v_mag[self.index])
 
     def json(self):
         return {
@@ -22,6 +169,12 @@ class Asteroid:
             "dec_rate": self.dec_rate,
             "app_mag": self.app_mag
         }
-    
+
     def propogate(self, period):
-        return None
\ No newline at end of file
+        """ Propogate the asteroid's position forward in time.
+        :param period: the time to propogate by in minutes
+        :return: the propogated right ascension and declination in radians
+        """
+        dec = self.dec + self.dec_rate * RATE_SCALE * period
+        ra = self.ra + self.ra_rate * RATE_SCALE * period / math.cos(self.dec)
+        return ra % (2 * math.pi), min(max(dec, -math.pi / 2), math.pi / 2)
@@ -0,0 +1,169 @@
+from astropy.time import Time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import socketserver
+import threading
+import time
+import traceback
+
+from pal.astorb.index import IndexCache
+from pal.astorb.query import create_session
+from pal.utils.telescope import get_telescope
+
+"""
+    Contains the Daemon class, which keeps PAL's state warm between requests.
+    Starting PAL imports astropy, loads the IERS tables, sets up each Telescope and opens new HTTP connections.
+    The daemon pays for these once, then serves requests from the same process over a local Unix socket
+    (one JSON request per line, one JSON response per line) or an HTTP port (POST /<request> with a JSON body).
+    The thin client in pal.client sends requests to it.
+
+    Each request is a JSON object with a "request" key and the parameters of the request:
+        - ping: Check the daemon is running. Returns the warm telescopes and the uptime in seconds.
+        - ephemeris: Run the ephemeris action, with the same parameters as pal.actions.ephemeris.
+        - field: Find the asteroids inside one exposure's footprint. Takes telescope and the exposure's keys
+          (see pal.actions.crossmatch).
+        - crossmatch: Find the asteroids inside each of a batch of exposures. Takes telescope and exposures.
+        - shutdown: Stop the daemon.
+    Each response is a JSON object with "status" (0 if successful, 1 if an error occurred) and either
+    "result" or "error".
+"""
+
+SOCKET_PATH = "pal/results/pal.sock"
+
+class Daemon():
+    telescopes = None
+    session = None
+    indexes = None
+    server = None
+
+    def __init__(self, telescopes: list[str] = None, workers: int = 4, cached_nights: int = 8):
+        """ Set up the warm state of the daemon.
+        :param telescopes: the telescopes to set up and warm up before serving. Others are set up on first use.
+        :param workers: the number of connections the HTTP session keeps open to the database
+        :param cached_nights: the number of nights of ephemera kept loaded and indexed
+        """
+        self.telescopes = list(telescopes) if telescopes is not None else ['Pathfinder']
+        self.workers = workers
+        self.session = create_session(workers)
+        self.indexes = IndexCache(cached_nights)
+        self.started = time.time()
+
+        # Ephemeris runs write the same result files, so they are run one at a time
+        self.ephemeris_lock = threading.Lock()
+
+        for name in self.telescopes:
+            self.warm_up(name)
+
+    def warm_up(self, name: str):
+        """ Set up a telescope and compute one night, which loads the IERS tables and solar ephemeris.
+        :param name: the name of the telescope
+        """
+        telescope = get_telescope(name)
+        telescope.get_nights(Time.now().reshape((1,)), use_cache=False)
+
+    def handle(self, request: dict) -> dict:
+        """ Handle one request.
+        :param request: the request, with a "request" key and its parameters
+        :return: the response
+        """
+        params = dict(request)
+        name = params.pop('request', None)
+        handler = getattr(self, f"handle_{name}", None) if isinstance(name, str) else None
+        if handler is None:
+            return {"status": 1, "error": f"Unknown request: {name}"}
+
+        try:
+            return {"status": 0, "result": handler(**params)}
+        except Exception as e:
+            traceback.print_exc()
+            return {"status": 1, "error": f"{type(e).__name__}: {e}"}
+
+    def handle_ping(self) -> dict:
+        return {"telescopes": self.telescopes, "uptime": time.time() - self.started}
+
+    def handle_ephemeris(self, **kwargs) -> int:
+        # Imported here so the daemon's modules can be imported without the action's
+        from pal.actions import ephemeris
+
+        kwargs.setdefault('workers', self.workers)
+        with self.ephemeris_lock:
+            status = ephemeris.execute(session=self.session, **kwargs)
+        if status != 0:
+            raise RuntimeError(f"Ephemeris action failed with status {status}")
+        return status
+
+    def handle_field(self, telescope: str, **exposure) -> dict:
+        return self.handle_crossmatch(telescope, [exposure])[0]
+
+    def handle_crossmatch(self, telescope: str, exposures: list[dict]) -> list[dict]:
+        from pal.actions.crossmatch import crossmatch
+
+        return list(crossmatch(exposures, get_telescope(telescope), self.indexes))
+
+    def handle_shutdown(self) -> str:
+        # Shut down from another thread, since shutdown() waits for the request being served to finish
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+        return "Shutting down"
+
+    def serve(self, socket_path: str = SOCKET_PATH, port: int = None):
+        """ Serve requests until the daemon is shut down.
+        :param socket_path: the Unix socket to listen on, if no port is given
+        :param port: the local HTTP port to listen on
+        """
+        daemon = self
+
+        if port is not None:
+            class Handler(BaseHTTPRequestHandler):
+                def do_POST(self):
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    try:
+                        request = json.loads(body)
+                        if not isinstance(request, dict):
+                            raise ValueError("expected a JSON object")
+                        request['request'] = self.path.strip('/')
+                        response = daemon.handle(request)
+                    except ValueError as e:
+                        response = {"status": 1, "error": f"Invalid request: {e}"}
+                    data = json.dumps(response).encode()
+                    self.send_response(200 if response['status'] == 0 else 400)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            print(f"PAL daemon listening on http://127.0.0.1:{self.server.server_address[1]}")
+        else:
+            class Handler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    for line in self.rfile:
+                        if not line.strip():
+                            continue
+                        try:
+                            request = json.loads(line)
+                            if not isinstance(request, dict):
+                                raise ValueError("expected a JSON object")
+                            response = daemon.handle(request)
+                        except ValueError as e:
+                            response = {"status": 1, "error": f"Invalid request: {e}"}
+                        self.wfile.write(json.dumps(response).encode() + b'\n')
+                        self.wfile.flush()
+
+            # Remove a socket left behind by a daemon that did not shut down cleanly
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+            print(f"PAL daemon listening on {socket_path}")
+
+        self.server.daemon_threads = True
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.session.close()
+            if port is None and os.path.exists(socket_path):
+                os.remove(socket_path)
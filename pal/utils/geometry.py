@@ -0,0 +1,93 @@
+from astropy.time import Time
+import astropy.units as u
+import configparser
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+"""
+    Contains the GeometryCache class, a persistent on-disk cache of the night geometry for a telescope site.
+    The twilight times and local sidereal time of a night depend only on the site and the date,
+    so they are computed once with astropy and reused by every later run.
+    Has the functions:
+        geometry_version(): Hashes the telescope configuration so the cache is invalidated when it changes.
+        prefill(): Computes and caches the night geometry for every date in a year.
+"""
+
+# Bump when the way night geometry is computed changes, to invalidate every cache
+GEOMETRY_VERSION = 1
+CACHE_DIR = "pal/results/cache"
+
+def geometry_version(settings: configparser.ConfigParser, telescope: str) -> str:
+    """ Hash the configuration of a telescope, so that cached geometry is discarded when telescope.ini changes.
+    :param settings: the parsed telescope configuration
+    :param telescope: the section of the telescope in the configuration
+    :return: the version string of the telescope's geometry
+    """
+    items = sorted(settings.items(telescope)) if settings.has_section(telescope) else []
+    digest = hashlib.sha1(json.dumps([GEOMETRY_VERSION, telescope, items]).encode()).hexdigest()
+    return digest[:16]
+
+class GeometryCache():
+    slug = None
+    version = None
+    file_name = None
+    nights = None
+
+    def __init__(self, slug: str, version: str, cache_dir: str = CACHE_DIR):
+        """ Load the cached night geometry for a telescope, discarding it if the version has changed.
+        :param slug: the slug of the telescope
+        :param version: the version string returned by geometry_version
+        :param cache_dir: the directory the cache is stored in
+        """
+        self.slug = slug
+        self.version = version
+        self.file_name = os.path.join(cache_dir, f"geometry_{slug}.json")
+        self.nights = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.file_name):
+            try:
+                with open(self.file_name, 'r') as f:
+                    cached = json.load(f)
+            except ValueError:
+                cached = {}
+            if cached.get('version') == self.version:
+                self.nights = cached.get('nights', {})
+
+    def get(self, keys: list[str]) -> list[dict]:
+        """ Get the cached geometry for several nights.
+        :param keys: the keys of the nights (ISO time of the date)
+        :return: the cached geometry of each night, or None where it is not cached
+        """
+        with self._lock:
+            return [self.nights.get(key) for key in keys]
+
+    def update(self, nights: dict[str, dict]):
+        """ Add the geometry of several nights to the cache and write it to disk.
+        :param nights: the geometry of each night, keyed by the ISO time of the date
+        """
+        with self._lock:
+            self.nights.update(nights)
+            os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+
+            # Write to a temporary file first so an interrupted run cannot corrupt the cache
+            temp_name = f"{self.file_name}.tmp"
+            with open(temp_name, 'w') as f:
+                json.dump({"version": self.version, "slug": self.slug, "nights": self.nights}, f)
+            os.replace(temp_name, self.file_name)
+
+def prefill(telescope, year: int) -> int:
+    """ Compute and cache the night geometry for every date in a year in one call.
+    :param telescope: the Telescope to fill the cache for
+    :param year: the year to fill
+    :return: the number of nights in the cache for the year
+    """
+    start = Time(f"{year}-01-01", scale='utc')
+    end = Time(f"{year + 1}-01-01", scale='utc')
+    dates = start + np.arange(round((end - start).to_value(u.day))) * u.day
+
+    telescope.get_nights(dates)
+    return len(dates)
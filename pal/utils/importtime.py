@@ -0,0 +1,52 @@
+import subprocess
+import sys
+
+"""
+    Contains the functions to report what importing an action costs at startup.
+    The action module is imported in a fresh interpreter with Python's -X importtime option, so the
+    report covers exactly the imports a cold `python -m pal` run pays for. Has the functions:
+        import_times(): Measures the time spent importing each package for a module.
+        import_report(): Formats the measurements as a short report.
+"""
+
+def import_times(module: str) -> tuple[float, dict[str, float]]:
+    """ Measure the time spent importing a module and each top-level package it pulls in.
+    :param module: the module to import, as in pal.actions.ephemeris
+    :return: the total import time in seconds, and the time spent in each top-level package in seconds
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(f"Could not import {module}: {result.stderr.strip().splitlines()[-1]}")
+
+    lines = [line[len('import time:'):].split('|') for line in result.stderr.splitlines() if line.startswith('import time:') and 'self [us]' not in line]
+
+    # Skip the imports made by the interpreter's startup, which end with the site module
+    names = [name.strip() if len(name) - len(name.lstrip()) == 1 else None for _, _, name in lines]
+    if 'site' in names:
+        lines = lines[names.index('site') + 1:]
+
+    total = 0
+    packages = {}
+    for self_time, cumulative, name in lines:
+        depth = len(name) - len(name.lstrip())
+        name = name.strip()
+
+        # Self times add up to the total, and are grouped by the package they belong to
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_time) / 1e6
+        if depth == 1:
+            total += int(cumulative) / 1e6
+
+    return total, packages
+
+def import_report(module: str, top: int = 10) -> str:
+    """ Report the time spent importing a module, broken down by package.
+    :param module: the module to import, as in pal.actions.ephemeris
+    :param top: the number of packages to list
+    :return: the report
+    """
+    total, packages = import_times(module)
+    lines = [f"Importing {module} takes {total:.3f} seconds."]
+    for package, seconds in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append(f"    {package:<24} {seconds:8.3f} s  {100 * seconds / total:5.1f}%")
+    return '\n'.join(lines)
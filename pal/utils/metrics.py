@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+"""
+    Contains the Metrics class, which collects structured measurements of a run.
+    Each measurement is a record with a type and its fields:
+        - page: one page of a query. Build time, HTTP latency, bytes received, retries, parse time and write time.
+        - night: one night of the pipeline. Its pages added up, with the night's write time and rows per second.
+        - stage: one stage of a run (for example, the astropy night geometry or the propogation of a night).
+        - plan: the query plan of one night. Its tiles and rows, against the area and rows of the single box it replaced,
+          counted for nights selected from the local mirror and estimated from the areas otherwise.
+        - site: one telescope of a night queried for several sites at once. Its rows, kept from the shared query.
+    The records are written as JSON lines next to the eph_log_* files, and can also be summed up
+    in the Prometheus text format, to tell whether a run is limited by the API, astropy or the disk.
+"""
+
+METRICS_DIR = "pal/results/logs"
+# The fields measured for every page, added up for each night
+PAGE_FIELDS = ('rows', 'bytes', 'retries', 'build_time', 'http_latency', 'parse_time', 'write_time')
+
+class Metrics():
+    records = None
+    file_name = None
+
+    def __init__(self, telescope: str, metrics_dir: str = METRICS_DIR):
+        """ Start collecting the measurements of a run.
+        :param telescope: the name of the telescope of the run
+        :param metrics_dir: the directory the measurements are written to
+        """
+        self.telescope = telescope
+        self.records = []
+        self.lock = threading.Lock()
+        now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.file_name = os.path.join(metrics_dir, f"eph_metrics_{telescope}_{now}.jsonl")
+
+    def record(self, type: str, **fields):
+        """ Add a measurement.
+        :param type: the type of the measurement: page, night, stage, plan or site
+        :param fields: the fields of the measurement
+        """
+        record = {"type": type, "time": time.time(), **fields}
+        with self.lock:
+            self.records.append(record)
+
+    def night(self, date: str, source: str, rows: int, seconds: float, write_time: float):
+        """ Add the measurement of a night, with the measurements of its pages added up.
+        :param date: the date of the night, YYYY-MM-DD
+        :param source: where the night's rows came from: query, cache, anchor (a reused query), predicted, mirror (the local mirror) or shared (a query shared by several telescopes)
+        :param rows: the number of observable asteroids written for the night
+        :param seconds: the time spent on the night
+        :param write_time: the time spent writing the night's observable file
+        """
+        with self.lock:
+            pages = [record for record in self.records if record['type'] == 'page' and record['date'] == date]
+        totals = {field: sum(page[field] for page in pages) for field in PAGE_FIELDS}
+
+        self.record(
+            "night", date=date, source=source, rows=rows, seconds=seconds, write_time=write_time,
+            rows_per_second=rows / seconds if seconds > 0 else None, pages=len(pages), rows_received=totals['rows'],
+            bytes=totals['bytes'], retries=totals['retries'], build_time=totals['build_time'], http_latency=totals['http_latency'],
+            parse_time=totals['parse_time'], page_write_time=totals['write_time'],
+        )
+
+    @contextmanager
+    def stage(self, name: str, **fields):
+        """ Measure the time spent in a stage of the run.
+        :param name: the name of the stage
+        :param fields: other fields of the measurement, such as the date
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record("stage", stage=name, seconds=time.perf_counter() - start, **fields)
+
+    def write(self, prometheus: bool = False) -> list[str]:
+        """ Write the measurements to disk.
+        :param prometheus: whether to also write the totals in the Prometheus text format
+        :return: the files written
+        """
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        with self.lock:
+            records = list(self.records)
+
+        with open(self.file_name, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record))
+                f.write('\n')
+        files = [self.file_name]
+
+        if prometheus:
+            prometheus_file = os.path.splitext(self.file_name)[0] + '.prom'
+            with open(prometheus_file, 'w') as f:
+                f.write(to_prometheus(records, self.telescope))
+            files.append(prometheus_file)
+
+        return files
+
+def to_prometheus(records: list[dict], telescope: str) -> str:
+    """ Sum up the measurements of a run in the Prometheus text format.
+    :param records: the measurements
+    :param telescope: the name of the telescope of the run
+    :return: the metrics, one sample per line
+    """
+    pages = [record for record in records if record['type'] == 'page']
+    nights = [record for record in records if record['type'] == 'night']
+    plans = [record for record in records if record['type'] == 'plan']
+    stages = {}
+    for record in records:
+        if record['type'] == 'stage':
+            stages[record['stage']] = stages.get(record['stage'], 0) + record['seconds']
+
+    label = f'telescope="{telescope}"'
+    metrics = [
+        ("pal_pages_total", "counter", "Query pages received.", [(label, len(pages))]),
+        ("pal_rows_total", "counter", "Rows received from the database.", [(label, sum(page['rows'] for page in pages))]),
+        ("pal_bytes_received_total", "counter", "Bytes received from the database.", [(label, sum(page['bytes'] for page in pages))]),
+        ("pal_retries_total", "counter", "Query retries.", [(label, sum(page['retries'] for page in pages))]),
+        ("pal_query_build_seconds_total", "counter", "Time spent building queries.", [(label, sum(page['build_time'] for page in pages))]),
+        ("pal_http_seconds_total", "counter", "Time spent waiting on the database.", [(label, sum(page['http_latency'] for page in pages))]),
+        ("pal_parse_seconds_total", "counter", "Time spent decoding and flattening pages.", [(label, sum(page['parse_time'] for page in pages))]),
+        ("pal_write_seconds_total", "counter", "Time spent writing pages and nights to disk.", [(label, sum(page['write_time'] for page in pages) + sum(night['write_time'] for night in nights))]),
+        ("pal_night_seconds", "gauge", "Time spent on each night.", [(f'{label},date="{night["date"]}"', night['seconds']) for night in nights]),
+        ("pal_night_rows_per_second", "gauge", "Rows per second of each night.", [(f'{label},date="{night["date"]}"', night['rows_per_second']) for night in nights if night['rows_per_second'] is not None]),
+        ("pal_plan_rows_saved_total", "counter", "Rows the query plans saved against the single box: counted for nights selected from the local mirror, estimated from the sky areas for queried nights.",
+            [(f'{label},method="{method}"', sum(plan['rows_saved'] for plan in plans if plan.get('estimated', True) == (method == 'estimated'))) for method in ('counted', 'estimated')]),
+        ("pal_stage_seconds_total", "counter", "Time spent in each stage.", [(f'{label},stage="{stage}"', seconds) for stage, seconds in stages.items()]),
+    ]
+
+    lines = []
+    for name, kind, help, samples in metrics:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}")
+    return '\n'.join(lines) + '\n'
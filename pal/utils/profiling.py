@@ -0,0 +1,164 @@
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+"""
+    Contains the Profiler class, which profiles each stage of a run separately.
+    For every stage it writes, under pal/results/logs:
+        - a cProfile dump (.pstats) of every thread the stage ran, for pstats or snakeviz.
+        - sampled stacks of every thread in the collapsed format (.folded), for flamegraph.pl or speedscope.
+          The samples are taken on wall-clock time, so time spent waiting on the network shows up as
+          socket frames rather than disappearing as it does from a CPU profile.
+    A summary compares each stage's wall-clock time with the CPU time the process used, and, when
+    allocation tracking is on, the peak memory allocated during the stage.
+"""
+
+PROFILE_DIR = "pal/results/logs"
+# Time between stack samples in seconds
+SAMPLE_INTERVAL = 0.005
+
+class Profiler():
+    stages = None
+    files = None
+
+    def __init__(self, telescope: str, allocations: bool = False, profile_dir: str = PROFILE_DIR, interval: float = SAMPLE_INTERVAL):
+        """ Set up the profiling of a run.
+        :param telescope: the name of the telescope of the run
+        :param allocations: whether to track memory allocations, reporting the peak memory of each stage
+        :param profile_dir: the directory the profiles are written to
+        :param interval: the time between stack samples in seconds
+        """
+        self.allocations = allocations
+        self.interval = interval
+        self.profile_dir = profile_dir
+        self.prefix = f"prof_{telescope}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        self.stages = []
+        self.files = []
+        os.makedirs(profile_dir, exist_ok=True)
+
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        """ Profile a stage of the run.
+        :param name: the name of the stage, used in the file names
+        """
+        sampler = StackSampler(self.interval)
+        thread_profiles = []
+        lock = threading.Lock()
+
+        def profile_thread(frame, event, arg):
+            # Called once in each thread started during the stage, which then profiles itself
+            profile = cProfile.Profile()
+            with lock:
+                thread_profiles.append(profile)
+            profile.enable()
+
+        if self.allocations:
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+
+        sampler.start()
+        threading.setprofile(profile_thread)
+        profile = cProfile.Profile()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            threading.setprofile(None)
+            sampler.stop()
+
+            summary = {"stage": name, "wall": wall, "cpu": cpu, "threads": 1 + len(thread_profiles)}
+            if self.allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                summary["peak_memory"] = peak - memory_start
+                summary["retained_memory"] = current - memory_start
+            self.stages.append(summary)
+
+            stats = pstats.Stats(profile)
+            with lock:
+                for thread_profile in thread_profiles:
+                    stats.add(thread_profile)
+            stats_file = os.path.join(self.profile_dir, f"{self.prefix}_{name}.pstats")
+            stats.dump_stats(stats_file)
+
+            folded_file = os.path.join(self.profile_dir, f"{self.prefix}_{name}.folded")
+            with open(folded_file, 'w') as f:
+                for stack, count in sorted(sampler.counts.items()):
+                    f.write(f"{stack} {count}\n")
+
+            self.files.extend([stats_file, folded_file])
+
+    def write_summary(self) -> str:
+        """ Write the summary of every stage profiled.
+        :return: the file name of the summary
+        """
+        lines = [f"{'stage':<24} {'wall [s]':>10} {'cpu [s]':>10} {'waiting':>8} {'threads':>8}" + (f" {'peak memory':>12} {'retained':>12}" if self.allocations else "")]
+        for stage in self.stages:
+            # CPU time is counted across every thread, so a stage running threads in parallel can wait less than nothing
+            waiting = max(0.0, 1 - stage['cpu'] / stage['wall']) if stage['wall'] > 0 else 0.0
+            line = f"{stage['stage']:<24} {stage['wall']:10.3f} {stage['cpu']:10.3f} {waiting:8.0%} {stage['threads']:8d}"
+            if self.allocations:
+                line += f" {format_bytes(stage['peak_memory']):>12} {format_bytes(stage['retained_memory']):>12}"
+            lines.append(line)
+
+        file_name = os.path.join(self.profile_dir, f"{self.prefix}_summary.txt")
+        with open(file_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.files.append(file_name)
+        return file_name
+
+class StackSampler():
+    counts = None
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        """ Set up a sampler of the stacks of every thread.
+        :param interval: the time between samples in seconds
+        """
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pal-stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                # Threads of the same pool are merged, as in ThreadPoolExecutor-0_3
+                thread = re.sub(r'_\d+$', '', names.get(ident, 'thread'))
+                self.counts[';'.join([thread] + stack[::-1])] += 1
+
+def format_bytes(size: int) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
@@ -0,0 +1,53 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+"""
+    Contains the SharedArray class, a NumPy array held in a block of shared memory.
+    The process that creates the array passes its spec (name, shape and dtype) to worker processes, which
+    attach to the same memory by name and write their part of it in place, instead of pickling arrays
+    back and forth. The creating process unlinks the block once it is done with it.
+"""
+
+class SharedArray():
+    array = None
+
+    def __init__(self, shape: tuple[int, ...], dtype: str = 'float64', name: str = None):
+        """ Create an array in a new block of shared memory, or attach to an existing one.
+        :param shape: the shape of the array
+        :param dtype: the data type of the array
+        :param name: the name of the block to attach to. A new block is created if not given.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    @classmethod
+    def attach(cls, spec: tuple[str, tuple[int, ...], str]) -> 'SharedArray':
+        """ Attach to an array created by another process.
+        :param spec: the spec of the array (see SharedArray.spec)
+        :return: the array
+        """
+        name, shape, dtype = spec
+        return cls(shape, dtype, name)
+
+    @property
+    def spec(self) -> tuple[str, tuple[int, ...], str]:
+        """ The name, shape and dtype of the array, which are all another process needs to attach to it. """
+        return self.memory.name, self.shape, self.dtype.str
+
+    def close(self):
+        """ Detach from the array. The creating process also frees the shared memory. """
+        # The array must be released before the buffer it views can be closed
+        self.array = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self) -> 'SharedArray':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,14 +1,30 @@
 from astropy.coordinates import AltAz, EarthLocation, get_sun
+from astropy.coordinates import Longitude
 from astropy.time import Time
 import astropy.units as u
 from datetime import datetime
+import numpy as np
+import threading
 
 from pal.utils import config
+from pal.utils.geometry import GeometryCache, geometry_version
 
 """
     Contains the Telescope class, which is used to represent the desired instrument to be used for observability calculations.
+    Has the function:
+        get_telescope(): Gets a shared Telescope instance, so long-running processes only set each one up once.
 """
 
+# Astronomical twilight altitude of the Sun in degrees
+TWILIGHT_ALTITUDE = -18
+# Spacing of the coarse Sun altitude samples in minutes, and the precision the crossings are refined to in seconds
+COARSE_STEP = 30
+REFINE_PRECISION = 1
+
+# Telescopes already set up by get_telescope, by name
+_telescopes = {}
+_telescopes_lock = threading.Lock()
+
 # DONE: Fix times in time-dependent classes.
 # TODO: Remove datetime dependency
 
@@ -23,6 +39,8 @@ class Telescope():
         # Get the telescope parameters
         self.slug = config.get(settings, telescope, 'slug')
         self.slug = config.expected_type(self.slug)
+        if self.slug is None:
+            raise ValueError(f"Unknown telescope: {telescope}. Telescopes are described in pal/config/telescope.ini.")
         self.latitude = config.get(settings, telescope, 'latitude')
         self.latitude = config.expected_type(self.latitude)
         self.longitude = config.get(settings, telescope, 'longitude')
@@ -34,9 +52,18 @@ class Telescope():
         self.dec_max = config.get(settings, telescope, 'dec_max')
         self.dec_max = config.expected_type(self.dec_max)
 
+        # Pointing limits, used to plan the queries (see pal.astorb.planner). By default the horizon and the meridian.
+        self.min_altitude = config.get(settings, telescope, 'min_altitude')
+        self.min_altitude = config.expected_type(self.min_altitude) or 0
+        self.hour_angle_limit = config.get(settings, telescope, 'hour_angle_limit')
+        self.hour_angle_limit = config.expected_type(self.hour_angle_limit) or 0
+
         # Set the location
         self.location = EarthLocation(lat=self.latitude*u.deg, lon=self.longitude*u.deg, height=self.altitude*u.m)
 
+        # Night geometry depends only on the site and date, so it is cached on disk between runs
+        self.geometry = GeometryCache(self.slug, geometry_version(settings, telescope))
+
         if telescope == 'Pathfinder':
             self.mag_lim = config.get(settings, telescope, 'bright_limiting_magnitude')
             self.mag_lim = config.expected_type(self.mag_lim)
@@ -53,26 +80,133 @@ class Telescope():
         lst = u_mid.sidereal_time('mean', longitude=self.location.lon)
         return lst
     
-    def get_night_length(self, date: Time) -> tuple[Time, Time]:
+    def get_night_length(self, date: Time) -> tuple[datetime, datetime]:
         """ Get the start and end times of the astronomical night for the given date.
         :param date: the date to calculate the night length for
         :return: the start and end times of the astronomical night for the given date
         """
-        times = date + (u.Quantity(range(0, 24*60, 1), u.minute))
-        altaz = AltAz(location=self.location, obstime=times)
+        night_start, night_end, _ = self.get_nights(Time(date, scale='utc').reshape((1,)))
+        return night_start[0].datetime, night_end[0].datetime
+
+    def get_nights(self, dates: Time, use_cache: bool = True) -> tuple[Time, Time, Longitude]:
+        """ Get the start and end of the astronomical night and the LST at UTC midnight for every date at once.
+        Nights found in the geometry cache are not recomputed; the rest are computed in one vectorized pass and cached.
+        :param dates: the dates to calculate the nights for, as returned by create_dates
+        :param use_cache: whether to read and update the on-disk geometry cache
+        :return: the start and end times of each astronomical night, and the LST at UTC midnight of each date
+        """
+        dates = Time(dates, scale='utc')
+        if not use_cache:
+            return self._compute_nights(dates)
 
-        # Calculate the Sun's altitude at each time
-        sun_altitudes = get_sun(times).transform_to(altaz).alt
+        keys = list(dates.isot)
+        cached = self.geometry.get(keys)
+        missing = [i for i, night in enumerate(cached) if night is None]
 
-        # Find when the Sun crosses -18 degrees altitude
-        night_start = times[sun_altitudes < -18*u.deg][0].iso
-        night_end = times[sun_altitudes < -18*u.deg][-1].iso
+        if missing:
+            night_start, night_end, lst = self._compute_nights(dates[missing])
+            computed = {
+                keys[i]: {"night_start": start, "night_end": end, "lst": float(deg)}
+                for i, start, end, deg in zip(missing, night_start.isot, night_end.isot, lst.deg)
+            }
+            self.geometry.update(computed)
+            for i in missing:
+                cached[i] = computed[keys[i]]
 
-        night_start_time = Time(night_start).datetime
-        night_end_time = Time(night_end).datetime
+        night_start = Time([night['night_start'] for night in cached], format='isot', scale='utc')
+        night_end = Time([night['night_end'] for night in cached], format='isot', scale='utc')
+        lst = Longitude([night['lst'] for night in cached], unit=u.deg)
+
+        return night_start, night_end, lst
+
+    def _compute_nights(self, dates: Time) -> tuple[Time, Time, Longitude]:
+        """ Compute the nights for every date in one vectorized pass.
+        The Sun's altitude is sampled coarsely across each UTC day, and the -18 degree crossings
+        are then refined by bisection for all dates at once.
+        :param dates: the dates to calculate the nights for
+        :return: the start and end times of each astronomical night, and the LST at UTC midnight of each date
+        """
+        lst = self.get_lST(dates)
+
+        # Sample the Sun's altitude across each day, shape (n_dates, n_samples)
+        steps = np.arange(0, 24*60 + COARSE_STEP, COARSE_STEP)
+        offsets = np.minimum(steps, 24*60 - 1)
+        times = dates[:, None] + offsets[None, :] * u.minute
+        dark = self.get_sun_altitude(times) < TWILIGHT_ALTITUDE
+
+        if not dark.any(axis=1).all():
+            raise ValueError("The Sun does not reach astronomical twilight on every date.")
+
+        # The night starts at the first dark sample and ends at the last one, as with minute sampling
+        first = np.argmax(dark, axis=1)
+        last = dark.shape[1] - 1 - np.argmax(dark[:, ::-1], axis=1)
+
+        # Bracket each crossing between a light and a dark sample, then refine
+        start = offsets[first].astype(float)
+        end = offsets[last].astype(float)
+        refine_start = first > 0
+        refine_end = last < dark.shape[1] - 1
+
+        if refine_start.any():
+            idx = np.nonzero(refine_start)[0]
+            start[idx] = self._refine_crossing(dates[idx], offsets[first[idx] - 1], offsets[first[idx]])
+        if refine_end.any():
+            idx = np.nonzero(refine_end)[0]
+            end[idx] = self._refine_crossing(dates[idx], offsets[last[idx] + 1], offsets[last[idx]])
+
+        night_start = dates + start * u.minute
+        night_end = dates + end * u.minute
+
+        return night_start, night_end, lst
+
+    def get_daylight(self, dates: Time) -> tuple[np.ndarray, np.ndarray]:
+        """ Get the daylight inside each UTC day that starts and ends in the dark, such as winter days at western sites.
+        get_nights spans the whole of such a day, which holds the end of one night and the start of the next.
+        :param dates: the dates to calculate the daylight for
+        :return: the end of the morning night (dawn) and the start of the evening night (dusk) in minutes after each date.
+                 Both are NaN for dates whose UTC day has no daylight between two nights.
+        """
+        dates = Time(dates, scale='utc')
+        steps = np.arange(0, 24*60 + COARSE_STEP, COARSE_STEP)
+        offsets = np.minimum(steps, 24*60 - 1)
+        times = dates[:, None] + offsets[None, :] * u.minute
+        dark = self.get_sun_altitude(times) < TWILIGHT_ALTITUDE
+
+        dawn = np.full(len(dates), np.nan)
+        dusk = np.full(len(dates), np.nan)
+        split = dark[:, 0] & dark[:, -1] & ~dark.all(axis=1)
+        if split.any():
+            idx = np.nonzero(split)[0]
+            first_light = np.argmax(~dark[idx], axis=1)
+            last_light = dark.shape[1] - 1 - np.argmax(~dark[idx, ::-1], axis=1)
+            dawn[idx] = self._refine_crossing(dates[idx], offsets[first_light], offsets[first_light - 1])
+            dusk[idx] = self._refine_crossing(dates[idx], offsets[last_light], offsets[last_light + 1])
+        return dawn, dusk
+
+    def get_sun_altitude(self, times: Time) -> np.ndarray:
+        """ Get the altitude of the Sun at the telescope for an array of times.
+        :param times: the times to calculate the altitude for, of any shape
+        :return: the altitude of the Sun in degrees, with the same shape as times
+        """
+        altaz = AltAz(location=self.location, obstime=times)
+        return get_sun(times).transform_to(altaz).alt.deg
+
+    def _refine_crossing(self, dates: Time, light: np.ndarray, dark: np.ndarray) -> np.ndarray:
+        """ Refine the time the Sun crosses the twilight altitude by bisection.
+        :param dates: the dates the crossings are on
+        :param light: minutes after each date at which the Sun is above the twilight altitude
+        :param dark: minutes after each date at which the Sun is below the twilight altitude
+        :return: the crossing times in minutes after each date, rounded toward the dark side
+        """
+        light = light.astype(float)
+        dark = dark.astype(float)
+        while np.max(np.abs(dark - light)) * 60 > REFINE_PRECISION:
+            middle = (light + dark) / 2
+            is_dark = self.get_sun_altitude(dates + middle * u.minute) < TWILIGHT_ALTITUDE
+            dark = np.where(is_dark, middle, dark)
+            light = np.where(is_dark, light, middle)
+        return dark
 
-        return night_start_time, night_end_time
-    
     def get_ra_range(self, date: datetime) -> tuple[float, float]:
         """ Get the right ascension range for the given date. This function is exclusive to the Pathfinder telescope.
         :param date: the date to calculate the right ascension range for
@@ -83,12 +217,23 @@ class Telescope():
         if self.name != 'Pathfinder':
             raise ValueError("RA range only available for Pathfinder telescope")
         
-        date = Time(date, format='datetime', scale='utc')
-        lst = self.get_lST(date)
+        ra_min, ra_max = self.get_ra_ranges(Time(date, scale='utc').reshape((1,)))
+        return ra_min[0], ra_max[0]
+
+    def get_ra_ranges(self, dates: Time) -> tuple[np.ndarray, np.ndarray]:
+        """ Get the right ascension range for every date at once. This function is exclusive to the Pathfinder telescope.
+        :param dates: the dates to calculate the right ascension ranges for
+        :return: the minimum and maximum right ascension in degrees for each date
+        """
+        if self.location == None:
+            raise ValueError("Telescope location not set")
+        if self.name != 'Pathfinder':
+            raise ValueError("RA range only available for Pathfinder telescope")
 
-        night_start, night_end = self.get_night_length(date)
-        ra_min = lst.deg + (night_start.hour + night_start.minute/60) * 15 
-        ra_max = lst.deg + (night_end.hour + night_end.minute/60) * 15 
+        dates = Time(dates, scale='utc')
+        night_start, night_end, lst = self.get_nights(dates)
+        ra_min = lst.deg + (night_start - dates).to_value(u.hour) * 15
+        ra_max = lst.deg + (night_end - dates).to_value(u.hour) * 15
 
         return ra_min, ra_max
     
@@ -106,3 +251,12 @@ class Telescope():
 
         
 
+def get_telescope(telescope: str) -> Telescope:
+    """ Get a shared Telescope instance, creating it on first use.
+    :param telescope: the name of the telescope in the configuration file
+    :return: the telescope
+    """
+    with _telescopes_lock:
+        if telescope not in _telescopes:
+            _telescopes[telescope] = Telescope(telescope)
+        return _telescopes[telescope]